@@ -0,0 +1,32 @@
+import json
+import sys
+from typing import Dict, Tuple
+
+# prints the change in time of each benchmark between two result files of benchmarks.run
+#   python -m benchmarks.compare old.json new.json
+
+
+def _load(path: str) -> Tuple[dict, Dict[tuple, dict]]:
+    with open(path, encoding="utf-8") as f:
+        report = json.load(f)
+    return report["meta"], {(r["benchmark"], r["history"], r["storage"]): r for r in report["results"]}
+
+
+def compare(old_path: str, new_path: str) -> None:
+    old_meta, old = _load(old_path)
+    new_meta, new = _load(new_path)
+    print(f"{old_meta.get('commit') or old_path} -> {new_meta.get('commit') or new_path}")
+    print(f"{'benchmark':<34}{'history':>9}{'storage':>9}{'old s':>11}{'new s':>11}{'change':>9}")
+    for key in sorted(old.keys() & new.keys(), key=lambda k: (k[0], k[1], k[2])):
+        before, after = old[key]["seconds"], new[key]["seconds"]
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "-"
+        print(f"{key[0]:<34}{key[1]:>9}{key[2]:>9}{before:>11.4f}{after:>11.4f}{change:>9}")
+
+    for key in sorted(old.keys() ^ new.keys()):
+        print(f"only in {'the old' if key in old else 'the new'} results: {key[0]} at {key[1]} ({key[2]})")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: python -m benchmarks.compare old.json new.json")
+    compare(sys.argv[1], sys.argv[2])
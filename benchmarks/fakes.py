@@ -0,0 +1,296 @@
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Union
+
+import praw
+from praw.reddit import Submission
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+BASE36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+MEDIA_ID_LETTERS = str.maketrans("0123456789", "ABCDEFGHIJ")
+
+
+def base36(n: int) -> str:
+    digits = ""
+    while True:
+        n, r = divmod(n, 36)
+        digits = BASE36[r] + digits
+        if n == 0:
+            return digits
+
+
+def reddit_id(n: int) -> str:
+    # reddit fullnames of posts are t3_ followed by an increasing base36 number
+    return f"t3_{base36(n + 36**4)}"
+
+
+def offline_reddit() -> praw.Reddit:
+    # a praw client that never authenticates, submissions only need it as their parent
+    return praw.Reddit(client_id="benchmark", client_secret="benchmark", user_agent="benchmark")
+
+
+# the share of each kind of submission in a synthetic listing
+SUBMISSION_KINDS = {
+    "self": 0.35,
+    "image_head": 0.20,
+    "image_rules": 0.10,
+    "link": 0.15,
+    "video": 0.05,
+    "reddit_link": 0.05,
+    "gallery": 0.10,
+}
+
+
+def make_submission_data(n: int, head_url: str, rng: random.Random, subreddit: str = "benchmark") -> dict:
+    # the listing payload of one submission, as reddit returns it
+    name = reddit_id(n)
+    short_id = name[3:]
+    kind = rng.choices(list(SUBMISSION_KINDS), weights=list(SUBMISSION_KINDS.values()))[0]
+    permalink = f"/r/{subreddit}/comments/{short_id}/post_{n}/"
+    # urls of external content must not contain the post id, or they are taken for links to the post itself
+    media_id = str(n).translate(MEDIA_ID_LETTERS)
+
+    url = f"https://www.reddit.com{permalink}"
+    selftext = ""
+    if kind == "self":
+        selftext = f"Body of post {n}. " * rng.randint(1, 20)
+    elif kind == "image_head":
+        # only a HEAD request can tell that this is an image
+        url = f"{head_url}/image/{media_id}.png"
+    elif kind == "image_rules":
+        url = f"https://i.redd.it/{media_id}.jpg"
+    elif kind == "link":
+        url = f"{head_url}/page/{media_id}"
+    elif kind == "video":
+        url = f"https://v.redd.it/{media_id}"
+    elif kind == "reddit_link":
+        url = f"https://www.reddit.com/r/{subreddit}/comments/{media_id.lower()}/"
+    elif kind == "gallery":
+        url = f"https://www.reddit.com/gallery/{short_id}"
+
+    data = {
+        "name": name,
+        "id": short_id,
+        "title": f"Title of post {n}",
+        "selftext": selftext,
+        "url": url,
+        "permalink": permalink,
+        "link_flair_text": rng.choice([None, None, "News", "Discussion"]),
+        "stickied": rng.random() < 0.02,
+        "over_18": rng.random() < 0.03,
+        "locked": rng.random() < 0.02,
+        "is_video": kind == "video",
+        "created_utc": 1700000000 + n,
+    }
+    # reddit only sends poll_data for polls
+    if rng.random() < 0.02:
+        data["poll_data"] = {"options": []}
+    return data
+
+
+def make_submissions(reddit: praw.Reddit, start: int, count: int, head_url: str, seed: int = 0) -> Iterator[Submission]:
+    # praw submissions built from a listing payload, so that nothing is fetched lazily
+    rng = random.Random(seed + start)
+    for n in range(start, start + count):
+        yield Submission(reddit, _data=make_submission_data(n, head_url, rng))
+
+
+def make_history(count: int, pair: Union[str, None] = None) -> Dict[str, dict]:
+    # the TinyDB table of `count` mirrored threads, as slim records
+    table = {}
+    for n in range(count):
+        record = {
+            "reddit_id": reddit_id(n),
+            "lemmy_post_id": n + 1,
+            "mirrored_at": 1700000000 + n,
+            "content_hash": f"{n:016x}",
+        }
+        if pair is not None:
+            record["pair"] = pair
+        table[str(n + 1)] = record
+    return table
+
+
+def write_history(path: str, count: int) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"_default": make_history(count)}, f)
+
+
+class _FakeLemmyPost:
+    def __init__(self, lemmy: "FakeLemmy"):
+        self.lemmy = lemmy
+
+    def create(self, community_id: int, name: str, **kwargs) -> dict:
+        self.lemmy._wait()
+        post_id = self.lemmy._add_post(name)
+        return {"post_view": {"post": {"id": post_id, "name": name, "community_id": community_id}}}
+
+    def list(self, community_id: int, sort=None, limit: int = 20, page: int = 1) -> List[dict]:
+        self.lemmy._wait()
+        with self.lemmy._lock:
+            posts = sorted(self.lemmy.posts.values(), key=lambda p: p["post"]["id"], reverse=True)
+        return posts[(page - 1) * limit : page * limit]
+
+    def save(self, post_id: int, saved: bool) -> dict:
+        self.lemmy._wait()
+        with self.lemmy._lock:
+            self.lemmy.posts[post_id]["saved"] = saved
+            return self.lemmy.posts[post_id]
+
+
+class _FakeLemmyComment:
+    def __init__(self, lemmy: "FakeLemmy"):
+        self.lemmy = lemmy
+
+    def create(self, post_id: int, content: str, **kwargs) -> dict:
+        self.lemmy._wait()
+        with self.lemmy._lock:
+            self.lemmy.comments += 1
+            comment_id = self.lemmy.comments
+        return {"comment_view": {"comment": {"id": comment_id, "post_id": post_id}}}
+
+    def distinguish(self, comment_id: int, distinguished: bool) -> dict:
+        self.lemmy._wait()
+        return {"comment_view": {"comment": {"id": comment_id, "distinguished": distinguished}}}
+
+
+class FakeLemmy:
+    # the parts of pythorhead's Lemmy the bot calls, in memory, each call taking `latency` seconds
+
+    def __init__(self, latency: float = 0.0, community_id: int = 1):
+        self.latency = latency
+        self.community_id = community_id
+        self.posts: Dict[int, dict] = {}
+        self.comments = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.post = _FakeLemmyPost(self)
+        self.comment = _FakeLemmyComment(self)
+
+    def _wait(self) -> None:
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _add_post(self, name: str, creator: str = "MirrorBot") -> int:
+        with self._lock:
+            post_id = len(self.posts) + 1
+            self.posts[post_id] = {
+                "post": {
+                    "id": post_id,
+                    "name": name,
+                    "deleted": False,
+                    "removed": False,
+                    "locked": False,
+                    "featured_community": False,
+                },
+                "creator": {"name": creator, "bot_account": True},
+                "saved": False,
+            }
+            return post_id
+
+    def add_posts(self, count: int) -> None:
+        for n in range(count):
+            self._add_post(f"Post {n}", creator="someone")
+
+    def discover_community(self, community: str) -> int:
+        self._wait()
+        return self.community_id
+
+
+class _HeadHandler(BaseHTTPRequestHandler):
+    # paths under /image/ are images, anything else is a web page
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.server.requests += 1
+        content_type = "image/png" if self.path.startswith("/image/") else "text/html; charset=utf-8"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HeadServer:
+    # a local HTTP server answering HEAD requests after `latency` seconds
+
+    def __init__(self, latency: float = 0.0):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _HeadHandler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self.server.requests = 0
+        self._thread = threading.Thread(target=self.server.serve_forever, name="head-server", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def requests(self) -> int:
+        return self.server.requests
+
+    def __enter__(self) -> "HeadServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeFilestack:
+    # handle -> file contents, in place of Filestack's storage.
+    # `filelink` replaces filestack.Filelink in src.helper, every transfer takes `latency` seconds
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.files: Dict[str, bytes] = {}
+        self.uploaded_bytes = 0
+        self.downloaded_bytes = 0
+
+    def filelink(self, handle: str, security=None) -> "_FakeFilelink":
+        return _FakeFilelink(self, handle)
+
+
+class _FakeFilelink:
+    def __init__(self, filestack: FakeFilestack, handle: str):
+        self.filestack = filestack
+        self.handle = handle
+        self.url = f"https://cdn.filestackcontent.com/{handle}"
+
+    def download(self, path: str) -> Union[int, None]:
+        time.sleep(self.filestack.latency)
+        data = self.filestack.files.get(self.handle)
+        if data is None:
+            return None
+        with open(path, "wb") as f:
+            f.write(data)
+        self.filestack.downloaded_bytes += len(data)
+        return len(data)
+
+    def overwrite(self, filepath: str, security=None) -> "_FakeFilelink":
+        time.sleep(self.filestack.latency)
+        with open(filepath, "rb") as f:
+            data = f.read()
+        self.filestack.files[self.handle] = data
+        self.filestack.uploaded_bytes += len(data)
+        return self
+
+    def metadata(self) -> dict:
+        return {"filename": self.handle, "size": len(self.filestack.files.get(self.handle, b""))}
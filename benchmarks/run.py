@@ -0,0 +1,261 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, List, Union
+from unittest import mock
+
+from benchmarks.fakes import (
+    FakeFilestack,
+    FakeLemmy,
+    HeadServer,
+    make_submissions,
+    offline_reddit,
+    reddit_id,
+    write_history,
+)
+from src.auto_mod import AutoMod, AutoModState
+from src.helper import BackupCodec, Compression, DataBase
+from src.media import MediaClassifier, MediaRules
+from src.mirror import _extract_threads_to_mirror, mirror_threads_to_lemmy
+from src.ratelimit import TokenBucket
+from src.records import mirrored_record
+from src.store import open_thread_store
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+# runs the bot's hot paths against synthetic Reddit listings and in-process fakes of Lemmy,
+# the image hosts and Filestack, for mirrored thread histories of several sizes.
+#   python -m benchmarks.run --sizes 1000 10000 100000 --output results.json
+# the results are JSON, two runs can be compared with `python -m benchmarks.compare old.json new.json`
+
+
+def _timed(func: Callable, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def _result(benchmark: str, history: int, storage: str, seconds: float, items: int, **extra) -> dict:
+    return {
+        "benchmark": benchmark,
+        "history": history,
+        "storage": storage,
+        "seconds": round(seconds, 6),
+        "items": items,
+        "ms_per_item": round(seconds * 1000 / items, 4) if items else None,
+        **extra,
+    }
+
+
+def _git_commit() -> Union[str, None]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def bench_extract(args, store, history: int, storage: str, head: HeadServer) -> dict:
+    # a listing of new threads with a share of already mirrored ones, classified over the HEAD server
+    reddit = offline_reddit()
+    mirrored = int(args.listing_size * args.mirrored_share)
+    listing = list(make_submissions(reddit, max(history - mirrored, 0), args.listing_size, head.url, args.seed))
+    classifier = MediaClassifier(timeout=5, deadline=60, max_workers=args.head_workers, rules=MediaRules())
+
+    requests_before = head.requests
+    seconds, threads = _timed(_extract_threads_to_mirror, listing, store, classifier=classifier)
+    return _result(
+        "extract_threads_to_mirror",
+        history,
+        storage,
+        seconds,
+        len(listing),
+        candidates=len(threads),
+        head_requests=head.requests - requests_before,
+    )
+
+
+def bench_mirror(args, store, history: int, storage: str, head: HeadServer) -> dict:
+    # posting every thread of a listing, including its database lookups and inserts
+    reddit = offline_reddit()
+    listing = make_submissions(reddit, history + args.listing_size, args.posts, head.url, args.seed)
+    # every thread is mirrored, not only the ones the default ignore list lets through
+    classifier = MediaClassifier(rules=MediaRules(non_image_domains=MediaRules.non_image_domains + ("127.0.0.1",)))
+    threads = _extract_threads_to_mirror(listing, store, ignore_thread_types=[], classifier=classifier)
+    lemmy = FakeLemmy(latency=args.lemmy_latency)
+
+    seconds, posted = _timed(mirror_threads_to_lemmy, lemmy, threads, "benchmark", store, limiter=TokenBucket(None))
+    return _result("mirror_threads_to_lemmy", history, storage, seconds, len(threads), posted=posted)
+
+
+def bench_auto_mod(args, history: int) -> dict:
+    # commenting on the new posts of a community, the posts it has seen before are skipped
+    lemmy = FakeLemmy(latency=args.lemmy_latency)
+    lemmy.add_posts(args.auto_mod_posts)
+    with tempfile.TemporaryDirectory() as tmp:
+        state = AutoModState(os.path.join(tmp, "automod_state.json"))
+        auto_mod = AutoMod(
+            lemmy,
+            "benchmark",
+            "AutoModBot",
+            limiter=TokenBucket(None),
+            state=state,
+            use_saved_flag=True,
+            max_pages=args.auto_mod_posts // 20 + 1,
+        )
+        seconds, _ = _timed(auto_mod.comment_on_new_threads, "Be nice!")
+    return _result(
+        "auto_mod_comment_on_new_threads",
+        history,
+        "-",
+        seconds,
+        args.auto_mod_posts,
+        comments=lemmy.comments,
+        lemmy_calls=lemmy.calls,
+    )
+
+
+def bench_db(args, db_path: str, history: int, storage: str) -> List[dict]:
+    # how opening, looking up and inserting into the database scale with its size
+    results = []
+    seconds, store = _timed(open_thread_store, db_path, storage=storage)
+    results.append(_result("db_open", history, storage, seconds, history, bytes=os.path.getsize(db_path)))
+
+    hits = [reddit_id(n) for n in range(0, history, max(history // args.lookups, 1))][: args.lookups]
+    misses = [reddit_id(history + n) for n in range(args.lookups)]
+    seconds, _ = _timed(lambda: [store.contains(key) for key in hits + misses])
+    results.append(_result("db_lookup", history, storage, seconds, len(hits) + len(misses)))
+
+    threads = [{"reddit_id": reddit_id(history + n), "title": f"Title {n}"} for n in range(args.inserts)]
+    seconds, _ = _timed(lambda: [store.insert(mirrored_record(t)) for t in threads])
+    store.close()
+    size = os.path.getsize(db_path)
+    results.append(
+        _result(
+            "db_insert",
+            history,
+            storage,
+            seconds,
+            len(threads),
+            bytes=size,
+            bytes_per_thread=round(size / (history + len(threads)), 1),
+        )
+    )
+    return results
+
+
+def bench_filestack(args, db_path: str, history: int) -> List[dict]:
+    # a full snapshot, a delta after new threads were mirrored, and a restore, against the fake Filestack
+    results = []
+    filestack = FakeFilestack(latency=args.filestack_latency)
+    kwargs = {"app_secret": "benchmark", "apikey": "benchmark", "handle": "backup", "delta_handle": "delta"}
+
+    with mock.patch("src.helper.Filelink", filestack.filelink):
+        backup = DataBase(db_path=db_path, codec=BackupCodec(compression=Compression.gzip))
+        uploaded = filestack.uploaded_bytes
+        seconds, _ = _timed(backup.refresh_backup, **kwargs)
+        results.append(
+            _result("filestack_snapshot", history, "json", seconds, history, bytes=filestack.uploaded_bytes - uploaded)
+        )
+
+        with open_thread_store(db_path) as store:
+            for n in range(args.inserts):
+                store.insert(mirrored_record({"reddit_id": reddit_id(history + args.inserts + n), "title": ""}))
+
+        uploaded = filestack.uploaded_bytes
+        seconds, _ = _timed(backup.refresh_backup, **kwargs)
+        results.append(
+            _result(
+                "filestack_delta", history, "json", seconds, args.inserts, bytes=filestack.uploaded_bytes - uploaded
+            )
+        )
+
+        restored = DataBase(db_path=f"{db_path}.restore", codec=backup.codec)
+        seconds, _ = _timed(restored.get_backup, **kwargs)
+        results.append(
+            _result("filestack_restore", history, "json", seconds, history, bytes=filestack.downloaded_bytes)
+        )
+    return results
+
+
+def run(args) -> dict:
+    results: List[dict] = []
+    with HeadServer(latency=args.head_latency) as head, tempfile.TemporaryDirectory() as tmp:
+        for history in args.sizes:
+            logging.warning(f"Benchmarking with {history} mirrored threads")
+            for storage in args.storages:
+                db_path = os.path.join(tmp, f"db_{history}_{storage}.json")
+
+                write_history(db_path, history)
+                results.extend(bench_db(args, db_path, history, storage))
+
+                write_history(db_path, history)
+                with open_thread_store(db_path, storage=storage) as store:
+                    results.append(bench_extract(args, store, history, storage, head))
+                    results.append(bench_mirror(args, store, history, storage, head))
+
+            results.append(bench_auto_mod(args, history))
+
+            db_path = os.path.join(tmp, f"db_{history}_filestack.json")
+            write_history(db_path, history)
+            results.extend(bench_filestack(args, db_path, history))
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "params": {k: v for k, v in vars(args).items() if k not in ("output", "log_level")},
+        },
+        "results": results,
+    }
+
+
+def parse_args(argv: Union[List[str], None] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the bot offline against synthetic data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="mirrored threads")
+    parser.add_argument("--storages", nargs="+", default=["json", "journal"], choices=["json", "journal"])
+    parser.add_argument("--listing-size", type=int, default=100, help="submissions per listing")
+    parser.add_argument("--mirrored-share", type=float, default=0.2, help="share of the listing already mirrored")
+    parser.add_argument("--posts", type=int, default=50, help="threads posted to the fake Lemmy")
+    parser.add_argument("--auto-mod-posts", type=int, default=50, help="new posts AutoMod comments on")
+    parser.add_argument("--lookups", type=int, default=1000, help="database lookups, half of them hits")
+    parser.add_argument("--inserts", type=int, default=50, help="database inserts")
+    parser.add_argument("--head-workers", type=int, default=16)
+    parser.add_argument("--head-latency", type=float, default=0.02, help="seconds per HEAD request")
+    parser.add_argument("--lemmy-latency", type=float, default=0.01, help="seconds per Lemmy call")
+    parser.add_argument("--filestack-latency", type=float, default=0.05, help="seconds per Filestack transfer")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--log-level", default="WARNING", help="the bot logs every thread at INFO")
+    return parser.parse_args(argv)
+
+
+def main(argv: Union[List[str], None] = None) -> dict:
+    args = parse_args(argv)
+    logging.getLogger().setLevel(args.log_level.upper())
+
+    report = run(args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ def get_handles():
 
     backup_filename = "mirrored_threads_backup.json"
     refresh_filename = "mirrored_threads_refresh.json"
+    delta_filename = "mirrored_threads_delta.json"
     db = DataBase()
 
     try:
@@ -24,10 +25,17 @@ def get_handles():
             filename=backup_filename,
             db_path=db_path,
         )
+        delta_file = db._upload_backup(
+            app_secret=app_secret,
+            apikey=apikey,
+            filename=delta_filename,
+            db_path=db_path,
+        )
         print("\n\n")
         print("Add these variables to the .env file")
         print(f'FILESTACK_HANDLE_REFRESH="{refresh_file.handle}"')
         print(f'FILESTACK_HANDLE_BACKUP="{backup_file.handle}"')
+        print(f'FILESTACK_HANDLE_DELTA="{delta_file.handle}"')
 
     except Exception as e:
         print("Could not create files, check your API Key and App Secret.")
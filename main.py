@@ -1,18 +1,39 @@
 import logging
 import os
-import random
+import signal
+import sys
 import threading
 from time import sleep
 
 import praw
 import schedule
 from pythorhead import Lemmy
-from tinydb import TinyDB
 
+from src import ratelimit
 from src.auth import lemmy_auth, reddit_oauth
-from src.auto_mod import AutoMod
-from src.helper import Config, DataBase, ScheduleType, Task
-from src.mirror import get_threads_from_reddit, mirror_threads_to_lemmy
+from src.auto_mod import AutoMod, AutoModState
+from src.helper import (
+    BackupCodec,
+    Config,
+    DataBase,
+    MirrorPair,
+    ScheduleType,
+    Task,
+    ThreadSelection,
+)
+from src.media import ContentTypeCache, MediaClassifier, MediaRules
+from src.metrics import start_metrics_server
+from src.mirror import (
+    ListingCheckpoint,
+    mirror_threads_to_lemmy,
+    select_threads_from_reddit,
+)
+from src.pipeline import MirrorPipeline, mirror_with_pipeline
+from src.ratelimit import TokenBucket, configure_lemmy_write_limiter
+from src.records import migrate_db_file
+from src.restore import BackgroundRestore
+from src.scheduler import JobPool, SchedulerLoop
+from src.store import ScopedThreadStore, ThreadStore, open_thread_store
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s",
@@ -28,55 +49,141 @@ schedule_logger.setLevel(level=logging.INFO)
 
 def mirror(
     reddit: praw.Reddit,
-    database: TinyDB,
-    mirror_threads_limit: int,
-    filter: str,
-    reddit_filter_limit: int = 10,
+    database: ThreadStore,
+    pair: MirrorPair,
     mirror_delay: int = 25,
-    cancel_after_first_run: bool = False,
     lemmy: Lemmy = None,
+    classifier: MediaClassifier = None,
+    restore: BackgroundRestore = None,
+    checkpoint: ListingCheckpoint = None,
 ) -> None:
-    logging.info("Task is running on thread %s" % threading.current_thread())
+    logging.info(f"Task for {pair.label} is running on thread %s" % threading.current_thread())
 
     if not reddit or not lemmy:
         return
 
-    threads = get_threads_from_reddit(
-        reddit,
-        config.REDDIT_SUBREDDIT,
-        database,
-        limit=reddit_filter_limit,
-        ignore_thread_types=config.REDDIT_THREADS_TO_IGNORE,
-        filter=filter,
-    )
+    # threads missing from the local snapshot would be mirrored again
+    if restore is not None and not restore.ready.is_set():
+        logging.info("Waiting for the Filestack backup to be restored before mirroring")
+        return
 
-    if threads:
-        thread_sample = random.sample(threads, mirror_threads_limit)
-        logging.info(f"Capping the number of threads to mirror at {mirror_threads_limit}")
+    # all pairs share one store, each pair only sees its own threads
+    store = ScopedThreadStore(database, pair.name, include_unpaired=pair.unpaired) if pair.name else database
+
+    # with LEMMY_WRITES_PER_MINUTE all Lemmy writes share one limit,
+    # otherwise only the posts of this run are kept `mirror_delay` seconds apart
+    limiter = ratelimit.lemmy_write_limiter if config.LEMMY_WRITES_PER_MINUTE else None
+
+    if config.MIRROR_PIPELINE:
+        pipeline = MirrorPipeline(
+            reddit,
+            lemmy,
+            pair.subreddit,
+            pair.community,
+            store,
+            limit=pair.limit,
+            filter=pair.filter,
+            cap=pair.cap,
+            ignore_thread_types=pair.ignore_thread_types,
+            classifier=classifier,
+            limiter=limiter or TokenBucket.from_delay(mirror_delay),
+            queue_size=config.PIPELINE_QUEUE_SIZE,
+            selection=config.MIRROR_SELECTION,
+            batch_size=config.MIRROR_EXTRACT_BATCH_SIZE,
+            checkpoint=checkpoint,
+            catch_up_limit=config.REDDIT_CATCH_UP_MAX_THREADS,
+            pair=pair.name,
+        )
+        posted = mirror_with_pipeline(pipeline)
+    else:
+        threads = select_threads_from_reddit(
+            reddit,
+            pair.subreddit,
+            store,
+            cap=pair.cap,
+            limit=pair.limit,
+            ignore_thread_types=pair.ignore_thread_types,
+            filter=pair.filter,
+            classifier=classifier,
+            selection=config.MIRROR_SELECTION,
+            batch_size=config.MIRROR_EXTRACT_BATCH_SIZE,
+            checkpoint=checkpoint,
+            catch_up_limit=config.REDDIT_CATCH_UP_MAX_THREADS,
+            pair=pair.name,
+        )
+
+        posted = 0
+        if threads:
+            posted = mirror_threads_to_lemmy(
+                lemmy,
+                threads,
+                pair.community,
+                store,
+                mirror_delay,
+                limiter=limiter,
+            )
+            if limiter is not None:
+                logging.info(f"Lemmy writes have been throttled for {limiter.throttled_seconds:.1f} seconds in total")
 
-        mirror_threads_to_lemmy(lemmy, thread_sample, config.LEMMY_COMMUNITY, database, mirror_delay)
+    logging.info(f"Posted {posted} threads in total for {pair.label}")
 
-    logging.info(f"Posted {mirror_threads_limit} threads in total")
+    # the listing checkpoint moves over the threads that were posted or rejected, failed posts are read again
+    if checkpoint is not None:
+        checkpoint.commit(checkpoint.key(pair.subreddit, pair.filter, pair.name), store.contains)
 
-    # if this is the first mirror job to run
-    if cancel_after_first_run:
-        return schedule.CancelJob
+    if database.bloom is not None:
+        logging.info(f"The bloom filter has saved {database.lookups_saved} exact database lookups so far")
 
 
-def automod_comment_on_new_threads(config: dict, lemmy: Lemmy):
+def automod_comment_on_new_threads(config: dict, lemmy: Lemmy, state: AutoModState = None):
     logging.info("Task is running on thread %s" % threading.current_thread())
 
-    auto_mod = AutoMod(lemmy, config.LEMMY_COMMUNITY, config.LEMMY_USERNAME)
+    auto_mod = AutoMod(
+        lemmy,
+        config.LEMMY_COMMUNITY,
+        config.LEMMY_USERNAME,
+        state=state,
+        use_saved_flag=config.AUTOMOD_USE_SAVED_FLAG,
+        page_size=config.AUTOMOD_PAGE_SIZE,
+        max_pages=config.AUTOMOD_MAX_PAGES_PER_TICK,
+        time_budget=config.AUTOMOD_TIME_BUDGET_SECOND,
+        max_in_flight=config.AUTOMOD_MAX_IN_FLIGHT,
+    )
     auto_mod.comment_on_new_threads(mod_message=config.LEMMY_MOD_MESSAGE_NEW_THREADS)
 
 
+def sync_backup(database: ThreadStore, filestack: DataBase, restore: BackgroundRestore = None, **kwargs):
+    # never overwrite the backup with a local snapshot it has not been merged into
+    if restore is not None and not restore.ready.is_set():
+        logging.info("Waiting for the Filestack backup to be restored before uploading the database")
+        return
+
+    # fold any journaled inserts into the database file before uploading it
+    database.flush()
+    filestack.refresh_backup(**kwargs)
+
+
 def raiseError(e):
     raise e
 
 
-def run_threaded(thread_func: callable, name: str, op_kwargs: dict = {}):
-    job_thread = threading.Thread(target=thread_func, daemon=True, name=name, kwargs=op_kwargs)
-    job_thread.start()
+def run_threaded(thread_func: callable, name: str, pool: JobPool, op_kwargs: dict = {}):
+    pool.submit(name, thread_func, op_kwargs)
+    logging.info(f"Job pool: {pool.running} running, {pool.queue_depth} queued")
+
+
+def run_until_stopped(scheduler: SchedulerLoop, pool: JobPool) -> None:
+    try:
+        scheduler.run_forever()
+    finally:
+        # on SIGTERM the running jobs finish writing to the database before it is closed, queued ones are dropped
+        scheduler.stop()
+        pool.shutdown(wait=True, cancel_queued=True)
+
+
+def run_threaded_once(thread_func: callable, name: str, pool: JobPool, op_kwargs: dict = {}):
+    run_threaded(thread_func, name, pool, op_kwargs)
+    return schedule.CancelJob
 
 
 if __name__ == "__main__":
@@ -85,19 +192,36 @@ if __name__ == "__main__":
     config = Config(env_values)
     needs_database = [Task.mirror_threads]
 
+    # docker stop sends SIGTERM, exit cleanly so the database is closed (and compacted)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    # Prometheus metrics on the exposed port
+    if config.METRICS_PORT:
+        start_metrics_server(config.METRICS_PORT)
+
     # authenticate with lemmy
     lemmy = lemmy_auth(config)
 
+    # when set, all posts and comments share one Lemmy rate limit
+    if config.LEMMY_WRITES_PER_MINUTE:
+        configure_lemmy_write_limiter(config.LEMMY_WRITES_PER_MINUTE / 60, config.LEMMY_WRITE_BURST)
+
+    # scheduled jobs share a fixed number of worker threads
+    # and a job never runs twice at the same time
+    pool = JobPool(max_workers=config.WORKER_POOL_SIZE, policy=config.JOB_OVERLAP_POLICY)
+
     # schedule tasks
     if Task.mod_comment_on_new_threads in config.TASKS:
         interval = 60 * 3
         schedule.every(interval).seconds.do(
             run_threaded,
             name="comment_on_new_threads",
+            pool=pool,
             thread_func=automod_comment_on_new_threads,
             op_kwargs={
                 "config": config,
                 "lemmy": lemmy,
+                "state": AutoModState(config.AUTOMOD_STATE_PATH),
             },
         )
         logging.info(f"TASK: Checking for new posts every {interval} seconds")
@@ -107,104 +231,169 @@ if __name__ == "__main__":
         backup_h = config.BACKUP_FILESTACK_EVERY_HOUR
         refresh_m = config.REFRESH_FILESTACK_EVERY_MINUTE
         mirror_delay_s = config.DELAY_BETWEEN_MIRRORED_THREADS_SECOND
-        filter_limit = config.REDDIT_FILTER_THREAD_LIMIT
-        reddit_cap = config.REDDIT_CAP_NUMBER_OF_MIRRORED_THREADS
         schedule_type = config.REDDIT_MIRROR_SCHEDULE_TYPE
 
         # get latest backup of the database
         database_path = "data/mirrored_threads.json"
-        filestack = DataBase(db_path=database_path)
-        filestack.get_backup(
-            app_secret=config.FILESTACK_APP_SECRET,
-            apikey=config.FILESTACK_API_KEY,
-            handle=config.FILESTACK_HANDLE_REFRESH,
+        filestack = DataBase(
+            db_path=database_path,
+            codec=BackupCodec(compression=config.BACKUP_COMPRESSION),
+            full_snapshot_every=config.BACKUP_FULL_SNAPSHOT_EVERY,
         )
+        backup_kwargs = {
+            "app_secret": config.FILESTACK_APP_SECRET,
+            "apikey": config.FILESTACK_API_KEY,
+            "handle": config.FILESTACK_HANDLE_REFRESH,
+            "delta_handle": config.FILESTACK_HANDLE_DELTA,
+        }
+        restore = None
+        if not config.FILESTACK_RESTORE_IN_BACKGROUND:
+            filestack.get_backup(**backup_kwargs)
+
+            # confirm the file has been downloaded
+            assert os.path.exists(database_path) or raiseError(FileNotFoundError)
+
+        # threads mirrored by older versions keep their full content, only a slim record is needed
+        before, after = migrate_db_file(database_path)
+        if after < before:
+            logging.info(f"Slimmed down the mirrored threads in {database_path} from {before} to {after} bytes")
+
+        # initialize database, indexed by reddit_id
+        database = open_thread_store(
+            database_path,
+            storage=config.DATABASE_STORAGE.value,
+            compact_every=config.DATABASE_COMPACT_EVERY,
+        )
+        if config.BLOOM_FILTER_FALSE_POSITIVE_RATE:
+            database.attach_bloom_filter(
+                false_positive_rate=config.BLOOM_FILTER_FALSE_POSITIVE_RATE,
+                max_bytes=config.BLOOM_FILTER_MAX_BYTES,
+                trust_positives=config.BLOOM_FILTER_TRUST_POSITIVES,
+            )
 
-        # confirm the file has been downloaded
-        assert os.path.exists(database_path) or raiseError(FileNotFoundError)
-
-        # initialize database
-        database = TinyDB(database_path)
+        if config.FILESTACK_RESTORE_IN_BACKGROUND:
+            # start from the local snapshot, the backup is downloaded next to it and merged in
+            logging.info(f"Starting from {len(database)} mirrored threads in the local database")
+            restore = BackgroundRestore(
+                database,
+                DataBase(db_path=f"{database_path}.restore", codec=filestack.codec),
+                retry_seconds=config.FILESTACK_RESTORE_RETRY_SECOND,
+                **backup_kwargs,
+            ).start()
 
         # authenticate with reddit once at the beginning
         reddit = reddit_oauth(config)
 
-        if schedule_type == ScheduleType.daily:
-            time_utc = config.MIRROR_EVERY_DAY_AT
-            # schedule to mirror every day at {time_utc}
-            schedule.every().day.at(time_utc, "UTC").do(
-                run_threaded,
-                thread_func=mirror,
-                name="mirror_daily",
-                op_kwargs={
-                    "reddit": reddit,
-                    "database": database,
-                    "mirror_threads_limit": reddit_cap,
-                    "filter": config.FILTER_BY,
-                    "reddit_filter_limit": filter_limit,
-                    "mirror_delay": mirror_delay_s,
-                    "cancel_after_first_run": False,
-                    "lemmy": lemmy,
-                },
-            )
-            logging.info(
-                f"TASK: Mirroring threads every every day at {time_utc} UTC with a delay of {mirror_delay_s} seconds between threads"
-            )
-            logging.info(
-                f"Checking up to {filter_limit} threads at a time, posting {reddit_cap} at a time, at {time_utc} UTC.."
-            )
-        elif schedule_type == ScheduleType.every_x_seconds:
-            # schedule to mirror every {mirror_s} seconds
-            mirror_s = config.MIRROR_THREADS_EVERY_SECOND
-            schedule.every(mirror_s).seconds.do(
-                run_threaded,
-                thread_func=mirror,
-                name="mirror_every_x_seconds",
-                op_kwargs={
-                    "reddit": reddit,
-                    "database": database,
-                    "mirror_threads_limit": reddit_cap,
-                    "filter": config.FILTER_BY,
-                    "reddit_filter_limit": filter_limit,
-                    "mirror_delay": mirror_delay_s,
-                    "cancel_after_first_run": False,
-                    "lemmy": lemmy,
-                },
+        # most urls can be told apart as images by their domain and extension alone
+        if config.MEDIA_RULES_FILE:
+            media_rules = MediaRules.from_file(config.MEDIA_RULES_FILE)
+        else:
+            media_rules = MediaRules(
+                image_domains=config.MEDIA_IMAGE_DOMAINS,
+                non_image_domains=config.MEDIA_NON_IMAGE_DOMAINS,
+                image_extensions=config.MEDIA_IMAGE_EXTENSIONS,
             )
 
-            # the scheduler will run the first job after {mirror_delay_s} seconds
-            # but for the bot to activate immediately, we can run the function
-            # first as a separate job and cancel it after the first run
-            schedule.every().seconds.do(
-                mirror,
-                reddit=reddit,
-                database=database,
-                mirror_threads_limit=reddit_cap,
-                filter=config.FILTER_BY,
-                reddit_filter_limit=filter_limit,
-                mirror_delay=mirror_delay_s,
-                cancel_after_first_run=True,
-                lemmy=lemmy,
-            )
-            logging.info(
-                f"TASK: Mirroring threads every {mirror_s} seconds with a delay of {mirror_delay_s} seconds between threads"
-            )
+        # the rest are checked for images concurrently over a shared connection pool,
+        # content types of urls seen before are cached on disk
+        classifier = MediaClassifier(
+            timeout=config.HEAD_REQUEST_TIMEOUT_SECOND,
+            deadline=config.HEAD_REQUESTS_DEADLINE_SECOND,
+            max_workers=config.HEAD_REQUESTS_MAX_WORKERS,
+            rules=media_rules,
+            cache=ContentTypeCache(
+                path=config.CONTENT_TYPE_CACHE_PATH,
+                max_entries=config.CONTENT_TYPE_CACHE_MAX_ENTRIES,
+                ttl=config.CONTENT_TYPE_CACHE_TTL_HOUR * 60 * 60,
+                negative_ttl=config.CONTENT_TYPE_CACHE_NEGATIVE_TTL_MINUTE * 60,
+            ),
+        )
 
-            logging.info(
-                f"Checking up to {filter_limit} threads at a time, posting {reddit_cap} at a time, starting now..."
-            )
+        # the newest thread read from the new listing, so that later runs only read newer threads
+        checkpoint = None
+        if config.REDDIT_LISTING_CHECKPOINT:
+            checkpoint = ListingCheckpoint(config.REDDIT_LISTING_CHECKPOINT_PATH)
+            if config.MIRROR_SELECTION != ThreadSelection.first:
+                logging.warning("REDDIT_LISTING_CHECKPOINT only applies with MIRROR_SELECTION=first, it is ignored")
+
+        # every pair is a separate job in the shared pool,
+        # with the same reddit client, lemmy session, store and classifier
+        for pair in config.MIRROR_PAIRS:
+            mirror_kwargs = {
+                "reddit": reddit,
+                "database": database,
+                "pair": pair,
+                "mirror_delay": mirror_delay_s,
+                "lemmy": lemmy,
+                "classifier": classifier,
+                "restore": restore,
+                "checkpoint": checkpoint,
+            }
+            job_suffix = f":{pair.name}" if pair.name else ""
+
+            if schedule_type == ScheduleType.daily:
+                time_utc = config.MIRROR_EVERY_DAY_AT
+                # schedule to mirror every day at {time_utc}
+                schedule.every().day.at(time_utc, "UTC").do(
+                    run_threaded,
+                    thread_func=mirror,
+                    name=f"mirror_daily{job_suffix}",
+                    pool=pool,
+                    op_kwargs=mirror_kwargs,
+                )
+                logging.info(
+                    f"TASK: Mirroring threads from {pair.label} every every day at {time_utc} UTC with a delay of {mirror_delay_s} seconds between threads"
+                )
+                logging.info(
+                    f"Checking up to {pair.limit} threads at a time, posting {pair.cap} at a time, at {time_utc} UTC.."
+                )
+            elif schedule_type == ScheduleType.every_x_seconds:
+                # schedule to mirror every {mirror_s} seconds
+                mirror_s = config.MIRROR_THREADS_EVERY_SECOND
+                schedule.every(mirror_s).seconds.do(
+                    run_threaded,
+                    thread_func=mirror,
+                    name=f"mirror_every_x_seconds{job_suffix}",
+                    pool=pool,
+                    op_kwargs=mirror_kwargs,
+                )
+
+                # the scheduler will run the first job after {mirror_delay_s} seconds
+                # but for the bot to activate immediately, the first run is submitted to the pool
+                # under the same name right away, so that the two never overlap
+                schedule.every().seconds.do(
+                    run_threaded_once,
+                    thread_func=mirror,
+                    name=f"mirror_every_x_seconds{job_suffix}",
+                    pool=pool,
+                    op_kwargs=mirror_kwargs,
+                )
+                logging.info(
+                    f"TASK: Mirroring threads from {pair.label} every {mirror_s} seconds with a delay of {mirror_delay_s} seconds between threads"
+                )
+
+                logging.info(
+                    f"Checking up to {pair.limit} threads at a time, posting {pair.cap} at a time, starting now..."
+                )
 
         # refresh the database file in filestack
         schedule.every(refresh_m).minutes.do(
-            filestack.refresh_backup,
+            sync_backup,
+            database=database,
+            filestack=filestack,
+            restore=restore,
             app_secret=config.FILESTACK_APP_SECRET,
             apikey=config.FILESTACK_API_KEY,
             handle=config.FILESTACK_HANDLE_REFRESH,
+            delta_handle=config.FILESTACK_HANDLE_DELTA,
         )
 
         # refresh the database backup in filestack
         schedule.every(backup_h).hours.do(
-            filestack.refresh_backup,
+            sync_backup,
+            database=database,
+            filestack=filestack,
+            restore=restore,
             app_secret=config.FILESTACK_APP_SECRET,
             apikey=config.FILESTACK_API_KEY,
             handle=config.FILESTACK_HANDLE_BACKUP,
@@ -214,15 +403,14 @@ if __name__ == "__main__":
             f"Refreshing the database file every {refresh_m} minutes; creating a backup copy every {backup_h} hours"
         )
 
+    # sleep until the next job is due instead of spinning on run_pending
+    scheduler = SchedulerLoop()
+
     if any([x in needs_database for x in config.TASKS]):
         # start scheduler with database
-        logging.info(f"Scheduler started")
         with database:
-            while True:
-                schedule.run_pending()
+            run_until_stopped(scheduler, pool)
 
     else:
         # otherwise, run without database
-        logging.info(f"Scheduler started")
-        while True:
-            schedule.run_pending()
+        run_until_stopped(scheduler, pool)
@@ -1,9 +1,19 @@
+import itertools
+import json
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List
+from typing import Callable, Dict, List, Tuple, Union
 
 from pythorhead.types import LanguageType, SortType
 
+from src import metrics, ratelimit
+from src.community import community_cache
+from src.ratelimit import TokenBucket
+
 logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s",
     level=logging.INFO,
@@ -22,40 +32,277 @@ class LemmyThread:
     by_automod: bool
 
 
+@dataclass
+class StepStats:
+    calls: int = 0
+    failures: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+    def record(self, seconds: float, failed: bool = False) -> None:
+        self.calls += 1
+        self.failures += failed
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    @property
+    def mean_seconds(self) -> float:
+        return self.total_seconds / self.calls if self.calls else 0.0
+
+
+class AutoModState:
+    # per community, kept in a local json file:
+    #   mark   the highest post id AutoMod has processed
+    #   retry  post id -> failed attempts, for posts whose comment failed; they are tried again next run
+    #   resume_page  while a backlog deeper than one run's pages is drained, the page the next run starts at
+
+    def __init__(self, path: Union[str, None] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._communities: Dict[str, dict] = {}
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    for community, value in json.load(f).items():
+                        if isinstance(value, dict):
+                            mark = value.get("mark")
+                            retry = {int(k): int(v) for k, v in value.get("retry", {}).items()}
+                            resume_page = value.get("resume_page")
+                        else:
+                            # written before failed posts were kept for retry: only the mark
+                            mark, retry, resume_page = value, {}, None
+                        self._communities[community] = {
+                            "mark": int(mark) if mark is not None else None,
+                            "retry": retry,
+                            "resume_page": int(resume_page) if resume_page else None,
+                        }
+            except (OSError, ValueError, TypeError, AttributeError) as e:
+                logging.warning(f"Could not load the AutoMod state from {path}. Exception {e}")
+
+    def _entry(self, community: str) -> dict:
+        return self._communities.setdefault(community, {"mark": None, "retry": {}, "resume_page": None})
+
+    def get(self, community: str) -> Union[int, None]:
+        with self._lock:
+            return self._communities.get(community, {}).get("mark")
+
+    def set(self, community: str, post_id: int) -> None:
+        with self._lock:
+            entry = self._entry(community)
+            if entry["mark"] is not None and post_id <= entry["mark"]:
+                return
+            entry["mark"] = post_id
+        self._save()
+
+    def retries(self, community: str) -> Dict[int, int]:
+        with self._lock:
+            return dict(self._communities.get(community, {}).get("retry", {}))
+
+    def set_retries(self, community: str, retries: Dict[int, int]) -> None:
+        with self._lock:
+            entry = self._entry(community)
+            if entry["retry"] == retries:
+                return
+            entry["retry"] = dict(retries)
+        self._save()
+
+    def resume_page(self, community: str) -> int:
+        with self._lock:
+            return self._communities.get(community, {}).get("resume_page") or 1
+
+    def set_resume_page(self, community: str, page: Union[int, None]) -> None:
+        page = page if page and page > 1 else None
+        with self._lock:
+            entry = self._entry(community)
+            if entry["resume_page"] == page:
+                return
+            entry["resume_page"] = page
+        self._save()
+
+    def _save(self) -> None:
+        if self.path is None:
+            return
+        with self._lock:
+            data = {
+                community: {
+                    "mark": entry["mark"],
+                    "retry": {str(k): v for k, v in entry["retry"].items()},
+                    "resume_page": entry["resume_page"],
+                }
+                for community, entry in self._communities.items()
+            }
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+
+
 class AutoMod:
-    def __init__(self, lemmy, community, lemmy_username):
+    def __init__(
+        self,
+        lemmy,
+        community,
+        lemmy_username,
+        limiter: TokenBucket = None,
+        state: AutoModState = None,
+        use_saved_flag: bool = True,
+        page_size: int = 20,
+        max_pages: int = 10,
+        time_budget: float = 120,
+        max_in_flight: int = 4,
+        max_retries: int = 3,
+    ):
         self.auto_mod = lemmy
-        self.community_id = lemmy.discover_community(community)
+        self.community = community
+        self.community_id = community_cache.resolve(lemmy, community)
         self.auto_mod_name = lemmy_username
+        # comments share the process-wide Lemmy write limit by default
+        self.limiter = limiter
+        # posts at or below the high-water mark have already been processed
+        self.state = state if state is not None else AutoModState()
+        # the saved flag is the fallback when there is no high-water mark yet
+        self.use_saved_flag = use_saved_flag
+        # after downtime or a burst, new posts are paged through up to `max_pages` pages,
+        # and commented on from the oldest for at most `time_budget` seconds per run
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.time_budget = time_budget
+        self.max_in_flight = max_in_flight
+        # a post whose comment failed is tried again on the next runs, at most `max_retries` times
+        self.max_retries = max_retries
+        self.stats: Dict[str, StepStats] = {step: StepStats() for step in ("create", "distinguish", "save")}
+        self._stats_lock = threading.Lock()
+
+    def _timed(self, step: str, func: Callable, **kwargs):
+        start = time.monotonic()
+        failed = False
+        try:
+            return func(**kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            seconds = time.monotonic() - start
+            metrics.LEMMY_SECONDS.labels(f"automod_{step}").observe(seconds)
+            with self._stats_lock:
+                self.stats[step].record(seconds, failed)
 
     def _comment_as_mod(
         self,
         post_id: int,
         content: str,
-    ) -> int:
+    ) -> Union[int, None]:
         try:
-            comment = self.auto_mod.comment.create(post_id=post_id, content=content, language_id=LanguageType.EN)
+            comment = self._timed(
+                "create", self.auto_mod.comment.create, post_id=post_id, content=content, language_id=LanguageType.EN
+            )
+            comment_id = comment["comment_view"]["comment"]["id"]
         except Exception as e:
-            logging.error(f"Could not comment! {e}")
-
-        comment_id = comment["comment_view"]["comment"]["id"]
+            logging.error(f"Could not comment on thread {post_id}! {e}")
+            return None
 
         try:
-            distinguish = self.auto_mod.comment.distinguish(comment_id=comment_id, distinguished=True)
+            self._timed("distinguish", self.auto_mod.comment.distinguish, comment_id=comment_id, distinguished=True)
 
         except Exception as e:
             logging.error(f"Could not distinguish comment {comment_id} as a Mod! {e}")
 
         return comment_id
 
+    def _comment_chain(self, thread: LemmyThread, mod_message: str, deadline: float) -> str:
+        # create -> distinguish -> save for one thread, in that order
+        if time.monotonic() > deadline:
+            return "skipped"
+        if thread.deleted or thread.removed:
+            return "ignored"
+
+        # waiting for the rate limit counts against the time budget too
+        limiter = self.limiter or ratelimit.lemmy_write_limiter
+        if limiter.acquire(timeout=deadline - time.monotonic()) is None:
+            return "skipped"
+
+        logging.info(f"Commenting on thread with ID: {thread.post_id}")
+        if self._comment_as_mod(post_id=thread.post_id, content=mod_message) is None:
+            return "failed"
+
+        # save thread
+        if self.use_saved_flag:
+            try:
+                self._timed("save", self.auto_mod.post.save, post_id=thread.post_id, saved=True)
+            except Exception as e:
+                logging.error(f"Could not save thread {thread.post_id}! {e}")
+        return "commented"
+
+    def _is_processed(self, post: dict, mark: Union[int, None]) -> bool:
+        if mark is not None:
+            return post["post"]["id"] <= mark
+        return self.use_saved_flag and post["saved"] is True
+
+    def _list_new_posts(self, mark: Union[int, None], start: int = 1) -> Tuple[List[dict], bool]:
+        # the posts of `max_pages` pages from page `start`, and whether paging got down to processed posts
+        # (or to the end of the listing)
+        posts: Dict[int, dict] = {}
+        for page in range(start, start + self.max_pages):
+            with metrics.LEMMY_SECONDS.labels("post_list").time():
+                batch = self.auto_mod.post.list(
+                    community_id=self.community_id, sort=SortType.New, limit=self.page_size, page=page
+                )
+            # posts shift to the next page when new ones arrive in between
+            for i in batch:
+                posts.setdefault(i["post"]["id"], i)
+
+            if len(batch) < self.page_size:
+                return list(posts.values()), True
+            # stop paging once a page reaches posts processed before; featured posts are listed first regardless
+            if any(self._is_processed(i, mark) for i in batch if not i["post"].get("featured_community")):
+                return list(posts.values()), True
+        return list(posts.values()), False
+
     def _find_new_threads(self) -> List[LemmyThread]:
-        new_threads = self.auto_mod.post.list(community_id=self.community_id, sort=SortType.New, limit=20)
+        mark = self.state.get(self.community)
+        # without a mark there is no backlog to drain, the newest pages are all there is to read
+        start = self.state.resume_page(self.community) if mark is not None else 1
+        try:
+            new_threads, reached = self._list_new_posts(mark, start)
+        except Exception as e:
+            logging.error(f"Could not list new threads! {e}")
+            community_cache.invalidate_on_not_found(self.auto_mod, self.community, e)
+            return []
 
         output = []
 
+        if mark is not None:
+            if not reached:
+                # more new posts than `max_pages` pages: the mark may only move over posts that were read,
+                # so the backlog is drained from its oldest end, reading on from the next page next run.
+                # new posts only push older ones to later pages, so none are skipped
+                logging.warning(
+                    f"No processed threads within {self.max_pages} pages from page {start}, "
+                    f"continuing from page {start + self.max_pages} next run"
+                )
+                self.state.set_resume_page(self.community, start + self.max_pages)
+                return output
+            # the posts on earlier pages are newer than the ones read now, they are read on the next runs.
+            # the next window overlaps this one by a page, so that it reaches the new mark
+            self.state.set_resume_page(self.community, start - self.max_pages + 1)
+        elif not reached:
+            logging.warning(f"Stopped after {self.max_pages} pages of new threads, older ones are skipped")
+
+        if mark is None and not self.use_saved_flag:
+            # nothing tells processed posts apart yet, so start after the newest post
+            if new_threads:
+                self.state.set(self.community, max(i["post"]["id"] for i in new_threads))
+            return output
+
         for i in new_threads:
-            # automod saves posts it already commented on
-            if i["saved"] is False and i["post"]["deleted"] is False:
+            # posts at or below the high-water mark have already been processed,
+            # without a mark automod relies on the posts it saved after commenting
+            if self._is_processed(i, mark):
+                continue
+            if self.use_saved_flag and i["saved"] is True:
+                continue
+            if i["post"]["deleted"] is False:
                 output.append(
                     LemmyThread(
                         i["post"]["deleted"],
@@ -71,15 +318,54 @@ class AutoMod:
         return output
 
     def comment_on_new_threads(self, mod_message: str = "Be nice!"):
-        new_threads: dict = self._find_new_threads()
-        num = 0
-        for thread in new_threads:
-            if not thread.deleted and not thread.removed:
-                # add mod comment
-                num += 1
-                logging.info(f"Commenting on thread with ID: {thread.post_id}")
-                comment = self._comment_as_mod(post_id=thread.post_id, content=mod_message)
-                # save thread
-                self.auto_mod.post.save(post_id=thread.post_id, saved=True)
-
-        logging.info(f"Added mod comment to {num} threads")
+        # oldest first, so the high-water mark can advance even when the time budget runs out
+        new_threads: List[LemmyThread] = self._find_new_threads()
+        retries = self.state.retries(self.community)
+        listed = {t.post_id for t in new_threads}
+        # posts whose comment failed before are below the mark, and no longer listed as new
+        new_threads += [
+            LemmyThread(False, False, False, post_id, False, False, False)
+            for post_id in retries
+            if post_id not in listed
+        ]
+        new_threads.sort(key=lambda t: t.post_id)
+        if not new_threads:
+            logging.info("Added mod comment to 0 threads")
+            return
+
+        # up to `max_in_flight` threads are commented on at the same time,
+        # a failing thread does not stop the others
+        deadline = time.monotonic() + self.time_budget
+        with ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="automod") as executor:
+            results = list(executor.map(lambda t: self._comment_chain(t, mod_message, deadline), new_threads))
+        for result in results:
+            metrics.AUTOMOD_COMMENTS.labels(result).inc()
+
+        # the mark only moves past threads that have been attempted, skipped threads are left for the next run.
+        # threads whose comment failed are kept for retry instead of holding the mark back,
+        # so that the threads after them are not commented on twice
+        attempted = list(itertools.takewhile(lambda r: r[1] != "skipped", zip(new_threads, results)))
+        for thread, result in attempted:
+            if result != "failed":
+                retries.pop(thread.post_id, None)
+                continue
+            retries[thread.post_id] = retries.get(thread.post_id, 0) + 1
+            if retries[thread.post_id] >= self.max_retries:
+                logging.warning(f"Giving up on thread {thread.post_id} after {self.max_retries} failed comments")
+                del retries[thread.post_id]
+        self.state.set_retries(self.community, retries)
+        if attempted:
+            self.state.set(self.community, max(thread.post_id for thread, _ in attempted))
+        if len(attempted) < len(new_threads):
+            logging.info(
+                f"Time budget of {self.time_budget} seconds used up, "
+                f"{len(new_threads) - len(attempted)} threads are left for the next run"
+            )
+
+        for step, stats in self.stats.items():
+            if stats.calls:
+                logging.info(
+                    f"AutoMod {step}: {stats.calls} calls, {stats.failures} failed, "
+                    f"{stats.mean_seconds:.2f}s mean, {stats.max_seconds:.2f}s max"
+                )
+        logging.info(f"Added mod comment to {results.count('commented')} threads")
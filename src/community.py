@@ -0,0 +1,63 @@
+import logging
+import threading
+import time
+import weakref
+from typing import Dict, Tuple, Union
+
+from pythorhead import Lemmy
+
+from src import metrics
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+class CommunityCache:
+    # community name -> community id, per Lemmy session.
+    # ids practically never change, so they are kept for `ttl` seconds
+    # or until a call fails with a 404 and the entry is invalidated
+
+    def __init__(self, ttl: float = 24 * 60 * 60):
+        self.ttl = ttl
+        self.discoveries = 0
+        self._lock = threading.Lock()
+        self._ids: "weakref.WeakKeyDictionary[Lemmy, Dict[str, Tuple[int, float]]]" = weakref.WeakKeyDictionary()
+
+    def resolve(self, lemmy: Lemmy, community: str) -> Union[int, None]:
+        with self._lock:
+            community_id, expires = self._ids.get(lemmy, {}).get(community, (None, 0))
+        if community_id is not None and expires > time.monotonic():
+            return community_id
+
+        with metrics.LEMMY_SECONDS.labels("discover_community").time():
+            community_id = lemmy.discover_community(community)
+        self.discoveries += 1
+        if community_id is not None:
+            with self._lock:
+                self._ids.setdefault(lemmy, {})[community] = (community_id, time.monotonic() + self.ttl)
+            logging.info(f"Resolved community {community} to id {community_id}")
+        return community_id
+
+    def invalidate(self, lemmy: Lemmy, community: str) -> None:
+        with self._lock:
+            self._ids.get(lemmy, {}).pop(community, None)
+        # newer pythorhead versions keep their own copy
+        known = getattr(lemmy, "_known_communities", None)
+        if isinstance(known, dict):
+            known.pop(community, None)
+        logging.info(f"Invalidated the cached id of community {community}")
+
+    def invalidate_on_not_found(self, lemmy: Lemmy, community: str, error: Exception) -> bool:
+        # Lemmy answers 404 or couldnt_find_community when the community id is stale
+        message = str(error).lower()
+        if "404" in message or "couldnt_find_community" in message or "not found" in message:
+            self.invalidate(lemmy, community)
+            return True
+        return False
+
+
+# shared by the mirror and AutoMod tasks
+community_cache = CommunityCache()
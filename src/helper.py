@@ -1,13 +1,33 @@
+import contextlib
 import datetime
+import gzip
+import hashlib
+import json
 import logging
+import os
+import threading
+import time
+import types
+import uuid
 from dataclasses import dataclass, field
 from enum import Enum, unique
-from typing import Dict, Union
+from typing import Dict, List, Tuple, Union
 
+import filestack.utils
 import requests
 from filestack import Client, Filelink, Security
+from requests.adapters import HTTPAdapter
 from tinydb import Query, TinyDB
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from src import metrics
+from src.media import default_classifier
+from src.store import ThreadStore
+
 logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s",
     level=logging.INFO,
@@ -43,6 +63,51 @@ class ScheduleType(Enum):
     every_x_seconds: str = "every_x_seconds"
 
 
+@unique
+class OverlapPolicy(Enum):
+    skip: str = "skip"
+    coalesce: str = "coalesce"
+
+
+@unique
+class Compression(Enum):
+    none: str = "none"
+    gzip: str = "gzip"
+    zstd: str = "zstd"
+
+
+@unique
+class ThreadSelection(Enum):
+    random: str = "random"
+    first: str = "first"
+
+
+@unique
+class StorageType(Enum):
+    json: str = "json"
+    journal: str = "journal"
+
+
+@dataclass
+class MirrorPair:
+    # a subreddit mirrored to a Lemmy community.
+    # threads of a named pair are stored under the pair's name, so the same thread
+    # can be mirrored to several communities. the single pair from REDDIT_SUBREDDIT has no name.
+    # the threads stored without a pair, before MIRROR_PAIRS was set, belong to the `unpaired` pair
+    subreddit: str
+    community: str
+    filter: str = "new"
+    ignore_thread_types: List["RedditThread"] = field(default_factory=list)
+    cap: int = 10
+    limit: int = 30
+    name: Union[str, None] = None
+    unpaired: bool = False
+
+    @property
+    def label(self) -> str:
+        return f"r/{self.subreddit} -> c/{self.community}"
+
+
 @dataclass
 class Config:
     config: dict
@@ -79,7 +144,47 @@ class Config:
         "REDDIT_FILTER_THREAD_LIMIT",
         "FILTER_BY",
         "REDDIT_CAP_NUMBER_OF_MIRRORED_THREADS",
+        "MIRROR_SELECTION",
+        "MIRROR_EXTRACT_BATCH_SIZE",
+        "MIRROR_PAIRS",
+        "REDDIT_LISTING_CHECKPOINT",
+        "REDDIT_LISTING_CHECKPOINT_PATH",
+        "REDDIT_CATCH_UP_MAX_THREADS",
         "MIRROR_EVERY_DAY_AT",
+        "HEAD_REQUEST_TIMEOUT_SECOND",
+        "HEAD_REQUESTS_DEADLINE_SECOND",
+        "HEAD_REQUESTS_MAX_WORKERS",
+        "MEDIA_RULES_FILE",
+        "MEDIA_IMAGE_DOMAINS",
+        "MEDIA_NON_IMAGE_DOMAINS",
+        "MEDIA_IMAGE_EXTENSIONS",
+        "CONTENT_TYPE_CACHE_PATH",
+        "CONTENT_TYPE_CACHE_MAX_ENTRIES",
+        "CONTENT_TYPE_CACHE_TTL_HOUR",
+        "CONTENT_TYPE_CACHE_NEGATIVE_TTL_MINUTE",
+        "WORKER_POOL_SIZE",
+        "JOB_OVERLAP_POLICY",
+        "AUTOMOD_STATE_PATH",
+        "AUTOMOD_USE_SAVED_FLAG",
+        "AUTOMOD_PAGE_SIZE",
+        "AUTOMOD_MAX_PAGES_PER_TICK",
+        "AUTOMOD_TIME_BUDGET_SECOND",
+        "AUTOMOD_MAX_IN_FLIGHT",
+        "LEMMY_WRITES_PER_MINUTE",
+        "LEMMY_WRITE_BURST",
+        "DATABASE_STORAGE",
+        "DATABASE_COMPACT_EVERY",
+        "FILESTACK_HANDLE_DELTA",
+        "BACKUP_COMPRESSION",
+        "BACKUP_FULL_SNAPSHOT_EVERY",
+        "FILESTACK_RESTORE_IN_BACKGROUND",
+        "FILESTACK_RESTORE_RETRY_SECOND",
+        "MIRROR_PIPELINE",
+        "PIPELINE_QUEUE_SIZE",
+        "BLOOM_FILTER_FALSE_POSITIVE_RATE",
+        "BLOOM_FILTER_MAX_BYTES",
+        "BLOOM_FILTER_TRUST_POSITIVES",
+        "METRICS_PORT",
     )
     keys_missing: bool = False
 
@@ -108,17 +213,58 @@ class Config:
         self.LEMMY_COMMUNITY: str = self.config["LEMMY_COMMUNITY"]
         self.LEMMY_MOD_MESSAGE_NEW_THREADS: str = self.config["LEMMY_MOD_MESSAGE_NEW_THREADS"]
 
+        self.WORKER_POOL_SIZE: int = int(self.config.get("WORKER_POOL_SIZE", 2))
+        self.JOB_OVERLAP_POLICY: OverlapPolicy = Util._getattr_mod(
+            OverlapPolicy, self.config.get("JOB_OVERLAP_POLICY", "skip")
+        )
+
+        self.AUTOMOD_STATE_PATH: str = self.config.get("AUTOMOD_STATE_PATH", "data/automod_state.json")
+        self.AUTOMOD_USE_SAVED_FLAG: bool = Util._get_bool(self.config.get("AUTOMOD_USE_SAVED_FLAG", "true"))
+        self.AUTOMOD_PAGE_SIZE: int = int(self.config.get("AUTOMOD_PAGE_SIZE", 20))
+        self.AUTOMOD_MAX_PAGES_PER_TICK: int = int(self.config.get("AUTOMOD_MAX_PAGES_PER_TICK", 10))
+        self.AUTOMOD_TIME_BUDGET_SECOND: float = float(self.config.get("AUTOMOD_TIME_BUDGET_SECOND", 120))
+        self.AUTOMOD_MAX_IN_FLIGHT: int = int(self.config.get("AUTOMOD_MAX_IN_FLIGHT", 4))
+
+        # when unset, mirrored posts are paced by DELAY_BETWEEN_MIRRORED_THREADS_SECOND instead
+        writes = self.config.get("LEMMY_WRITES_PER_MINUTE")
+        self.LEMMY_WRITES_PER_MINUTE: Union[float, None] = float(writes) if writes else None
+        self.LEMMY_WRITE_BURST: int = int(self.config.get("LEMMY_WRITE_BURST", 1))
+
+        # the metrics server is off unless a port is set
+        port = self.config.get("METRICS_PORT")
+        self.METRICS_PORT: Union[int, None] = int(port) if port else None
+
         if Task.mirror_threads in self.TASKS:
             self.REDDIT_CLIENT_ID: str = self.config["REDDIT_CLIENT_ID"]
             self.REDDIT_CLIENT_SECRET: str = self.config["REDDIT_CLIENT_SECRET"]
             self.REDDIT_PASSWORD: str = self.config["REDDIT_PASSWORD"]
             self.REDDIT_USER_AGENT: str = self.config["REDDIT_USER_AGENT"]
             self.REDDIT_USERNAME: str = self.config["REDDIT_USERNAME"]
-            self.REDDIT_SUBREDDIT: str = self.config["REDDIT_SUBREDDIT"]
+            # not needed when the pairs to mirror are listed in MIRROR_PAIRS
+            self.REDDIT_SUBREDDIT: str = (
+                self.config.get("REDDIT_SUBREDDIT")
+                if "MIRROR_PAIRS" in self.config
+                else self.config["REDDIT_SUBREDDIT"]
+            )
             self.FILESTACK_API_KEY: str = self.config["FILESTACK_API_KEY"]
             self.FILESTACK_APP_SECRET: str = self.config["FILESTACK_APP_SECRET"]
             self.FILESTACK_HANDLE_REFRESH: str = self.config["FILESTACK_HANDLE_REFRESH"]
             self.FILESTACK_HANDLE_BACKUP: str = self.config["FILESTACK_HANDLE_BACKUP"]
+            # backups of the refresh handle are split into snapshots and deltas when a delta handle is set
+            self.FILESTACK_HANDLE_DELTA: Union[str, None] = self.config.get("FILESTACK_HANDLE_DELTA") or None
+            self.BACKUP_COMPRESSION: Compression = Util._getattr_mod(
+                Compression, self.config.get("BACKUP_COMPRESSION", "none")
+            )
+            self.BACKUP_FULL_SNAPSHOT_EVERY: int = int(self.config.get("BACKUP_FULL_SNAPSHOT_EVERY", 12))
+            # start from the local database file and restore the backup in the background
+            self.FILESTACK_RESTORE_IN_BACKGROUND: bool = Util._get_bool(
+                self.config.get("FILESTACK_RESTORE_IN_BACKGROUND", "false")
+            )
+            self.FILESTACK_RESTORE_RETRY_SECOND: float = float(self.config.get("FILESTACK_RESTORE_RETRY_SECOND", 60))
+
+            # mirror with the asyncio pipeline instead of the step by step task
+            self.MIRROR_PIPELINE: bool = Util._get_bool(self.config.get("MIRROR_PIPELINE", "false"))
+            self.PIPELINE_QUEUE_SIZE: int = int(self.config.get("PIPELINE_QUEUE_SIZE", 10))
 
             self.REDDIT_THREADS_TO_IGNORE: list = [
                 Util._getattr_mod(RedditThread, x)
@@ -137,9 +283,62 @@ class Config:
             self.REDDIT_CAP_NUMBER_OF_MIRRORED_THREADS: int = int(
                 self.config.get("REDDIT_CAP_NUMBER_OF_MIRRORED_THREADS", 10)
             )
+            # how the capped threads are picked: a uniform random sample, or the first ones in the listing
+            self.MIRROR_SELECTION: ThreadSelection = Util._getattr_mod(
+                ThreadSelection, self.config.get("MIRROR_SELECTION", "random")
+            )
+            # submissions read from the listing at a time, their urls are checked for images together
+            self.MIRROR_EXTRACT_BATCH_SIZE: int = int(self.config.get("MIRROR_EXTRACT_BATCH_SIZE", 10))
+            # remember the newest thread read from the new listing and only read newer ones
+            self.REDDIT_LISTING_CHECKPOINT: bool = Util._get_bool(self.config.get("REDDIT_LISTING_CHECKPOINT", "false"))
+            self.REDDIT_LISTING_CHECKPOINT_PATH: str = self.config.get(
+                "REDDIT_LISTING_CHECKPOINT_PATH", "data/listing_checkpoint.json"
+            )
+            self.REDDIT_CATCH_UP_MAX_THREADS: int = int(self.config.get("REDDIT_CATCH_UP_MAX_THREADS", 1000))
 
             self.FILTER_BY: str = self.config.get("FILTER_BY", "new")
 
+            # [{"subreddit": "...", "community": "...", "filter": "new", "ignore": "nsfw,pinned", "cap": 5, "limit": 30}]
+            # filter, ignore, cap and limit default to the variables above
+            self.MIRROR_PAIRS: List[MirrorPair] = self._get_mirror_pairs(self.config.get("MIRROR_PAIRS"))
+
+            self.HEAD_REQUEST_TIMEOUT_SECOND: float = float(self.config.get("HEAD_REQUEST_TIMEOUT_SECOND", 5))
+            self.HEAD_REQUESTS_DEADLINE_SECOND: float = float(self.config.get("HEAD_REQUESTS_DEADLINE_SECOND", 20))
+            self.HEAD_REQUESTS_MAX_WORKERS: int = int(self.config.get("HEAD_REQUESTS_MAX_WORKERS", 16))
+
+            # rules to tell images apart by domain and extension, without a request
+            # a rules file takes precedence over the separate lists
+            self.MEDIA_RULES_FILE: Union[str, None] = self.config.get("MEDIA_RULES_FILE")
+            self.MEDIA_IMAGE_DOMAINS: Union[list, None] = Util._get_optional_list(
+                self.config.get("MEDIA_IMAGE_DOMAINS")
+            )
+            self.MEDIA_NON_IMAGE_DOMAINS: Union[list, None] = Util._get_optional_list(
+                self.config.get("MEDIA_NON_IMAGE_DOMAINS")
+            )
+            self.MEDIA_IMAGE_EXTENSIONS: Union[list, None] = Util._get_optional_list(
+                self.config.get("MEDIA_IMAGE_EXTENSIONS")
+            )
+
+            self.CONTENT_TYPE_CACHE_PATH: str = self.config.get("CONTENT_TYPE_CACHE_PATH", "data/content_types.json")
+            self.CONTENT_TYPE_CACHE_MAX_ENTRIES: int = int(self.config.get("CONTENT_TYPE_CACHE_MAX_ENTRIES", 10000))
+            self.CONTENT_TYPE_CACHE_TTL_HOUR: float = float(self.config.get("CONTENT_TYPE_CACHE_TTL_HOUR", 24 * 7))
+            self.CONTENT_TYPE_CACHE_NEGATIVE_TTL_MINUTE: float = float(
+                self.config.get("CONTENT_TYPE_CACHE_NEGATIVE_TTL_MINUTE", 30)
+            )
+
+            self.DATABASE_STORAGE: StorageType = Util._getattr_mod(
+                StorageType, self.config.get("DATABASE_STORAGE", "json")
+            )
+            self.DATABASE_COMPACT_EVERY: int = int(self.config.get("DATABASE_COMPACT_EVERY", 100))
+
+            # the bloom filter is only built when a false positive rate is set
+            fpr = self.config.get("BLOOM_FILTER_FALSE_POSITIVE_RATE")
+            self.BLOOM_FILTER_FALSE_POSITIVE_RATE: Union[float, None] = float(fpr) if fpr else None
+            self.BLOOM_FILTER_MAX_BYTES: int = int(self.config.get("BLOOM_FILTER_MAX_BYTES", 1024 * 1024))
+            self.BLOOM_FILTER_TRUST_POSITIVES: bool = Util._get_bool(
+                self.config.get("BLOOM_FILTER_TRUST_POSITIVES", "false")
+            )
+
             self.REDDIT_MIRROR_SCHEDULE_TYPE: str = Util._getattr_mod(
                 ScheduleType, self.config["REDDIT_MIRROR_SCHEDULE_TYPE"]
             )
@@ -152,15 +351,181 @@ class Config:
                 self.MIRROR_THREADS_EVERY_SECOND: int = int(self.config.get("MIRROR_THREADS_EVERY_SECOND", 60 * 5))
                 self.MIRROR_EVERY_DAY_AT = None
 
+    def _get_mirror_pairs(self, text: Union[str, None]) -> List[MirrorPair]:
+        defaults = {
+            "filter": self.FILTER_BY,
+            "ignore_thread_types": self.REDDIT_THREADS_TO_IGNORE,
+            "cap": self.REDDIT_CAP_NUMBER_OF_MIRRORED_THREADS,
+            "limit": self.REDDIT_FILTER_THREAD_LIMIT,
+        }
+        if not text:
+            return [MirrorPair(self.REDDIT_SUBREDDIT, self.LEMMY_COMMUNITY, **defaults)]
+
+        pairs = []
+        for p in json.loads(text):
+            ignore = p.get("ignore")
+            if isinstance(ignore, str):
+                ignore = Util._get_clean_list(ignore)
+            pair = MirrorPair(
+                subreddit=p["subreddit"],
+                community=p["community"],
+                filter=p.get("filter", defaults["filter"]),
+                ignore_thread_types=(
+                    defaults["ignore_thread_types"]
+                    if ignore is None
+                    else [Util._getattr_mod(RedditThread, x) for x in ignore if x]
+                ),
+                cap=int(p.get("cap", defaults["cap"])),
+                limit=int(p.get("limit", defaults["limit"])),
+                name=p.get("name") or f"{p['subreddit'].lower()}:{p['community'].lower()}",
+            )
+            pairs.append(pair)
+
+        # the threads mirrored by the single pair setup are remembered for the same subreddit and community,
+        # or they would all be mirrored again
+        if self.REDDIT_SUBREDDIT:
+            legacy = (self.REDDIT_SUBREDDIT.lower(), self.LEMMY_COMMUNITY.lower())
+            for pair in pairs:
+                if (pair.subreddit.lower(), pair.community.lower()) == legacy:
+                    pair.unpaired = True
+                    break
+
+        names = [p.name for p in pairs]
+        if len(set(names)) != len(names):
+            raise AssertionError("MIRROR_PAIRS has pairs with the same name")
+        return pairs
+
 
 class FileUploadError(Exception):
     pass
 
 
+class BackupFormatError(Exception):
+    pass
+
+
+@dataclass
+class SnapshotState:
+    # the last full snapshot uploaded to (or restored from) a handle
+    snapshot_id: str
+    last_doc_id: int
+    deltas_since: int = 0
+
+
+@dataclass
+class BackupCodec:
+    # encodes the TinyDB database file for Filestack as either
+    #   a snapshot: {"format": "snapshot", "snapshot_id": ..., "last_doc_id": ..., "db": <TinyDB json>}
+    #   or a delta: {"format": "delta", "snapshot_id": ..., "records": {doc_id: record}} with the records
+    #   inserted after the snapshot
+    # compressed with gzip or zstd. plain TinyDB json from older backups still decodes.
+    compression: Compression = Compression.none
+    table: str = "_default"
+
+    gzip_magic: bytes = b"\x1f\x8b"
+    zstd_magic: bytes = b"\x28\xb5\x2f\xfd"
+
+    def __post_init__(self):
+        if self.compression == Compression.zstd and zstandard is None:
+            logging.warning("zstandard is not installed, compressing backups with gzip instead")
+            self.compression = Compression.gzip
+
+    def encode(self, payload: dict) -> bytes:
+        data = json.dumps(payload, separators=(",", ":")).encode()
+        if self.compression == Compression.gzip:
+            return gzip.compress(data)
+        if self.compression == Compression.zstd:
+            return zstandard.ZstdCompressor().compress(data)
+        return data
+
+    def decode(self, data: bytes) -> dict:
+        # the compression is detected from the data, not from the configured codec
+        if data.startswith(self.gzip_magic):
+            data = gzip.decompress(data)
+        elif data.startswith(self.zstd_magic):
+            if zstandard is None:
+                raise BackupFormatError("The backup is compressed with zstd, but zstandard is not installed")
+            data = zstandard.ZstdDecompressor().decompress(data)
+        try:
+            return json.loads(data) if data.strip() else {}
+        except ValueError as e:
+            raise BackupFormatError(f"Could not decode backup. {e}")
+
+    def snapshot(self, db: dict) -> Tuple[dict, SnapshotState]:
+        table = db.get(self.table, {})
+        state = SnapshotState(uuid.uuid4().hex, max((int(k) for k in table), default=0))
+        payload = {"format": "snapshot", "snapshot_id": state.snapshot_id, "last_doc_id": state.last_doc_id, "db": db}
+        return payload, state
+
+    def delta(self, db: dict, state: SnapshotState) -> dict:
+        table = db.get(self.table, {})
+        records = {k: v for k, v in table.items() if int(k) > state.last_doc_id}
+        return {"format": "delta", "snapshot_id": state.snapshot_id, "records": records}
+
+    def restore(self, payload: dict, delta: Union[dict, None] = None) -> Tuple[dict, Union[SnapshotState, None]]:
+        if payload.get("format") == "snapshot":
+            db = payload["db"]
+            state = SnapshotState(payload["snapshot_id"], payload["last_doc_id"])
+        elif payload.get("format") is None:
+            # a plain TinyDB file from before backups were encoded
+            db, state = payload, None
+        else:
+            raise BackupFormatError(f"Expected a snapshot, got {payload.get('format')}")
+
+        # a delta only applies to the snapshot it was taken against
+        if delta and state and delta.get("format") == "delta" and delta.get("snapshot_id") == state.snapshot_id:
+            db = db | {self.table: db.get(self.table, {}) | delta["records"]}
+            logging.info(f"Applied {len(delta['records'])} records from the delta backup")
+        return db, state
+
+
 class FileDownloadError(Exception):
     pass
 
 
+# filestack sends every request through the functions of the `requests` module,
+# which opens a new connection each time. while a DataBase call runs, its requests go through this keep-alive
+# session instead, by swapping `filestack.utils.original_requests`. filestack (4.0.0) takes no session argument,
+# so this depends on that private module attribute. it is global to the process, so the (reentrant) lock
+# serialises the DataBase calls of all threads for as long as the attribute is swapped
+filestack_session: Union[requests.Session, None] = None
+_filestack_session_lock = threading.RLock()
+_filestack_session_users = 0
+_pooled_requests: Union[types.SimpleNamespace, None] = None
+_unpooled_requests = None
+
+
+@contextlib.contextmanager
+def _pooled_filestack_session():
+    global filestack_session, _filestack_session_users, _pooled_requests, _unpooled_requests
+    with _filestack_session_lock:
+        # filestack versions without the module attribute keep their own connections
+        pooled = hasattr(filestack.utils, "original_requests")
+        if pooled:
+            if filestack_session is None:
+                filestack_session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+                filestack_session.mount("https://", adapter)
+                filestack_session.mount("http://", adapter)
+
+                # stands in for the requests module inside filestack, with the request functions bound to the session
+                _pooled_requests = types.SimpleNamespace(**vars(requests))
+                for method in ("get", "post", "put", "delete"):
+                    setattr(_pooled_requests, method, getattr(filestack_session, method))
+
+            if _filestack_session_users == 0:
+                _unpooled_requests = filestack.utils.original_requests
+                filestack.utils.original_requests = _pooled_requests
+            _filestack_session_users += 1
+        try:
+            yield filestack_session
+        finally:
+            if pooled:
+                _filestack_session_users -= 1
+                if _filestack_session_users == 0:
+                    filestack.utils.original_requests = _unpooled_requests
+
+
 @dataclass
 class DataBase:
     # filestack DataBase
@@ -173,21 +538,74 @@ class DataBase:
         }
     )
 
+    # content hash of the database file last synced with each handle,
+    # so that unchanged files are not uploaded again
+    synced_hashes: Dict[str, str] = field(default_factory=dict, repr=False)
+    bytes_saved: int = 0
+
+    # backups are plain TinyDB files unless a compression or delta handle is used
+    codec: BackupCodec = field(default_factory=BackupCodec)
+    # with a delta handle, a full snapshot is uploaded after this many deltas
+    full_snapshot_every: int = 12
+    snapshots: Dict[str, SnapshotState] = field(default_factory=dict, repr=False)
+
+    # a signed policy is valid for `policy_ttl` seconds and is signed again
+    # `policy_refresh_margin` seconds before it expires
+    policy_ttl: float = 15 * 60
+    policy_refresh_margin: float = 60
+    policies_signed: int = 0
+
+    _security: Union[Security, None] = field(default=None, init=False, repr=False)
+    _clients: Dict[str, Client] = field(default_factory=dict, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False, compare=False)
+
     @staticmethod
-    def refresh_policy():
-        return {"expiry": int((datetime.datetime.now() + datetime.timedelta(minutes=15)).timestamp())}
+    def _file_hash(path: str) -> str:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        return h.hexdigest()
 
+    @staticmethod
+    def refresh_policy(ttl: float = 15 * 60):
+        return {"expiry": int((datetime.datetime.now() + datetime.timedelta(seconds=ttl)).timestamp())}
+
+    def _get_security(self, app_secret: str) -> Security:
+        # reuse the signed policy until it is about to expire
+        with self._lock:
+            security = self._security
+            if (
+                security is None
+                or security.secret != app_secret
+                or security.policy["expiry"] - self.policy_refresh_margin <= time.time()
+            ):
+                security = Security(self.refresh_policy(self.policy_ttl), app_secret)
+                self._security = security
+                self.policies_signed += 1
+            return security
+
+    def _get_client(self, app_secret: str, apikey: str) -> Client:
+        security = self._get_security(app_secret)
+        with self._lock:
+            client = self._clients.get(apikey)
+            if client is None:
+                client = self._clients[apikey] = Client(apikey, security=security)
+            client.security = security
+            return client
+
+    @_pooled_filestack_session()
     def _upload_backup(self, app_secret: str, apikey: str, filename: str, db_path: str = None):
         if db_path is None:
             db_path = self.db_path
 
-        security = Security(self.refresh_policy(), app_secret)
-        client = Client(apikey, security=security)
+        client = self._get_client(app_secret, apikey)
 
-        file = client.upload(
-            filepath=db_path,
-            store_params=self.store_params | {"filename": filename},
-        )
+        with metrics.FILESTACK_SECONDS.labels("upload").time():
+            file = client.upload(
+                filepath=db_path,
+                store_params=self.store_params | {"filename": filename},
+            )
 
         if not (file is None):
             logging.info(f"Uploading file {filename} to {file.url} with handle {file.handle}.")
@@ -195,23 +613,94 @@ class DataBase:
         else:
             raise FileUploadError("Upload to filestack failed.")
 
-    def get_backup(self, app_secret: str, apikey: str, handle: str):
-        security = Security(self.refresh_policy(), app_secret)
-        client = Client(apikey, security=security)
+    @_pooled_filestack_session()
+    def get_backup(self, app_secret: str, apikey: str, handle: str, delta_handle: Union[str, None] = None):
+        security = self._get_security(app_secret)
         filelink = Filelink(handle=handle, security=security)
-        d = filelink.download(self.db_path)
+        with metrics.FILESTACK_SECONDS.labels("download").time():
+            d = filelink.download(self.db_path)
         if not (d is None):
             logging.info(f"Downloading backup file from {filelink.url} to {self.db_path}")
+            self._decode_backup(handle, delta_handle, security)
+            self.synced_hashes[handle] = self._file_hash(self.db_path)
         else:
             raise FileDownloadError("Pulling backup from filestack failed")
 
-    def refresh_backup(self, app_secret: str, apikey: str, handle: str):
-        security = Security(self.refresh_policy(), app_secret)
-        client = Client(apikey, security=security)
-        filelink = Filelink(handle=handle, security=security)
-        o = filelink.overwrite(filepath=self.db_path, security=security)
+    def _decode_backup(self, handle: str, delta_handle: Union[str, None], security: Security) -> None:
+        # turn a downloaded snapshot (+ delta) back into a plain TinyDB file
+        with open(self.db_path, "rb") as f:
+            payload = self.codec.decode(f.read())
+
+        delta = None
+        if delta_handle is not None and payload.get("format") == "snapshot":
+            delta_path = f"{self.db_path}.delta"
+            try:
+                if Filelink(handle=delta_handle, security=security).download(delta_path) is not None:
+                    with open(delta_path, "rb") as f:
+                        delta = self.codec.decode(f.read())
+            except Exception as e:
+                logging.error(f"Could not pull the delta backup, restoring the snapshot only. Exception {e}")
+
+        if payload.get("format") is None:
+            # already a plain TinyDB file, deltas are only taken against snapshots
+            return
+
+        db, state = self.codec.restore(payload, delta)
+        if state is not None:
+            self.snapshots[handle] = state
+
+        tmp_path = f"{self.db_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(db, f)
+        os.replace(tmp_path, self.db_path)
+
+    def _encode_backup(self, handle: str, delta_handle: Union[str, None]) -> Tuple[str, str, SnapshotState]:
+        # returns the file to upload, the handle to overwrite and the snapshot state after the upload
+        with open(self.db_path, encoding="utf-8") as f:
+            db = json.load(f) if os.path.getsize(self.db_path) else {}
+
+        state = self.snapshots.get(handle)
+        if delta_handle is not None and state is not None and state.deltas_since < self.full_snapshot_every:
+            payload = self.codec.delta(db, state)
+            target = delta_handle
+            state = SnapshotState(state.snapshot_id, state.last_doc_id, state.deltas_since + 1)
+            logging.info(f"Backing up {len(payload['records'])} records since the last snapshot as a delta")
+        else:
+            payload, state = self.codec.snapshot(db)
+            target = handle
+
+        upload_path = f"{self.db_path}.upload"
+        with open(upload_path, "wb") as f:
+            f.write(self.codec.encode(payload))
+        logging.info(f"Encoded {os.path.getsize(self.db_path)} bytes as {os.path.getsize(upload_path)} bytes")
+        return upload_path, target, state
+
+    @_pooled_filestack_session()
+    def refresh_backup(self, app_secret: str, apikey: str, handle: str, delta_handle: Union[str, None] = None):
+        content_hash = self._file_hash(self.db_path)
+        if self.synced_hashes.get(handle) == content_hash:
+            size = os.path.getsize(self.db_path)
+            self.bytes_saved += size
+            logging.info(
+                f"Database unchanged since the last sync with {handle}, skipped uploading {size} bytes "
+                f"({self.bytes_saved} bytes saved so far)"
+            )
+            return None
+
+        upload_path, target, state = self.db_path, handle, None
+        if self.codec.compression != Compression.none or delta_handle is not None:
+            upload_path, target, state = self._encode_backup(handle, delta_handle)
+
+        security = self._get_security(app_secret)
+        filelink = Filelink(handle=target, security=security)
+        with metrics.FILESTACK_SECONDS.labels("upload").time():
+            o = filelink.overwrite(filepath=upload_path, security=security)
         if not (o is None):
             logging.info(f"Storing {filelink.metadata()['filename']} backup at {filelink.url}")
+            self.synced_hashes[handle] = content_hash
+            if state is not None:
+                self.snapshots[handle] = state
+            return o
         else:
             raise FileUploadError("Overwriting the database file from filestack failed.")
 
@@ -220,15 +709,7 @@ class DataBase:
 class Util:
     @staticmethod
     def _check_if_image(url: str):
-        try:
-            resp = requests.head(url)
-            if resp.ok:
-                content_type = resp.headers.get("content-type")
-                if "image" in content_type:
-                    return url
-        except Exception as e:
-            logging.error(f"Could not check image. {e}")
-            return None
+        return default_classifier.check_image(url)
 
     @staticmethod
     def _getattr_mod(__o: object, __name: str) -> Union[str, None]:
@@ -238,21 +719,39 @@ class Util:
             return None
 
     @staticmethod
-    def _check_thread_in_db(reddit_id: str, DB: TinyDB) -> bool:
-        q = Query()
-        if DB.search(q.reddit_id == reddit_id):
+    def _check_thread_in_db(reddit_id: str, DB: Union[ThreadStore, TinyDB]) -> bool:
+        # thread stores answer from their index, plain TinyDB falls back to a full scan
+        with metrics.DB_SECONDS.labels("lookup").time():
+            if isinstance(DB, ThreadStore):
+                found = DB.contains(reddit_id)
+            else:
+                found = bool(DB.search(Query().reddit_id == reddit_id))
+
+        if found:
             logging.info(f"Post with id {reddit_id} has already been mirrored.")
             return True
         return False
 
     @staticmethod
-    def _insert_thread_into_db(thread: dict, DB: TinyDB) -> None:
+    def _insert_thread_into_db(thread: dict, DB: Union[ThreadStore, TinyDB]) -> None:
         try:
-            DB.insert(thread)
+            with metrics.DB_SECONDS.labels("insert").time():
+                DB.insert(thread)
             logging.info(f"Inserted {thread['reddit_id']} into TinyDB")
         except Exception as e:
             logging.error(f"Could not insert {thread['reddit_id']} into TinyDB. Exception: {e}")
 
+    @staticmethod
+    def _get_bool(text: str) -> bool:
+        return str(text).strip().lower() in ("true", "1", "yes")
+
+    @staticmethod
+    def _get_optional_list(text: Union[str, None]) -> Union[list, None]:
+        # None when the variable is not set, so that defaults apply
+        if text is None:
+            return None
+        return [x for x in Util._get_clean_list(text) if x]
+
     @staticmethod
     def _get_clean_list(text: str, sep: str = ",") -> list:
         split_list = text.split(sep)
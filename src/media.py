@@ -0,0 +1,291 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Tuple, Union
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src import metrics
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+class MediaRules:
+    # decides from the url alone whether it points to an image, without any request.
+    # domains are matched in a trie of reversed labels, so "reddit.com" also covers "www.reddit.com"
+    # and the most specific domain wins ("i.imgur.com" over "imgur.com").
+    # urls on image domains are images if their extension is an image extension,
+    # urls on non-image domains are never images, anything else is left to a HEAD request
+
+    image_domains: Tuple[str, ...] = ("i.redd.it", "preview.redd.it", "i.imgur.com", "pbs.twimg.com")
+    non_image_domains: Tuple[str, ...] = (
+        "v.redd.it",
+        "reddit.com",
+        "redd.it",
+        "imgur.com",
+        "youtube.com",
+        "youtu.be",
+    )
+    image_extensions: Tuple[str, ...] = ("jpg", "jpeg", "png", "gif", "webp", "bmp")
+
+    def __init__(
+        self,
+        image_domains: Union[Iterable[str], None] = None,
+        non_image_domains: Union[Iterable[str], None] = None,
+        image_extensions: Union[Iterable[str], None] = None,
+    ):
+        self._trie: dict = {}
+        for domain in self.non_image_domains if non_image_domains is None else non_image_domains:
+            self._add_domain(domain, False)
+        for domain in self.image_domains if image_domains is None else image_domains:
+            self._add_domain(domain, True)
+
+        extensions = self.image_extensions if image_extensions is None else image_extensions
+        self._extensions = frozenset(e.strip().lower().lstrip(".") for e in extensions if e.strip())
+        self.decided = 0
+        self.undecided = 0
+
+    @classmethod
+    def from_file(cls, path: str) -> "MediaRules":
+        # {"image_domains": [...], "non_image_domains": [...], "image_extensions": [...]}
+        with open(path, encoding="utf-8") as f:
+            rules = json.load(f)
+        return cls(rules.get("image_domains"), rules.get("non_image_domains"), rules.get("image_extensions"))
+
+    def _add_domain(self, domain: str, is_image: bool) -> None:
+        domain = domain.strip().lower()
+        if not domain:
+            return
+        node = self._trie
+        for label in reversed(domain.split(".")):
+            node = node.setdefault(label, {})
+        node["$"] = is_image
+
+    def _match_domain(self, host: str) -> Union[bool, None]:
+        match = None
+        node = self._trie
+        for label in reversed(host.split(".")):
+            node = node.get(label)
+            if node is None:
+                break
+            match = node.get("$", match)
+        return match
+
+    def classify(self, url: str) -> Union[bool, None]:
+        # True: an image, False: not an image, None: only a request can tell
+        decision = None
+        try:
+            parts = urlsplit(url)
+            host = (parts.hostname or "").lower()
+        except (TypeError, ValueError, AttributeError):
+            host = ""
+
+        if host:
+            is_image_domain = self._match_domain(host)
+            if is_image_domain is False:
+                decision = False
+            elif is_image_domain:
+                filename = parts.path.rsplit("/", 1)[-1]
+                extension = filename.rsplit(".", 1)[1].lower() if "." in filename else ""
+                decision = True if extension in self._extensions else None
+
+        if decision is None:
+            self.undecided += 1
+        else:
+            self.decided += 1
+        return decision
+
+
+class ContentTypeCache:
+    # url -> content type, least recently used urls are evicted first.
+    # failed lookups are cached too, but only for `negative_ttl` seconds.
+    # persisted as json so that it survives restarts
+
+    def __init__(
+        self,
+        path: Union[str, None] = None,
+        max_entries: int = 10000,
+        ttl: float = 7 * 24 * 60 * 60,
+        negative_ttl: float = 30 * 60,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # url -> (content type or None for a failed lookup, expiry as a unix timestamp)
+        self._entries: OrderedDict[str, Tuple[Union[str, None], float]] = OrderedDict()
+        self._dirty = False
+
+        if path is not None:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, url: str) -> Tuple[bool, Union[str, None]]:
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None or entry[1] < time.time():
+                self._entries.pop(url, None)
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(url)
+            self.hits += 1
+            return True, entry[0]
+
+    def store(self, url: str, content_type: Union[str, None]) -> None:
+        ttl = self.ttl if content_type is not None else self.negative_ttl
+        with self._lock:
+            self._entries[url] = (content_type, time.time() + ttl)
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not load the content type cache from {self.path}. Exception {e}")
+            return
+
+        now = time.time()
+        with self._lock:
+            # entries are saved from least to most recently used
+            for url, (content_type, expires) in entries.items():
+                if expires >= now:
+                    self._entries[url] = (content_type, expires)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        logging.info(f"Loaded {len(self._entries)} cached content types from {self.path}")
+
+    def save(self) -> None:
+        if self.path is None or not self._dirty:
+            return
+        with self._lock:
+            entries = dict(self._entries)
+            self._dirty = False
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+
+@dataclass
+class MediaClassifier:
+    # checks whether urls point to images with HEAD requests
+    # over a shared keep-alive connection pool
+
+    # seconds for a single HEAD request
+    timeout: float = 5
+    # seconds for a whole batch, urls still unresolved by then count as non-images
+    deadline: float = 20
+    max_workers: int = 16
+    cache: Union[ContentTypeCache, None] = None
+    rules: Union[MediaRules, None] = None
+
+    session: requests.Session = field(default=None, repr=False)
+
+    def __post_init__(self):
+        if self.session is None:
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+
+    def _probe(self, url: str) -> Union[str, None]:
+        with metrics.HEAD_REQUEST_SECONDS.time():
+            resp = self.session.head(url, timeout=self.timeout)
+        if resp.ok:
+            return resp.headers.get("content-type")
+        return None
+
+    def _content_type(self, url: str) -> Union[str, None]:
+        if self.cache is not None:
+            found, content_type = self.cache.lookup(url)
+            if found:
+                return content_type
+
+        try:
+            content_type = self._probe(url)
+        except Exception as e:
+            logging.error(f"Could not check image. {e}")
+            content_type = None
+
+        if self.cache is not None and isinstance(url, str):
+            self.cache.store(url, content_type)
+        return content_type
+
+    def _check_by_request(self, url: str) -> Union[str, None]:
+        content_type = self._content_type(url)
+        if content_type and "image" in content_type:
+            return url
+        return None
+
+    def check_image(self, url: str) -> Union[str, None]:
+        if self.rules is not None:
+            is_image = self.rules.classify(url)
+            if is_image is not None:
+                return url if is_image else None
+        return self._check_by_request(url)
+
+    def check_images(self, urls: Iterable[str]) -> Dict[str, Union[str, None]]:
+        # resolve all urls concurrently; the batch takes about as long as its slowest url
+        urls = list(dict.fromkeys(u for u in urls if u is not None))
+        results: Dict[str, Union[str, None]] = {u: None for u in urls}
+        if not urls:
+            return results
+
+        # urls that the rules can decide never reach the HEAD requests
+        if self.rules is not None:
+            undecided: List[str] = []
+            for u in urls:
+                is_image = self.rules.classify(u)
+                if is_image is None:
+                    undecided.append(u)
+                elif is_image:
+                    results[u] = u
+            logging.info(f"Classified {len(urls) - len(undecided)} of {len(urls)} urls without a request")
+            urls = undecided
+            if not urls:
+                return results
+
+        start = time.monotonic()
+        hits = self.cache.hits if self.cache is not None else 0
+        executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls)), thread_name_prefix="head")
+        futures = {executor.submit(self._check_by_request, u): u for u in urls}
+        done, not_done = wait(futures, timeout=self.deadline)
+        # running requests are bounded by `timeout`, queued ones are dropped
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        for f in done:
+            results[futures[f]] = f.result()
+
+        if not_done:
+            logging.warning(f"{len(not_done)} of {len(urls)} urls were not checked within {self.deadline} seconds")
+        logging.info(f"Checked {len(done)} urls for images in {time.monotonic() - start:.2f} seconds")
+        if self.cache is not None:
+            logging.info(f"The content type cache saved {self.cache.hits - hits} of {len(urls)} HEAD requests")
+            self.cache.save()
+        return results
+
+
+default_classifier = MediaClassifier()
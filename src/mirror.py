@@ -1,7 +1,11 @@
+import itertools
+import json
 import logging
+import os
+import random
 import re
-from time import sleep
-from typing import List, Union
+import threading
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Tuple, Union
 
 import praw
 from praw.models import ListingGenerator
@@ -10,7 +14,12 @@ from pythorhead import Lemmy
 from pythorhead.types import LanguageType
 from tinydb import TinyDB
 
-from src.helper import RedditThread, Util
+from src import metrics
+from src.community import community_cache
+from src.helper import RedditThread, ThreadSelection, Util
+from src.media import MediaClassifier, default_classifier
+from src.ratelimit import TokenBucket
+from src.records import Candidate, mirrored_record
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s",
@@ -18,6 +27,79 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
+REDDIT_DOMAIN = "https://www.reddit.com"
+# the most items reddit returns for a single listing request
+REDDIT_PAGE_SIZE = 100
+
+
+def _reddit_id_value(fullname: str) -> int:
+    # reddit ids are base 36 and increase over time
+    return int(fullname.split("_", 1)[-1], 36)
+
+
+class ListingCheckpoint:
+    # the newest submission read from a listing, per subreddit and filter, kept in a local json file.
+    # the threads read by a run are staged first, the cursor moves over them once the selected ones are posted
+
+    def __init__(self, path: Union[str, None] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._cursors: Dict[str, str] = {}
+        self._staged: Dict[str, Tuple[List[str], Set[str]]] = {}
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self._cursors = dict(json.load(f))
+            except (OSError, ValueError) as e:
+                logging.warning(f"Could not load the listing checkpoint from {path}. Exception {e}")
+
+    @staticmethod
+    def key(subreddit_name: str, filter: str, pair: Union[str, None] = None) -> str:
+        key = f"{subreddit_name.lower()}/{filter}"
+        return f"{pair}/{key}" if pair else key
+
+    def get(self, key: str) -> Union[str, None]:
+        with self._lock:
+            return self._cursors.get(key)
+
+    def stage(self, key: str, read: List[str], selected: List[str]) -> None:
+        # `read` are the fullnames of the threads considered, oldest first, `selected` the ones to be posted
+        with self._lock:
+            self._staged[key] = (list(read), set(selected))
+
+    def commit(self, key: str, is_mirrored: Callable[[str], bool]) -> None:
+        # moves the cursor over the staged threads, up to the first selected one that was not posted.
+        # the threads that were not selected have been rejected and are passed
+        with self._lock:
+            staged = self._staged.pop(key, None)
+        if staged is None:
+            return
+
+        read, selected = staged
+        cursor = None
+        for fullname in read:
+            if fullname in selected and not is_mirrored(fullname):
+                logging.info(f"Thread {fullname} was not posted, the checkpoint stays before it")
+                break
+            cursor = fullname
+        if cursor is not None:
+            self.set(key, cursor)
+
+    def set(self, key: str, fullname: str) -> None:
+        with self._lock:
+            current = self._cursors.get(key)
+            if current is not None and _reddit_id_value(fullname) <= _reddit_id_value(current):
+                return
+            self._cursors[key] = fullname
+            cursors = dict(self._cursors)
+
+        if self.path is not None:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(cursors, f)
+            os.replace(tmp_path, self.path)
+
 
 def _rule_1_check_funday_friday_flair(flair: str) -> Union[bool, None]:
     # if "Fun" in the flair and the day is not Friday
@@ -29,6 +111,130 @@ def _rule_1_check_funday_friday_flair(flair: str) -> Union[bool, None]:
             return True
 
 
+def _get_thread_url(reddit_id: str, url_attr: str) -> Tuple[Union[str, None], bool]:
+    # if the reddit_id is in the url, it's the url to the reddit post
+    # otherwise, it's the url to external content embedded into the thread
+    # the same goes for reddit gallery links
+    url: Union[str, None] = None if not url_attr or reddit_id.split("_", 1)[1] in url_attr else url_attr
+
+    # add the missing reddit domain if missing in url from api
+    if url is not None:
+        if url.startswith("/r/"):
+            url = f"{REDDIT_DOMAIN}{url}"
+
+    # check if url is a reddit gallery
+    if url:
+        reddit_gallery: bool = True if re.match("^(https://v.redd.it/)\\w+$", url) else False
+    else:
+        reddit_gallery: bool = False
+
+    return url, reddit_gallery
+
+
+def _listing_record(submission: Submission) -> dict:
+    # the fields of a submission as they came with the listing page.
+    # reading a field that a praw Submission does not have makes praw fetch the whole submission
+    # (one request per post) before raising AttributeError, so fields are read from the instance
+    # dict instead, where a missing field is simply None
+    try:
+        return vars(submission)
+    except TypeError:
+        return {}
+
+
+def _candidate_url(submission: Submission) -> Union[str, None]:
+    # the url to check for an image, if any
+    record = _listing_record(submission)
+    url, reddit_gallery = _get_thread_url(record.get("name"), record.get("url"))
+    return url if reddit_gallery is False else None
+
+
+def _thread_from_submission(
+    i: Submission,
+    DB: TinyDB,
+    ignore_thread_types: List[RedditThread],
+    images: Dict[str, Union[str, None]],
+) -> Union[Candidate, None]:
+    # the thread to mirror, or None if the submission is ignored.
+    # `images` maps the candidate url of the submission to its image url (or None)
+    ignoring_post = False
+    record = _listing_record(i)
+
+    reddit_id: str = record.get("name")
+
+    logging.info(f"Checking post {reddit_id}...")
+
+    is_mirrored = True if Util._check_thread_in_db(reddit_id, DB) else False
+    is_pinned: bool = bool(record.get("stickied"))
+    is_nsfw: bool = record.get("over_18")
+    is_poll: bool = True if record.get("poll_data") else False
+    is_locked: bool = record.get("locked")
+    is_video: bool = record.get("is_video")
+
+    url_attr = record.get("url")
+    url, reddit_gallery = _get_thread_url(reddit_id, url_attr)
+
+    # check if the url is an image
+    image = images.get(url) if (url is not None and reddit_gallery is False) else None
+
+    # if it is, set the url to None
+    url = None if (image is not None and reddit_gallery is not False) else url
+
+    title: str = record.get("title")
+    body_attr = record.get("selftext")
+    body: Union[str, None] = None if body_attr == "" else body_attr
+    permalink: str = f"{REDDIT_DOMAIN}{record.get('permalink')}"
+    flair: Union[str, None] = record.get("link_flair_text")
+    flair = flair.strip() if flair else None
+    only_has_body = True if (body is not None and not url and not image and not is_video) else False
+
+    ignore_map = {
+        RedditThread.mirrored: is_mirrored,
+        RedditThread.pinned: is_pinned,
+        RedditThread.nsfw: is_nsfw,
+        RedditThread.poll: is_poll,
+        RedditThread.locked: is_locked,
+        RedditThread.video: is_video,
+        RedditThread.url: True if url else None,
+        RedditThread.flair: True if flair else None,
+        RedditThread.body: only_has_body,
+        RedditThread.image: True if image else None,
+        RedditThread.reddit_gallery: reddit_gallery,
+        RedditThread.rule_1: _rule_1_check_funday_friday_flair(flair),
+    }
+
+    for t in ignore_thread_types:
+        if ignore_map[t]:
+            logging.info(f"Ignoring submission {reddit_id} with title {title}; {t.value} = {ignore_map[t]}")
+            metrics.CANDIDATES_IGNORED.labels(t.value).inc()
+            ignoring_post = True
+
+    if ignoring_post:
+        metrics.CANDIDATES.labels("ignored").inc()
+        return None
+    metrics.CANDIDATES.labels("accepted").inc()
+
+    # only post threads with URL that are not a video
+    # due to v.redd.it embedding video and sound separately
+    data = Candidate(
+        reddit_id=reddit_id,
+        title=title,
+        body=body,
+        url=url,
+        image_url=image,
+        permalink=permalink,
+        flair=flair,
+        is_video=is_video,
+        is_pinned=is_pinned,
+        is_nsfw=is_nsfw,
+        is_poll=is_poll,
+        is_locked=is_locked,
+        reddit_gallery=reddit_gallery,
+    )
+    logging.info(f"Committing submission {reddit_id} with title {title}")
+    return data
+
+
 def _extract_threads_to_mirror(
     listing: ListingGenerator,
     DB: TinyDB,
@@ -41,109 +247,31 @@ def _extract_threads_to_mirror(
         RedditThread.video,
         RedditThread.url,
     ],
-) -> List[dict]:
+    classifier: MediaClassifier = None,
+) -> List[Candidate]:
     logging.info(f"Ignoring: {', '.join([_.value for _ in ignore_thread_types])}")
 
-    threads_to_mirror = []
-    reddit_domain = "https://www.reddit.com"
-
-    for i in listing:
-        ignoring_post = False
+    if classifier is None:
+        classifier = default_classifier
 
-        reddit_id: str = Util._getattr_mod(i, "name")
-
-        logging.info(f"Checking post {reddit_id}...")
-
-        is_mirrored = True if Util._check_thread_in_db(reddit_id, DB) else False
-        is_pinned: bool = False if Util._getattr_mod(i, "sitckied") == None else True
-        is_nsfw: bool = Util._getattr_mod(i, "over_18")
-        is_poll: bool = True if Util._getattr_mod(i, "poll_data") else False
-        is_locked: bool = Util._getattr_mod(i, "locked")
-        is_video: bool = Util._getattr_mod(i, "is_video")
-
-        url_attr = Util._getattr_mod(i, "url")
-
-        # if the reddit_id is in the url, it's the url to the reddit post
-        # otherwise, it's the url to external content embedded into the thread
-        # the same goes for reddit gallery links
-        url: Union[str, None] = None if reddit_id.split("_", 1)[1] in url_attr else url_attr
+    threads_to_mirror = []
 
-        # add the missing reddit domain if missing in url from api
-        if url is not None:
-            if url.startswith("/r/"):
-                url = f"{reddit_domain}{url}"
+    # check all urls of the listing for images at once, instead of one after another
+    with metrics.REDDIT_FETCH_SECONDS.time():
+        submissions = list(listing)
+    images = classifier.check_images(_candidate_url(i) for i in submissions)
 
-        # check if url is a reddit gallery
-        if url:
-            reddit_gallery: bool = True if re.match("^(https://v.redd.it/)\w+$", url) else False
-        else:
-            reddit_gallery: bool = False
-
-        # check if the url is an image
-        image = Util._check_if_image(url) if (url is not None and reddit_gallery is False) else None
-
-        # if it is, set the url to None
-        url = None if (image is not None and reddit_gallery is not False) else url
-
-        title: str = getattr(i, "title")
-        body_attr = Util._getattr_mod(i, "selftext")
-        body: Union[str, None] = None if body_attr == "" else body_attr
-        permalink: str = f"{reddit_domain}{Util._getattr_mod(i, 'permalink')}"
-        flair: Union[str, None] = Util._getattr_mod(i, "link_flair_text")
-        flair = flair.strip() if flair else None
-        only_has_body = True if (body is not None and not url and not image and not is_video) else False
-
-        ignore_map = {
-            RedditThread.mirrored: is_mirrored,
-            RedditThread.pinned: is_pinned,
-            RedditThread.nsfw: is_nsfw,
-            RedditThread.poll: is_poll,
-            RedditThread.locked: is_locked,
-            RedditThread.video: is_video,
-            RedditThread.url: True if url else None,
-            RedditThread.flair: True if flair else None,
-            RedditThread.body: only_has_body,
-            RedditThread.image: True if image else None,
-            RedditThread.reddit_gallery: reddit_gallery,
-            RedditThread.rule_1: _rule_1_check_funday_friday_flair(flair),
-        }
-
-        for t in ignore_thread_types:
-            if ignore_map[t]:
-                logging.info(f"Ignoring submission {i.name} with title {i.title}; {t.value} = {ignore_map[t]}")
-                ignoring_post = True
-
-        if not ignoring_post:
-            # only post threads with URL that are not a video
-            # due to v.redd.it embedding video and sound separately
-            data = {
-                "url": url,
-                "image_url": image,
-                "url_attr": url_attr,
-                "title": title,
-                "body_attr": body_attr,
-                "body": body,
-                "permalink": permalink,
-                "reddit_id": reddit_id,
-                "flair": flair,
-                "is_video": is_video,
-                "is_pinned": is_pinned,
-                "is_nsfw": is_nsfw,
-                "is_poll": is_poll,
-                "is_locked": is_locked,
-                "reddit_gallery": reddit_gallery,
-            }
-            logging.info(f"Committing submission {i.name} with title {i.title}")
+    for i in submissions:
+        data = _thread_from_submission(i, DB, ignore_thread_types, images)
+        if data is not None:
             threads_to_mirror.append(data)
 
     return threads_to_mirror
 
 
-def get_threads_from_reddit(
-    reddit: praw.Reddit,
-    subreddit_name: str,
+def iter_threads_to_mirror(
+    listing: ListingGenerator,
     DB: TinyDB,
-    limit: int = 100,
     ignore_thread_types: list[RedditThread] = [
         RedditThread.mirrored,
         RedditThread.pinned,
@@ -153,8 +281,60 @@ def get_threads_from_reddit(
         RedditThread.video,
         RedditThread.url,
     ],
-    filter: str = "new",
-) -> List[Submission]:
+    classifier: MediaClassifier = None,
+    batch_size: int = 10,
+) -> Iterator[Candidate]:
+    # yields the threads to mirror while reading the listing, `batch_size` submissions at a time.
+    # the urls of a batch are checked for images together, and once the caller stops
+    # no more submissions (or pages of the listing) are requested
+    logging.info(f"Ignoring: {', '.join([_.value for _ in ignore_thread_types])}")
+
+    if classifier is None:
+        classifier = default_classifier
+
+    submissions = iter(listing)
+    while True:
+        with metrics.REDDIT_FETCH_SECONDS.time():
+            batch = list(itertools.islice(submissions, max(batch_size, 1)))
+        if not batch:
+            return
+
+        images = classifier.check_images(_candidate_url(i) for i in batch)
+        for i in batch:
+            data = _thread_from_submission(i, DB, ignore_thread_types, images)
+            if data is not None:
+                yield data
+
+
+def sample_threads(
+    threads: Iterable[Candidate],
+    k: int,
+    selection: ThreadSelection = ThreadSelection.random,
+    rng: random.Random = None,
+) -> List[Candidate]:
+    # picks up to `k` threads without building the full list of candidates
+    if k <= 0:
+        return []
+
+    if selection == ThreadSelection.first:
+        # stops reading the threads as soon as there are enough
+        return list(itertools.islice(threads, k))
+
+    # reservoir sampling: every thread is equally likely to be picked, and only `k` are kept in memory.
+    # fewer than `k` threads are all returned
+    rng = rng or random
+    reservoir: List[Candidate] = []
+    for n, thread in enumerate(threads):
+        if n < k:
+            reservoir.append(thread)
+        else:
+            j = rng.randrange(n + 1)
+            if j < k:
+                reservoir[j] = thread
+    return reservoir
+
+
+def _get_listing(reddit: praw.Reddit, subreddit_name: str, limit: int = 100, filter: str = "new") -> ListingGenerator:
     if limit > 100:
         logging.info(f"Max limit of submissions to return is 100. The limit arg ({limit}) has now been set to 100.")
         limit = 100
@@ -168,6 +348,7 @@ def get_threads_from_reddit(
 
     subreddit = reddit.subreddit(subreddit_name)
     logging.info(f"Searching subreddit r/{subreddit}")
+    metrics.LISTINGS_FETCHED.labels(subreddit_name).inc()
 
     if filter == "new":
         listing = subreddit.new(limit=limit)
@@ -181,60 +362,216 @@ def get_threads_from_reddit(
         listing = subreddit.rising(limit=limit)
         logging.info(f"Grabbed a list of {filter} threads from Reddit")
 
-    threads_to_mirror = _extract_threads_to_mirror(listing=listing, DB=DB, ignore_thread_types=ignore_thread_types)
+    return listing
+
+
+def fetch_new_since(
+    reddit: praw.Reddit,
+    subreddit_name: str,
+    cursor: Union[str, None],
+    limit: int = 100,
+    max_items: int = 1000,
+) -> List[Submission]:
+    # the submissions of r/{subreddit_name}/new posted after `cursor`, oldest first.
+    # without a cursor, the newest `limit` submissions
+    if cursor is None:
+        return list(reversed(list(_get_listing(reddit, subreddit_name, limit, "new"))))
+
+    url = f"r/{subreddit_name}/new"
+    cursor_value = _reddit_id_value(cursor)
+    metrics.LISTINGS_FETCHED.labels(subreddit_name).inc()
+
+    def get_page(params: dict) -> List[Submission]:
+        with metrics.REDDIT_FETCH_SECONDS.time():
+            return list(reddit.get(url, params=params))
+
+    # usually a single request returns everything posted since the cursor
+    page = get_page({"before": cursor, "limit": REDDIT_PAGE_SIZE})
+    if 0 < len(page) < REDDIT_PAGE_SIZE:
+        return list(reversed(page))
+
+    if not page:
+        # nothing new, unless the cursor has been deleted: reddit answers with an empty page then
+        head = get_page({"limit": 1})
+        if not head or _reddit_id_value(head[0].name) <= cursor_value:
+            return []
+        logging.info(f"The checkpoint {cursor} is no longer listed in r/{subreddit_name}")
+
+    # catching up: page back from the newest submission with `after` until reaching the cursor
+    new: List[Submission] = []
+    params = {"limit": REDDIT_PAGE_SIZE}
+    while len(new) < max_items:
+        page = get_page(params)
+        for submission in page:
+            if _reddit_id_value(submission.name) <= cursor_value:
+                logging.info(f"Caught up with {len(new)} threads posted since the checkpoint")
+                return list(reversed(new))
+            new.append(submission)
+        if len(page) < REDDIT_PAGE_SIZE:
+            break
+        params = {"limit": REDDIT_PAGE_SIZE, "after": page[-1].name}
+
+    if len(new) >= max_items:
+        logging.warning(f"More than {max_items} threads were posted since the checkpoint, only reading the newest")
+    return list(reversed(new[:max_items]))
+
+
+def get_threads_from_reddit(
+    reddit: praw.Reddit,
+    subreddit_name: str,
+    DB: TinyDB,
+    limit: int = 100,
+    ignore_thread_types: list[RedditThread] = [
+        RedditThread.mirrored,
+        RedditThread.pinned,
+        RedditThread.nsfw,
+        RedditThread.poll,
+        RedditThread.locked,
+        RedditThread.video,
+        RedditThread.url,
+    ],
+    filter: str = "new",
+    classifier: MediaClassifier = None,
+) -> List[Submission]:
+    listing = _get_listing(reddit, subreddit_name, limit, filter)
+
+    threads_to_mirror = _extract_threads_to_mirror(
+        listing=listing, DB=DB, ignore_thread_types=ignore_thread_types, classifier=classifier
+    )
     logging.info(f"Found {len(threads_to_mirror)} potential threads to mirror")
 
     return threads_to_mirror
 
 
+def iter_selected_threads_from_reddit(
+    reddit: praw.Reddit,
+    subreddit_name: str,
+    DB: TinyDB,
+    cap: int,
+    limit: int = 100,
+    ignore_thread_types: list[RedditThread] = [
+        RedditThread.mirrored,
+        RedditThread.pinned,
+        RedditThread.nsfw,
+        RedditThread.poll,
+        RedditThread.locked,
+        RedditThread.video,
+        RedditThread.url,
+    ],
+    filter: str = "new",
+    classifier: MediaClassifier = None,
+    selection: ThreadSelection = ThreadSelection.random,
+    batch_size: int = 10,
+    checkpoint: ListingCheckpoint = None,
+    catch_up_limit: int = 1000,
+    pair: Union[str, None] = None,
+) -> Iterator[Candidate]:
+    # like get_threads_from_reddit followed by a sample of `cap` threads,
+    # but candidates are extracted lazily and never collected into a list.
+    # the first selection yields each thread as soon as it is found, a random one once the listing has been read.
+    # with a checkpoint, only the threads posted since the previous run are read from the new listing.
+    # only the first selection leaves a clean cut behind it, a random draw leaves candidates all over the listing
+    use_checkpoint = checkpoint is not None and filter == "new" and selection == ThreadSelection.first
+    if use_checkpoint:
+        key = checkpoint.key(subreddit_name, filter, pair)
+        listing = fetch_new_since(reddit, subreddit_name, checkpoint.get(key), limit, catch_up_limit)
+        logging.info(f"Read {len(listing)} new threads from r/{subreddit_name} since the checkpoint")
+    else:
+        listing = _get_listing(reddit, subreddit_name, limit, filter)
+
+    threads = iter_threads_to_mirror(
+        listing, DB, ignore_thread_types=ignore_thread_types, classifier=classifier, batch_size=batch_size
+    )
+    selected: List[Candidate] = []
+    if selection == ThreadSelection.first:
+        for thread in itertools.islice(threads, max(cap, 0)):
+            selected.append(thread)
+            yield thread
+    else:
+        selected = sample_threads(threads, cap, selection)
+        yield from selected
+    logging.info(f"Selected {len(selected)} threads to mirror, capped at {cap}")
+
+    if use_checkpoint and listing:
+        # threads up to the new cursor have been considered and are not read again.
+        # when the first threads fill the cap, the ones after the last of them are left for the next run.
+        # the cursor only moves with `checkpoint.commit`, after the selected threads have been posted
+        read = [submission.name for submission in listing]
+        if selected and len(selected) == cap:
+            read = read[: read.index(selected[-1]["reddit_id"]) + 1]
+        checkpoint.stage(key, read, [t["reddit_id"] for t in selected])
+
+
+def select_threads_from_reddit(
+    reddit: praw.Reddit, subreddit_name: str, DB: TinyDB, cap: int, **kwargs
+) -> List[Candidate]:
+    # the arguments are the ones of iter_selected_threads_from_reddit
+    return list(iter_selected_threads_from_reddit(reddit, subreddit_name, DB, cap, **kwargs))
+
+
+def _post_thread(lemmy: Lemmy, thread: Union[Candidate, dict], community_id: int) -> Union[dict, None]:
+    # generate a bot disclaimer
+    bot_body = f"(This post was mirrored by a bot. [The original post can be found here]({thread['permalink']}))"
+
+    # add the bot disclaimer to the post and link to the original content
+    post_body = thread["body"] + "\n\n" + bot_body if isinstance(thread["body"], str) else bot_body
+
+    # add flair if it exists
+    thread_title = f"{thread['flair']} | {thread['title']}" if thread["flair"] else thread["title"]
+
+    # add a url or image url if they exist
+    thread_url = thread["url"]
+    image_url = thread["image_url"]
+
+    # link to the url or external content
+    url = thread_url if thread_url is not None else image_url
+
+    with metrics.LEMMY_SECONDS.labels("post_create").time():
+        return lemmy.post.create(
+            community_id=community_id,
+            name=thread_title,
+            url=url,
+            nsfw=None,
+            body=post_body,
+            language_id=LanguageType.EN,
+        )
+
+
 def mirror_threads_to_lemmy(
     lemmy: Lemmy,
-    threads_to_mirror: List[dict],
+    threads_to_mirror: List[Candidate],
     community: str,
     DB: TinyDB,
     delay: int = 30,
+    limiter: TokenBucket = None,
 ) -> int:
-    community_id = lemmy.discover_community(community)
+    community_id = community_cache.resolve(lemmy, community)
+
+    # without a shared limiter, keep posts at least `delay` seconds apart
+    if limiter is None:
+        limiter = TokenBucket.from_delay(delay)
 
     num_mirrored_posts = 0
-    posted = False
+    throttled = 0.0
     for thread in threads_to_mirror:
-        sleep(delay)
+        posted = False
         if not Util._check_thread_in_db(thread["reddit_id"], DB):
-            # generate a bot disclaimer
-            bot_body = (
-                f"(This post was mirrored by a bot. [The original post can be found here]({thread['permalink']}))"
-            )
-
-            # add the bot disclaimer to the post and link to the original content
-            post_body = thread["body"] + "\n\n" + bot_body if isinstance(thread["body"], str) else bot_body
-
-            # add flair if it exists
-            thread_title = f"{thread['flair']} | {thread['title']}" if thread["flair"] else thread["title"]
-
-            # add a url or image url if they exist
-            thread_url = thread["url"]
-            image_url = thread["image_url"]
-
-            # link to the url or external content
-            url = thread_url if thread_url is not None else image_url
-
+            # only actual posts are paced
+            throttled += limiter.acquire()
             try:
-                lemmy.post.create(
-                    community_id=community_id,
-                    name=thread_title,
-                    url=url,
-                    nsfw=None,
-                    body=post_body,
-                    language_id=LanguageType.EN,
-                )
+                post = _post_thread(lemmy, thread, community_id)
                 posted = True
             except Exception as e:
+                metrics.POSTS.labels("failed").inc()
                 logging.error(f"Lemmy cound not create a post for thread {thread['reddit_id']}. Exception {e}.")
+                if community_cache.invalidate_on_not_found(lemmy, community, e):
+                    community_id = community_cache.resolve(lemmy, community)
 
             if posted:
+                metrics.POSTS.labels("created").inc()
                 num_mirrored_posts += 1
-                Util._insert_thread_into_db(thread, DB)
+                Util._insert_thread_into_db(mirrored_record(thread, post), DB)
                 logging.info(f"Posted thread with reddit_id {thread['reddit_id']} in {community}")
 
+    logging.info(f"Waited {throttled:.1f} seconds for the Lemmy rate limit")
     return num_mirrored_posts
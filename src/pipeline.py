@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Iterator, List, Set, Union
+
+import praw
+from pythorhead import Lemmy
+from tinydb import TinyDB
+
+from src import metrics
+from src.community import community_cache
+from src.helper import RedditThread, ThreadSelection, Util
+from src.media import MediaClassifier
+from src.mirror import (
+    ListingCheckpoint,
+    _post_thread,
+    iter_selected_threads_from_reddit,
+)
+from src.ratelimit import TokenBucket
+from src.records import Candidate, mirrored_record
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+# marks the end of a stage's output
+_DONE = object()
+
+
+@dataclass
+class PipelineStats:
+    selected: int = 0
+    duplicates: int = 0
+    posted: int = 0
+    failed: int = 0
+    # seconds the post stage waited for the Lemmy rate limit
+    throttled: float = 0.0
+    # seconds each stage spent waiting for the next stage to take its output (backpressure)
+    blocked: dict = field(default_factory=lambda: {"select": 0.0})
+
+
+@dataclass
+class MirrorPipeline:
+    # the mirror task as two stages connected by a bounded queue:
+    #   select  reads the listing and picks the threads like the synchronous task (iter_selected_threads_from_reddit),
+    #           `batch_size` submissions at a time, and drops the ones already seen earlier in this run
+    #   post    creates the Lemmy posts, paced by `limiter`
+    # each stage waits for its blocking network calls in a worker thread, so with the first selection
+    # the next threads are fetched and checked for images while the previous ones are posted.
+    # a full queue holds the select stage back, so at most `queue_size` threads wait to be posted.
+    # with a checkpoint, the selection is staged like in the synchronous task and committed by the caller
+
+    reddit: praw.Reddit
+    lemmy: Lemmy
+    subreddit: str
+    community: str
+    DB: TinyDB
+    limit: int = 100
+    filter: str = "new"
+    cap: int = 100
+    ignore_thread_types: List[RedditThread] = field(
+        default_factory=lambda: [
+            RedditThread.mirrored,
+            RedditThread.pinned,
+            RedditThread.nsfw,
+            RedditThread.poll,
+            RedditThread.locked,
+            RedditThread.video,
+            RedditThread.url,
+        ]
+    )
+    classifier: Union[MediaClassifier, None] = None
+    limiter: Union[TokenBucket, None] = None
+    queue_size: int = 10
+    selection: ThreadSelection = ThreadSelection.random
+    batch_size: int = 10
+    checkpoint: Union[ListingCheckpoint, None] = None
+    catch_up_limit: int = 1000
+    pair: Union[str, None] = None
+
+    stats: PipelineStats = field(default_factory=PipelineStats, init=False)
+
+    def __post_init__(self):
+        if self.limiter is None:
+            self.limiter = TokenBucket(None)
+
+    @property
+    def name(self) -> str:
+        return f"r/{self.subreddit} -> c/{self.community}"
+
+    async def _put(self, queue: asyncio.Queue, item, stage: str) -> None:
+        start = time.monotonic()
+        await queue.put(item)
+        self.stats.blocked[stage] += time.monotonic() - start
+
+    async def _select(self, posts: asyncio.Queue) -> None:
+        seen: Set[str] = set()
+        try:
+            threads: Iterator[Candidate] = iter_selected_threads_from_reddit(
+                self.reddit,
+                self.subreddit,
+                self.DB,
+                self.cap,
+                limit=self.limit,
+                ignore_thread_types=self.ignore_thread_types,
+                filter=self.filter,
+                classifier=self.classifier,
+                selection=self.selection,
+                batch_size=self.batch_size,
+                checkpoint=self.checkpoint,
+                catch_up_limit=self.catch_up_limit,
+                pair=self.pair,
+            )
+            while True:
+                # praw requests the next page of the listing as it is iterated
+                thread = await asyncio.to_thread(next, threads, _DONE)
+                if thread is _DONE:
+                    break
+
+                # a thread can show up twice while the listing shifts between pages.
+                # mirrored threads have already been dropped by the selection, the database is not read again
+                if thread["reddit_id"] in seen:
+                    self.stats.duplicates += 1
+                    continue
+                seen.add(thread["reddit_id"])
+                self.stats.selected += 1
+                await self._put(posts, thread, "select")
+        except Exception as e:
+            logging.error(f"{self.name}: could not select threads from Reddit. Exception {e}")
+        finally:
+            await posts.put(_DONE)
+
+    async def _post(self, posts: asyncio.Queue) -> None:
+        community_id = await asyncio.to_thread(community_cache.resolve, self.lemmy, self.community)
+        while True:
+            thread = await posts.get()
+            if thread is _DONE:
+                break
+
+            self.stats.throttled += await asyncio.to_thread(self.limiter.acquire)
+            try:
+                post = await asyncio.to_thread(_post_thread, self.lemmy, thread, community_id)
+            except Exception as e:
+                self.stats.failed += 1
+                metrics.POSTS.labels("failed").inc()
+                logging.error(f"Lemmy cound not create a post for thread {thread['reddit_id']}. Exception {e}.")
+                if community_cache.invalidate_on_not_found(self.lemmy, self.community, e):
+                    community_id = await asyncio.to_thread(community_cache.resolve, self.lemmy, self.community)
+                continue
+
+            self.stats.posted += 1
+            metrics.POSTS.labels("created").inc()
+            Util._insert_thread_into_db(mirrored_record(thread, post), self.DB)
+            logging.info(f"Posted thread with reddit_id {thread['reddit_id']} in {self.community}")
+
+    async def run(self) -> int:
+        self.stats = PipelineStats()
+        posts: asyncio.Queue = asyncio.Queue(self.queue_size)
+
+        start = time.monotonic()
+        await asyncio.gather(self._select(posts), self._post(posts))
+
+        blocked = ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in self.stats.blocked.items())
+        logging.info(
+            f"{self.name}: posted {self.stats.posted} of {self.stats.selected} selected threads "
+            f"({self.stats.duplicates} duplicates, {self.stats.failed} failed) "
+            f"in {time.monotonic() - start:.1f} seconds; waited {self.stats.throttled:.1f}s for the rate limit; "
+            f"blocked on a full queue: {blocked}"
+        )
+        return self.stats.posted
+
+
+def mirror_with_pipeline(pipeline: MirrorPipeline) -> int:
+    # entry point for the synchronous scheduler, each pair job runs its own event loop
+    return asyncio.run(pipeline.run())
@@ -0,0 +1,68 @@
+import logging
+import threading
+import time
+from typing import Union
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+class TokenBucket:
+    # allows `burst` calls at once, refilled at `rate` tokens per second.
+    # a rate of None means no limit
+
+    def __init__(self, rate: Union[float, None], burst: int = 1):
+        self.rate = rate if rate else None
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.throttled_seconds = 0.0
+        self.acquired = 0
+
+    @classmethod
+    def from_delay(cls, delay: float) -> "TokenBucket":
+        # one call every `delay` seconds
+        return cls(1 / delay if delay and delay > 0 else None, burst=1)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout: Union[float, None] = None) -> Union[float, None]:
+        # blocks until a token is available and returns the seconds spent waiting.
+        # the token is reserved under the lock and the wait happens outside of it: the tokens go negative
+        # by the calls waiting, so each caller sleeps until its own token is due, in the order they came.
+        # when the token is not due within `timeout` seconds, nothing is reserved and None is returned at once
+        with self._lock:
+            if self.rate is None:
+                self.acquired += 1
+                return 0.0
+
+            self._refill()
+            wait = (1 - self._tokens) / self.rate if self._tokens < 1 else 0.0
+            if timeout is not None and wait > timeout:
+                return None
+            self._tokens -= 1
+            self.acquired += 1
+            self.throttled_seconds += wait
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+# shared by everything in the process that writes to Lemmy
+lemmy_write_limiter = TokenBucket(None)
+
+
+def configure_lemmy_write_limiter(rate: Union[float, None], burst: int = 1) -> TokenBucket:
+    global lemmy_write_limiter
+    lemmy_write_limiter = TokenBucket(rate, burst)
+    if rate:
+        logging.info(f"Limiting Lemmy writes to {rate * 60:g} per minute with bursts of {burst}")
+    return lemmy_write_limiter
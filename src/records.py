@@ -0,0 +1,151 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Tuple, Union
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+# the fields kept for each mirrored thread in the database
+RECORD_FIELDS = ("reddit_id", "pair", "lemmy_post_id", "mirrored_at", "content_hash")
+
+
+class Candidate:
+    # a thread to mirror, while it is in flight between reddit and lemmy.
+    # slotted, since a run can hold many of them; reads like the dict it replaces (thread["title"])
+
+    __slots__ = (
+        "reddit_id",
+        "title",
+        "body",
+        "url",
+        "image_url",
+        "permalink",
+        "flair",
+        "is_video",
+        "is_pinned",
+        "is_nsfw",
+        "is_poll",
+        "is_locked",
+        "reddit_gallery",
+    )
+
+    def __init__(
+        self,
+        reddit_id: str,
+        title: str,
+        body: Union[str, None] = None,
+        url: Union[str, None] = None,
+        image_url: Union[str, None] = None,
+        permalink: Union[str, None] = None,
+        flair: Union[str, None] = None,
+        is_video: bool = False,
+        is_pinned: bool = False,
+        is_nsfw: bool = False,
+        is_poll: bool = False,
+        is_locked: bool = False,
+        reddit_gallery: bool = False,
+    ):
+        self.reddit_id = reddit_id
+        self.title = title
+        self.body = body
+        self.url = url
+        self.image_url = image_url
+        self.permalink = permalink
+        self.flair = flair
+        self.is_video = is_video
+        self.is_pinned = is_pinned
+        self.is_nsfw = is_nsfw
+        self.is_poll = is_poll
+        self.is_locked = is_locked
+        self.reddit_gallery = reddit_gallery
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key, default)
+
+    def as_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f"Candidate(reddit_id={self.reddit_id!r}, title={self.title!r})"
+
+
+def content_hash(thread: Union[Candidate, dict]) -> str:
+    # tells whether the content of a thread changed, without keeping the content
+    h = hashlib.blake2b(digest_size=8)
+    for key in ("title", "body", "url", "image_url"):
+        h.update(str(thread.get(key) or "").encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _post_id(post: Union[dict, None]) -> Union[int, None]:
+    # the id of a post created with pythorhead, {"post_view": {"post": {"id": ...}}}
+    try:
+        post_id = post["post_view"]["post"]["id"]
+    except (KeyError, TypeError):
+        return None
+    return post_id if isinstance(post_id, int) else None
+
+
+def mirrored_record(thread: Union[Candidate, dict], post: Union[dict, None] = None) -> dict:
+    # what is stored for a mirrored thread
+    return {
+        "reddit_id": thread["reddit_id"],
+        "lemmy_post_id": _post_id(post),
+        "mirrored_at": int(time.time()),
+        "content_hash": content_hash(thread),
+    }
+
+
+def slim_record(doc: dict) -> dict:
+    # a thread stored before records were slimmed down, with its content replaced by a hash
+    if set(doc) <= set(RECORD_FIELDS):
+        return doc
+    record = {
+        "reddit_id": doc["reddit_id"],
+        "lemmy_post_id": doc.get("lemmy_post_id"),
+        "mirrored_at": doc.get("mirrored_at"),
+        "content_hash": doc.get("content_hash") or content_hash(doc),
+    }
+    if doc.get("pair"):
+        record["pair"] = doc["pair"]
+    return record
+
+
+def migrate_db_file(db_path: str, table: str = "_default") -> Tuple[int, int]:
+    # rewrites a TinyDB database file with slim records, returns its size before and after.
+    # files without any full records are left alone
+    if not os.path.exists(db_path) or os.path.getsize(db_path) == 0:
+        return 0, 0
+
+    before = os.path.getsize(db_path)
+    with open(db_path, encoding="utf-8") as f:
+        db = json.load(f)
+
+    docs = db.get(table, {})
+    if all(set(doc) <= set(RECORD_FIELDS) for doc in docs.values() if "reddit_id" in doc):
+        return before, before
+
+    db[table] = {doc_id: slim_record(doc) if "reddit_id" in doc else doc for doc_id, doc in docs.items()}
+    tmp_path = f"{db_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(db, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, db_path)
+
+    after = os.path.getsize(db_path)
+    logging.info(f"Migrated {len(docs)} mirrored threads in {db_path} to slim records, {before} -> {after} bytes")
+    return before, after
@@ -0,0 +1,82 @@
+import logging
+import os
+import threading
+import time
+from typing import Union
+
+from tinydb import TinyDB
+
+from src.helper import DataBase
+from src.records import slim_record
+from src.store import ThreadStore
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+class BackgroundRestore:
+    # pulls the Filestack backup in a background thread while the bot runs on the local snapshot,
+    # then merges the backup into the live store by reddit_id.
+    # `backup` downloads into its own db_path, so the live database file is never overwritten.
+    # until the merge completes, `ready` stays unset: mirroring would repost threads the local
+    # snapshot does not know about, and uploading the snapshot would overwrite the newer backup.
+    # a failed restore is retried every `retry_seconds`.
+
+    def __init__(self, store: ThreadStore, backup: DataBase, retry_seconds: float = 60, **backup_kwargs):
+        self.store = store
+        self.backup = backup
+        self.backup_kwargs = backup_kwargs
+        self.retry_seconds = retry_seconds
+        self.ready = threading.Event()
+        self.merged = 0
+        self.failed_attempts = 0
+        self.seconds: Union[float, None] = None
+        self._stop = threading.Event()
+        self._thread: Union[threading.Thread, None] = None
+
+    def start(self) -> "BackgroundRestore":
+        self._thread = threading.Thread(target=self._run, name="restore", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def wait(self, timeout: Union[float, None] = None) -> bool:
+        return self.ready.wait(timeout)
+
+    def _run(self) -> None:
+        start = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                self._restore()
+            except Exception as e:
+                self.failed_attempts += 1
+                logging.error(
+                    f"Could not restore the database from Filestack, retrying in {self.retry_seconds} seconds. "
+                    f"Exception {e}"
+                )
+                self._stop.wait(self.retry_seconds)
+                continue
+
+            self.seconds = time.monotonic() - start
+            self.ready.set()
+            logging.info(
+                f"Merged {self.merged} threads from the Filestack backup into {len(self.store)} mirrored threads "
+                f"in {self.seconds:.2f} seconds"
+            )
+            return
+
+    def _restore(self) -> None:
+        try:
+            self.backup.get_backup(**self.backup_kwargs)
+            with TinyDB(self.backup.db_path) as db:
+                # a backup written by an older version holds full records
+                threads = [slim_record(thread) if "reddit_id" in thread else thread for thread in db.all()]
+            self.merged = self.store.merge(threads)
+        finally:
+            if os.path.exists(self.backup.db_path):
+                os.remove(self.backup.db_path)
@@ -0,0 +1,176 @@
+import datetime
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Tuple, Union
+
+import schedule
+
+from src import metrics
+from src.helper import OverlapPolicy
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+class _WakingJobList(list):
+    # the scheduler's job list, calls `on_change` whenever a job is added or cancelled
+    # so that a sleeping scheduler loop can recompute its timeout
+
+    def __init__(self, jobs: list, on_change: Callable[[], None]):
+        super().__init__(jobs)
+        self._on_change = on_change
+
+    def append(self, job) -> None:
+        super().append(job)
+        self._on_change()
+
+    def remove(self, job) -> None:
+        super().remove(job)
+        self._on_change()
+
+    def clear(self) -> None:
+        super().clear()
+        self._on_change()
+
+
+class SchedulerLoop:
+    # runs pending jobs, then sleeps until the next job is due instead of spinning.
+    # adding or cancelling a job from any thread wakes the loop early.
+
+    def __init__(
+        self,
+        scheduler: schedule.Scheduler = schedule.default_scheduler,
+        max_idle_seconds: float = 60,
+    ):
+        self.scheduler = scheduler
+        # an upper bound on a single sleep, guards against clock jumps
+        self.max_idle_seconds = max_idle_seconds
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.scheduler.jobs = _WakingJobList(self.scheduler.jobs, self.wake)
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stop.is_set()
+
+    def next_timeout(self) -> float:
+        idle: Union[float, None] = self.scheduler.idle_seconds
+        if idle is None:
+            # no jobs scheduled, wait until one is added
+            return self.max_idle_seconds
+        return min(max(idle, 0), self.max_idle_seconds)
+
+    def _record_lag(self) -> None:
+        # how late the jobs that are due now are started, the loop sleeps until the next job is due
+        now = datetime.datetime.now()
+        for job in self.scheduler.jobs:
+            if job.should_run:
+                metrics.SCHEDULER_LAG_SECONDS.observe(max((now - job.next_run).total_seconds(), 0))
+
+    def run_once(self) -> float:
+        self._record_lag()
+        self.scheduler.run_pending()
+        timeout = self.next_timeout()
+        if self._wake.wait(timeout):
+            self._wake.clear()
+        return timeout
+
+    def run_forever(self) -> None:
+        logging.info("Scheduler started")
+        while not self.stopped:
+            self.run_once()
+        logging.info("Scheduler stopped")
+
+
+class JobPool:
+    # a fixed number of worker threads for scheduled jobs.
+    # a job that is still queued or running is not started again:
+    # with OverlapPolicy.skip the new tick is dropped,
+    # with OverlapPolicy.coalesce all ticks during a run collapse into a single follow-up run
+
+    def __init__(self, max_workers: int = 2, policy: OverlapPolicy = OverlapPolicy.skip):
+        self.max_workers = max_workers
+        self.policy = policy
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        # job name -> "queued" or "running"
+        self._active: Dict[str, str] = {}
+        self._rerun: Dict[str, Tuple[Callable, dict]] = {}
+        self.skipped = 0
+        self.coalesced = 0
+
+    @property
+    def running(self) -> int:
+        with self._lock:
+            return sum(state == "running" for state in self._active.values())
+
+    @property
+    def queue_depth(self) -> int:
+        with self._lock:
+            return sum(state == "queued" for state in self._active.values())
+
+    def is_active(self, name: str) -> bool:
+        with self._lock:
+            return name in self._active
+
+    def submit(self, name: str, func: Callable, kwargs: dict = {}, policy: Union[OverlapPolicy, None] = None) -> bool:
+        policy = policy or self.policy
+        with self._lock:
+            if name in self._active:
+                if policy == OverlapPolicy.coalesce:
+                    self._rerun[name] = (func, kwargs)
+                    self.coalesced += 1
+                    logging.info(f"Job {name} is still {self._active[name]}, it will run once more afterwards")
+                else:
+                    self.skipped += 1
+                    logging.info(f"Job {name} is still {self._active[name]}, skipping this run")
+                return False
+            self._active[name] = "queued"
+
+        self._executor.submit(self._run, name, func, kwargs, time.monotonic())
+        return True
+
+    def _run(self, name: str, func: Callable, kwargs: dict, queued_at: float) -> None:
+        metrics.JOB_QUEUE_SECONDS.observe(time.monotonic() - queued_at)
+        with self._lock:
+            self._active[name] = "running"
+        try:
+            func(**kwargs)
+        except Exception as e:
+            logging.error(f"Job {name} failed. Exception {e}")
+        finally:
+            with self._lock:
+                rerun = self._rerun.pop(name, None)
+                if rerun is None:
+                    del self._active[name]
+                else:
+                    self._active[name] = "queued"
+            if rerun is not None:
+                try:
+                    self._executor.submit(self._run, name, *rerun, time.monotonic())
+                except RuntimeError:
+                    # the pool is shutting down
+                    with self._lock:
+                        del self._active[name]
+
+    def shutdown(self, wait: bool = True, cancel_queued: bool = False) -> None:
+        # with `cancel_queued`, the jobs that have not started yet are dropped, the running ones still finish
+        if cancel_queued:
+            with self._lock:
+                self._rerun.clear()
+        self._executor.shutdown(wait=wait, cancel_futures=cancel_queued)
+        if cancel_queued:
+            with self._lock:
+                self._active = {name: state for name, state in self._active.items() if state == "running"}
@@ -0,0 +1,407 @@
+import abc
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+from typing import Dict, Iterable, List, Union
+
+from tinydb import TinyDB
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+class BloomFilter:
+    # compact probabilistic set: "not in" answers are always right,
+    # "in" answers are wrong with roughly `false_positive_rate` probability
+
+    def __init__(self, capacity: int, false_positive_rate: float = 0.01, max_bytes: int = 1024 * 1024):
+        capacity = max(capacity, 1)
+        num_bits = math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+        self.num_bits: int = max(min(num_bits, max_bytes * 8), 8)
+        self.num_hashes: int = max(round(self.num_bits / capacity * math.log(2)), 1)
+        self.capacity = capacity
+        self.count = 0
+        self._bits = bytearray(math.ceil(self.num_bits / 8))
+
+        if num_bits > self.num_bits:
+            logging.warning(
+                f"Bloom filter capped at {max_bytes} bytes, "
+                f"false positive rate at capacity will be {self.false_positive_rate(capacity):.4f}"
+            )
+
+    def _positions(self, key: str) -> Iterable[int]:
+        # double hashing: k positions from two halves of a single digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, key: str) -> None:
+        for p in self._positions(key):
+            self._bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def false_positive_rate(self, count: Union[int, None] = None) -> float:
+        count = self.count if count is None else count
+        return (1 - math.exp(-self.num_hashes * count / self.num_bits)) ** self.num_hashes
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self._bits)
+
+
+def thread_key(reddit_id: str, pair: Union[str, None] = None) -> str:
+    # threads mirrored for a named pair are keyed by (pair, reddit_id),
+    # threads without a pair (from a single pair setup) by their reddit_id alone
+    return f"{pair}/{reddit_id}" if pair else reddit_id
+
+
+def _doc_key(doc: dict) -> str:
+    return thread_key(doc["reddit_id"], doc.get("pair"))
+
+
+class ThreadStore(abc.ABC):
+    # a store of mirrored threads with a keyed lookup on reddit_id
+    # subclasses decide how the threads are persisted
+
+    bloom: Union[BloomFilter, None] = None
+    bloom_trust_positives: bool = False
+    lookups_saved: int = 0
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._index: Dict[str, int] = {}
+
+    def attach_bloom_filter(
+        self,
+        false_positive_rate: float = 0.01,
+        max_bytes: int = 1024 * 1024,
+        capacity: Union[int, None] = None,
+        trust_positives: bool = False,
+    ) -> BloomFilter:
+        # leave room for growth so the false positive rate holds for a while
+        with self._lock:
+            capacity = capacity or max(2 * len(self._index), 10000)
+            self.bloom = BloomFilter(capacity, false_positive_rate, max_bytes)
+            for key in self._index:
+                self.bloom.add(key)
+            self.bloom_trust_positives = trust_positives
+            self.lookups_saved = 0
+
+        logging.info(
+            f"Bloom filter with {self.bloom.size_bytes} bytes and {self.bloom.num_hashes} hashes "
+            f"built from {self.bloom.count} mirrored threads"
+        )
+        return self.bloom
+
+    def contains(self, key: str) -> bool:
+        # `key` is the reddit_id, or the thread_key of a thread mirrored for a pair.
+        # both stores answer from the in-memory index, which is as fast as the bloom filter:
+        # the filter only counts the lookups it would save in front of a slower lookup
+        with self._lock:
+            if self.bloom is not None:
+                if key not in self.bloom:
+                    self.lookups_saved += 1
+                    return False
+                if self.bloom_trust_positives:
+                    self.lookups_saved += 1
+                    return True
+            return self._contains(key)
+
+    def _contains(self, key: str) -> bool:
+        return key in self._index
+
+    def _add_to_index(self, key: str, doc_id: int) -> None:
+        self._index[key] = doc_id
+        if self.bloom is not None:
+            self.bloom.add(key)
+
+    @abc.abstractmethod
+    def insert(self, thread: dict) -> int:
+        ...
+
+    def _insert_many(self, threads: List[dict]) -> None:
+        for thread in threads:
+            self.insert(thread)
+
+    def merge(self, threads: Iterable[dict]) -> int:
+        # inserts the threads that are not stored yet, matched by (pair, reddit_id)
+        with self._lock:
+            new: Dict[str, dict] = {}
+            for thread in threads:
+                if thread.get("reddit_id") is None:
+                    continue
+                key = _doc_key(thread)
+                if key not in self._index:
+                    new.setdefault(key, dict(thread))
+            if new:
+                self._insert_many(list(new.values()))
+            return len(new)
+
+    @abc.abstractmethod
+    def remove(self, key: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def all(self) -> List[dict]:
+        ...
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._index)
+
+    def __contains__(self, key: str) -> bool:
+        return self.contains(key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TinyDBThreadStore(ThreadStore):
+    # keeps an in-memory reddit_id -> doc_id index in sync with the TinyDB file
+    # so that lookups no longer scan the whole JSON document
+
+    def __init__(self, db_path: str):
+        super().__init__()
+        self.db_path = db_path
+        self.db = TinyDB(db_path)
+        self._build_index()
+
+    def _build_index(self) -> None:
+        with self._lock:
+            self._index = {_doc_key(doc): doc.doc_id for doc in self.db.all() if "reddit_id" in doc}
+        logging.info(f"Indexed {len(self._index)} mirrored threads from {self.db_path}")
+
+    def insert(self, thread: dict) -> int:
+        with self._lock:
+            doc_id = self.db.insert(thread)
+            self._add_to_index(_doc_key(thread), doc_id)
+            return doc_id
+
+    def _insert_many(self, threads: List[dict]) -> None:
+        # a single write of the database file for the whole batch
+        for thread, doc_id in zip(threads, self.db.insert_multiple(threads)):
+            self._add_to_index(_doc_key(thread), doc_id)
+
+    def remove(self, key: str) -> bool:
+        with self._lock:
+            doc_id = self._index.pop(key, None)
+            if doc_id is None:
+                return False
+            self.db.remove(doc_ids=[doc_id])
+            return True
+
+    def all(self) -> List[dict]:
+        with self._lock:
+            return self.db.all()
+
+    def close(self) -> None:
+        with self._lock:
+            self.db.close()
+
+
+class JournalThreadStore(ThreadStore):
+    # append-only storage: each insert appends one JSONL record to a journal next to
+    # the snapshot and fsyncs it, instead of rewriting the whole JSON document.
+    # the journal is folded into the snapshot every `compact_every` inserts and on close.
+    # the snapshot keeps the TinyDB layout, so it can still be opened with TinyDB.
+
+    table: str = "_default"
+
+    def __init__(self, db_path: str, compact_every: int = 100):
+        super().__init__()
+        self.db_path = db_path
+        self.journal_path = f"{db_path}.journal"
+        self.compact_every = compact_every
+        self._docs: Dict[int, dict] = {}
+        self._last_id = 0
+        self._pending = 0
+        self._torn = False
+
+        self._load()
+        # a torn last line is dropped along with the journal, or the next record would be appended to it
+        if self._pending or self._torn:
+            self.compact()
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def _load(self) -> None:
+        if os.path.exists(self.db_path) and os.path.getsize(self.db_path) > 0:
+            with open(self.db_path, encoding="utf-8") as f:
+                table = json.load(f).get(self.table, {})
+            self._docs = {int(doc_id): doc for doc_id, doc in table.items()}
+
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a torn write from a crash can only be the last line
+                        logging.warning(f"Skipping a corrupt record in {self.journal_path}")
+                        self._torn = True
+                        continue
+                    self._torn = self._torn or not line.endswith("\n")
+                    self._replay(record)
+                    self._pending += 1
+
+        self._last_id = max(self._docs, default=0)
+        self._index = {_doc_key(doc): doc_id for doc_id, doc in self._docs.items() if "reddit_id" in doc}
+        logging.info(f"Indexed {len(self._index)} mirrored threads from {self.db_path}")
+
+    def _replay(self, record: dict) -> None:
+        if record["op"] == "insert":
+            self._docs[record["doc_id"]] = record["doc"]
+        elif record["op"] == "remove":
+            self._docs.pop(record["doc_id"], None)
+
+    def _append(self, *records: dict) -> None:
+        self._journal.write("".join(json.dumps(record) + "\n" for record in records))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._pending += len(records)
+
+    def insert(self, thread: dict) -> int:
+        with self._lock:
+            self._last_id += 1
+            doc_id = self._last_id
+            self._append({"op": "insert", "doc_id": doc_id, "doc": thread})
+            self._docs[doc_id] = dict(thread)
+            self._add_to_index(_doc_key(thread), doc_id)
+
+            if self.compact_every and self._pending >= self.compact_every:
+                self.compact()
+            return doc_id
+
+    def _insert_many(self, threads: List[dict]) -> None:
+        # a single journal write and fsync for the whole batch, compacted at most once after it
+        doc_ids = range(self._last_id + 1, self._last_id + len(threads) + 1)
+        self._append(*({"op": "insert", "doc_id": doc_id, "doc": t} for doc_id, t in zip(doc_ids, threads)))
+        self._last_id += len(threads)
+        for doc_id, thread in zip(doc_ids, threads):
+            self._docs[doc_id] = dict(thread)
+            self._add_to_index(_doc_key(thread), doc_id)
+
+        if self.compact_every and self._pending >= self.compact_every:
+            self.compact()
+
+    def remove(self, key: str) -> bool:
+        with self._lock:
+            doc_id = self._index.pop(key, None)
+            if doc_id is None:
+                return False
+            self._append({"op": "remove", "doc_id": doc_id})
+            self._docs.pop(doc_id, None)
+            return True
+
+    def all(self) -> List[dict]:
+        with self._lock:
+            return [dict(doc) for doc in self._docs.values()]
+
+    def compact(self) -> None:
+        with self._lock:
+            tmp_path = f"{self.db_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({self.table: {str(doc_id): doc for doc_id, doc in self._docs.items()}}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.db_path)
+
+            # the snapshot now holds everything, so the journal can start over
+            with open(self.journal_path, "w", encoding="utf-8"):
+                pass
+            logging.info(f"Compacted {self._pending} journal records into {self.db_path}")
+            self._pending = 0
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._pending:
+                self.compact()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._journal.closed:
+                return
+            self.flush()
+            self._journal.close()
+
+
+class ScopedThreadStore(ThreadStore):
+    # the threads of one mirror pair in a store shared by all pairs.
+    # lookups and inserts take a plain reddit_id and are scoped to the pair.
+    # with `include_unpaired`, the threads stored without a pair count as the pair's too
+
+    def __init__(self, store: ThreadStore, pair: str, include_unpaired: bool = False):
+        super().__init__()
+        self.store = store
+        self.pair = pair
+        self.include_unpaired = include_unpaired
+
+    @property
+    def bloom(self) -> Union[BloomFilter, None]:
+        return self.store.bloom
+
+    @property
+    def lookups_saved(self) -> int:
+        return self.store.lookups_saved
+
+    def contains(self, reddit_id: str) -> bool:
+        if self.store.contains(thread_key(reddit_id, self.pair)):
+            return True
+        return self.include_unpaired and self.store.contains(reddit_id)
+
+    def insert(self, thread: dict) -> int:
+        return self.store.insert(dict(thread, pair=self.pair))
+
+    def remove(self, reddit_id: str) -> bool:
+        if self.store.remove(thread_key(reddit_id, self.pair)):
+            return True
+        return self.include_unpaired and self.store.remove(reddit_id)
+
+    def merge(self, threads: Iterable[dict]) -> int:
+        return self.store.merge(dict(thread, pair=self.pair) for thread in threads)
+
+    def all(self) -> List[dict]:
+        return [
+            doc
+            for doc in self.store.all()
+            if doc.get("pair") == self.pair or (self.include_unpaired and doc.get("pair") is None)
+        ]
+
+    def flush(self) -> None:
+        self.store.flush()
+
+    def close(self) -> None:
+        # the shared store is closed by its owner
+        pass
+
+    def __len__(self) -> int:
+        # counted from the keys of the shared index, without reading the threads
+        prefix = thread_key("", self.pair)
+        with self.store._lock:
+            return sum(
+                1 for key in self.store._index if key.startswith(prefix) or (self.include_unpaired and "/" not in key)
+            )
+
+
+def open_thread_store(db_path: str, storage: str = "json", compact_every: int = 100) -> ThreadStore:
+    if storage == "journal":
+        return JournalThreadStore(db_path, compact_every=compact_every)
+    return TinyDBThreadStore(db_path)
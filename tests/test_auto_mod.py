@@ -1,6 +1,7 @@
 from unittest import mock
 
-from src.auto_mod import AutoMod, LemmyThread
+from src.auto_mod import AutoMod, AutoModState, LemmyThread
+from src.ratelimit import TokenBucket
 from tests import items
 
 
@@ -23,3 +24,175 @@ class TestClassAutoMod:
         mock_lemmy.comment.distinguish.return_value = True
         auto_mod = AutoMod(mock_lemmy, "world", "TestModBot")
         assert auto_mod._comment_as_mod(content="Test Content", post_id=123) == 1
+
+    def test__find_new_threads_above_high_water_mark(self):
+        mock_lemmy = mock.MagicMock()
+        mock_lemmy.post.list.return_value = [
+            items.thread_list_response_lemmy_saved,
+            items.thread_list_response_lemmy_unsaved,
+        ]
+        state = AutoModState()
+        state.set("world", 4)
+
+        auto_mod = AutoMod(mock_lemmy, "world", "TestModBot", state=state, use_saved_flag=False)
+        assert [t.post_id for t in auto_mod._find_new_threads()] == [5]
+
+    def test__find_new_threads_without_mark_or_saved_flag(self):
+        mock_lemmy = mock.MagicMock()
+        mock_lemmy.post.list.return_value = [
+            items.thread_list_response_lemmy_saved,
+            items.thread_list_response_lemmy_unsaved,
+        ]
+        state = AutoModState()
+
+        auto_mod = AutoMod(mock_lemmy, "world", "TestModBot", state=state, use_saved_flag=False)
+        assert auto_mod._find_new_threads() == []
+        assert state.get("world") == 5
+
+    def test_comment_on_new_threads_sets_high_water_mark(self, tmp_path):
+        mock_lemmy = mock.MagicMock()
+        mock_lemmy.post.list.return_value = [items.thread_list_response_lemmy_unsaved]
+        path = str(tmp_path / "automod_state.json")
+
+        auto_mod = AutoMod(mock_lemmy, "world", "TestModBot", state=AutoModState(path), use_saved_flag=False)
+        auto_mod.comment_on_new_threads()
+
+        assert AutoModState(path).get("world") == 3
+        mock_lemmy.post.save.assert_not_called()
+        assert auto_mod._find_new_threads() == []
+
+    def test__find_new_threads_pages_until_high_water_mark(self):
+        def new_post(post_id):
+            return items.thread_list_response_lemmy_unsaved | {
+                "post": items.thread_list_response_lemmy_unsaved["post"] | {"id": post_id}
+            }
+
+        pages = {1: [new_post(i) for i in (10, 9)], 2: [new_post(i) for i in (8, 7)], 3: [new_post(i) for i in (6, 5)]}
+        mock_lemmy = mock.MagicMock()
+        mock_lemmy.post.list.side_effect = lambda page, **kwargs: pages.get(page, [])
+        state = AutoModState()
+        state.set("world", 7)
+
+        auto_mod = AutoMod(mock_lemmy, "world", "TestModBot", state=state, page_size=2)
+        assert [t.post_id for t in auto_mod._find_new_threads()] == [10, 9, 8]
+        assert mock_lemmy.post.list.call_count == 2
+
+    def test__find_new_threads_max_pages(self):
+        mock_lemmy = mock.MagicMock()
+        mock_lemmy.post.list.return_value = [items.thread_list_response_lemmy_unsaved]
+
+        auto_mod = AutoMod(mock_lemmy, "world", "TestModBot", page_size=1, max_pages=3)
+        auto_mod._find_new_threads()
+        assert mock_lemmy.post.list.call_count == 3
+
+    def test__find_new_threads_drains_backlog_from_oldest_pages(self, tmp_path):
+        def new_post(post_id):
+            return items.thread_list_response_lemmy_unsaved | {
+                "post": items.thread_list_response_lemmy_unsaved["post"] | {"id": post_id}
+            }
+
+        posts = [new_post(i) for i in range(10, 2, -1)]
+        mock_lemmy = mock.MagicMock()
+        mock_lemmy.post.list.side_effect = lambda page, limit, **kwargs: posts[(page - 1) * limit : page * limit]
+        path = str(tmp_path / "automod_state.json")
+        state = AutoModState(path)
+        state.set("world", 3)
+
+        auto_mod = AutoMod(mock_lemmy, "world", "TestModBot", state=state, page_size=2, max_pages=2)
+        # pages 1-2 do not reach the mark, nothing is processed and the mark stays
+        assert auto_mod._find_new_threads() == []
+        assert state.get("world") == 3
+        assert AutoModState(path).resume_page("world") == 3
+
+        # pages 3-4 reach it, the oldest posts come first and the newer pages are read on the next runs
+        assert sorted(t.post_id for t in auto_mod._find_new_threads()) == [4, 5, 6]
+        state.set("world", 6)
+        assert sorted(t.post_id for t in auto_mod._find_new_threads()) == [7, 8]
+        state.set("world", 8)
+        assert sorted(t.post_id for t in auto_mod._find_new_threads()) == [9, 10]
+        assert state.resume_page("world") == 1
+
+    def test_comment_on_new_threads_time_budget(self):
+        mock_lemmy = mock.MagicMock()
+        mock_lemmy.post.list.return_value = [items.thread_list_response_lemmy_unsaved]
+        state = AutoModState()
+
+        auto_mod = AutoMod(mock_lemmy, "world", "TestModBot", state=state, time_budget=-1)
+        auto_mod.comment_on_new_threads()
+        mock_lemmy.comment.create.assert_not_called()
+        assert state.get("world") is None
+
+    def test_comment_on_new_threads_skips_when_limiter_outlasts_budget(self):
+        mock_lemmy = mock.MagicMock()
+        mock_lemmy.post.list.return_value = [items.thread_list_response_lemmy_unsaved]
+        state = AutoModState()
+        limiter = TokenBucket(rate=0.001, burst=1)
+        limiter.acquire()
+
+        auto_mod = AutoMod(mock_lemmy, "world", "TestModBot", state=state, time_budget=1, limiter=limiter)
+        auto_mod.comment_on_new_threads()
+        mock_lemmy.comment.create.assert_not_called()
+        assert state.get("world") is None
+        assert limiter.acquired == 1
+
+    def test__comment_as_mod_create_fails(self):
+        mock_lemmy = mock.MagicMock()
+        mock_lemmy.comment.create.side_effect = Exception("Test")
+        auto_mod = AutoMod(mock_lemmy, "world", "TestModBot")
+        assert auto_mod._comment_as_mod(content="Test Content", post_id=123) is None
+        mock_lemmy.comment.distinguish.assert_not_called()
+        assert auto_mod.stats["create"].failures == 1
+
+    def test_comment_on_new_threads_failure_does_not_stop_batch(self):
+        def new_post(post_id):
+            return items.thread_list_response_lemmy_unsaved | {
+                "post": items.thread_list_response_lemmy_unsaved["post"] | {"id": post_id}
+            }
+
+        def create(post_id, **kwargs):
+            if post_id == 2:
+                raise Exception("Test")
+            return {"comment_view": {"comment": {"id": post_id * 10}}}
+
+        mock_lemmy = mock.MagicMock()
+        mock_lemmy.post.list.return_value = [new_post(i) for i in (3, 2, 1)]
+        mock_lemmy.comment.create.side_effect = create
+        state = AutoModState()
+
+        auto_mod = AutoMod(mock_lemmy, "world", "TestModBot", state=state, max_in_flight=3)
+        auto_mod.comment_on_new_threads()
+
+        assert mock_lemmy.comment.create.call_count == 3
+        assert sorted(c.kwargs["comment_id"] for c in mock_lemmy.comment.distinguish.call_args_list) == [10, 30]
+        assert sorted(c.kwargs["post_id"] for c in mock_lemmy.post.save.call_args_list) == [1, 3]
+        assert auto_mod.stats["create"].calls == 3
+        assert auto_mod.stats["create"].failures == 1
+        # the mark moves on, the failed thread is kept for the next run
+        assert state.get("world") == 3
+        assert state.retries("world") == {2: 1}
+
+        # the next run retries the failed thread only
+        mock_lemmy.comment.create.reset_mock(side_effect=True)
+        mock_lemmy.comment.create.return_value = {"comment_view": {"comment": {"id": 20}}}
+        auto_mod.comment_on_new_threads()
+        assert [c.kwargs["post_id"] for c in mock_lemmy.comment.create.call_args_list] == [2]
+        assert state.retries("world") == {}
+
+    def test_comment_on_new_threads_gives_up_after_max_retries(self, tmp_path):
+        mock_lemmy = mock.MagicMock()
+        mock_lemmy.post.list.return_value = [items.thread_list_response_lemmy_unsaved]
+        mock_lemmy.comment.create.side_effect = Exception("Test")
+        path = str(tmp_path / "automod_state.json")
+
+        for attempt in range(1, 3):
+            auto_mod = AutoMod(mock_lemmy, "world", "TestModBot", state=AutoModState(path), max_retries=2)
+            auto_mod.comment_on_new_threads()
+            assert AutoModState(path).retries("world") == ({3: 1} if attempt == 1 else {})
+        assert mock_lemmy.comment.create.call_count == 2
+
+    def test_state_reads_marks_without_retries(self, tmp_path):
+        path = tmp_path / "automod_state.json"
+        path.write_text('{"world": 7}')
+        state = AutoModState(str(path))
+        assert state.get("world") == 7
+        assert state.retries("world") == {}
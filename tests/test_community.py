@@ -0,0 +1,49 @@
+from unittest import mock
+
+from src.community import CommunityCache
+
+
+class TestClassCommunityCache:
+    def test_resolve_is_cached(self):
+        cache = CommunityCache()
+        mock_lemmy = mock.MagicMock()
+        mock_lemmy.discover_community.return_value = 42
+        assert cache.resolve(mock_lemmy, "world") == 42
+        assert cache.resolve(mock_lemmy, "world") == 42
+        assert mock_lemmy.discover_community.call_count == 1
+
+    def test_not_found_is_not_cached(self):
+        cache = CommunityCache()
+        mock_lemmy = mock.MagicMock()
+        mock_lemmy.discover_community.return_value = None
+        cache.resolve(mock_lemmy, "world")
+        cache.resolve(mock_lemmy, "world")
+        assert mock_lemmy.discover_community.call_count == 2
+
+    def test_ttl(self):
+        cache = CommunityCache(ttl=-1)
+        mock_lemmy = mock.MagicMock()
+        cache.resolve(mock_lemmy, "world")
+        cache.resolve(mock_lemmy, "world")
+        assert mock_lemmy.discover_community.call_count == 2
+
+    def test_invalidate_on_not_found(self):
+        cache = CommunityCache()
+        mock_lemmy = mock.MagicMock()
+        mock_lemmy._known_communities = {"world": 42}
+        cache.resolve(mock_lemmy, "world")
+
+        assert not cache.invalidate_on_not_found(mock_lemmy, "world", Exception("rate_limit_error"))
+        assert cache.invalidate_on_not_found(mock_lemmy, "world", Exception("404 Client Error"))
+        assert mock_lemmy._known_communities == {}
+
+        cache.resolve(mock_lemmy, "world")
+        assert mock_lemmy.discover_community.call_count == 2
+
+    def test_sessions_are_separate(self):
+        cache = CommunityCache()
+        first, second = mock.MagicMock(), mock.MagicMock()
+        first.discover_community.return_value = 1
+        second.discover_community.return_value = 2
+        assert cache.resolve(first, "world") == 1
+        assert cache.resolve(second, "world") == 2
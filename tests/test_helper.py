@@ -1,17 +1,25 @@
 import os
+import threading
+import time
 from unittest import mock
 
+import filestack.utils
 import pytest
+import requests
 from filestack import Client, Filelink
 from filestack.exceptions import FilestackHTTPError
 from tinydb import TinyDB
 
+from src import helper
 from src.helper import (
+    BackupCodec,
+    Compression,
     Config,
     DataBase,
     FileDownloadError,
     FileUploadError,
     RedditThread,
+    StorageType,
     Util,
 )
 from tests import items
@@ -32,6 +40,47 @@ class TestClassHelper:
             RedditThread.nsfw,
         ]
 
+    def test_check_configs_backup_compression(self):
+        c = Config(items.full_config)
+        assert c.BACKUP_COMPRESSION == Compression.none
+        assert c.FILESTACK_HANDLE_DELTA is None
+        assert Config(items.full_config | {"BACKUP_COMPRESSION": "gzip"}).BACKUP_COMPRESSION == Compression.gzip
+
+    def test_check_configs_single_mirror_pair(self):
+        c = Config(items.full_config)
+        assert len(c.MIRROR_PAIRS) == 1
+        assert c.MIRROR_PAIRS[0].name is None
+        assert c.MIRROR_PAIRS[0].subreddit == c.REDDIT_SUBREDDIT
+        assert c.MIRROR_PAIRS[0].cap == c.REDDIT_CAP_NUMBER_OF_MIRRORED_THREADS
+
+    def test_check_configs_mirror_pairs(self):
+        pairs = (
+            '[{"subreddit": "Pics", "community": "pics", "ignore": "nsfw", "cap": 2},'
+            ' {"subreddit": "news", "community": "world", "filter": "hot", "ignore": []}]'
+        )
+        c = Config(items.full_config | {"MIRROR_PAIRS": pairs})
+        assert [p.name for p in c.MIRROR_PAIRS] == ["pics:pics", "news:world"]
+        assert c.MIRROR_PAIRS[0].ignore_thread_types == [RedditThread.nsfw]
+        assert c.MIRROR_PAIRS[0].cap == 2
+        assert c.MIRROR_PAIRS[1].filter == "hot"
+        assert c.MIRROR_PAIRS[1].ignore_thread_types == []
+        assert c.MIRROR_PAIRS[1].limit == c.REDDIT_FILTER_THREAD_LIMIT
+        assert not any(p.unpaired for p in c.MIRROR_PAIRS)
+
+    def test_check_configs_mirror_pairs_from_single_pair(self):
+        pairs = '[{"subreddit": "pics", "community": "pics"}, {"subreddit": "All", "community": "bot_test"}]'
+        c = Config(items.full_config | {"MIRROR_PAIRS": pairs})
+        assert [p.unpaired for p in c.MIRROR_PAIRS] == [False, True]
+
+    def test_check_configs_mirror_pairs_unique_names(self):
+        pairs = '[{"subreddit": "pics", "community": "pics"}, {"subreddit": "Pics", "community": "Pics"}]'
+        with pytest.raises(AssertionError):
+            Config(items.full_config | {"MIRROR_PAIRS": pairs})
+
+    def test_check_configs_database_storage(self):
+        assert Config(items.full_config).DATABASE_STORAGE == StorageType.json
+        assert Config(items.full_config | {"DATABASE_STORAGE": "journal"}).DATABASE_STORAGE == StorageType.journal
+
 
 @pytest.mark.parametrize("test_filestack", [DataBase("tests/filestack_tests.txt")])
 class TestClassDataBase:
@@ -48,6 +97,15 @@ class TestClassDataBase:
                 file = test_filestack._upload_backup(c.FILESTACK_APP_SECRET, c.FILESTACK_API_KEY, "test.json")
                 assert file
 
+    def test__upload_backup_is_timed(self, test_filestack):
+        c = Config(items.full_config)
+        uploads = helper.metrics.FILESTACK_SECONDS.labels("upload")
+        before = sum(uploads.counts)
+        with mock.patch.object(Client, "upload", return_value=None):
+            with pytest.raises(FileUploadError):
+                test_filestack._upload_backup(c.FILESTACK_APP_SECRET, c.FILESTACK_API_KEY, "test.json")
+        assert sum(uploads.counts) == before + 1
+
     def test_get_backup_bad_apikey_app_key_fail(self, test_filestack):
         c = Config(items.full_config)
 
@@ -106,3 +164,207 @@ class TestClassUtil:
 
     def test__check_if_image_bad_input(self):
         assert Util._check_if_image(123) is None
+
+
+class TestClassDataBaseSync:
+    def test_refresh_backup_skips_unchanged_file(self, tmp_path):
+        c = Config(items.full_config)
+        db_path = tmp_path / "db.json"
+        db_path.write_text('{"_default": {}}')
+        database = DataBase(str(db_path))
+
+        with mock.patch.object(Filelink, "overwrite", return_value=True) as overwrite, mock.patch.object(
+            Filelink, "metadata", return_value={"filename": "db.json"}
+        ):
+            database.refresh_backup(c.FILESTACK_APP_SECRET, c.FILESTACK_API_KEY, c.FILESTACK_HANDLE_REFRESH)
+            assert (
+                database.refresh_backup(c.FILESTACK_APP_SECRET, c.FILESTACK_API_KEY, c.FILESTACK_HANDLE_REFRESH) is None
+            )
+            assert overwrite.call_count == 1
+            assert database.bytes_saved == len('{"_default": {}}')
+
+            # a different handle has not seen this content yet
+            database.refresh_backup(c.FILESTACK_APP_SECRET, c.FILESTACK_API_KEY, c.FILESTACK_HANDLE_BACKUP)
+            assert overwrite.call_count == 2
+
+            db_path.write_text('{"_default": {"1": {"reddit_id": "t3_1"}}}')
+            database.refresh_backup(c.FILESTACK_APP_SECRET, c.FILESTACK_API_KEY, c.FILESTACK_HANDLE_REFRESH)
+            assert overwrite.call_count == 3
+
+    def test_get_backup_marks_handle_as_synced(self, tmp_path):
+        c = Config(items.full_config)
+        db_path = tmp_path / "db.json"
+        db_path.write_text('{"_default": {}}')
+        database = DataBase(str(db_path))
+
+        with mock.patch.object(Filelink, "download", return_value=16), mock.patch.object(
+            Filelink, "overwrite", return_value=True
+        ) as overwrite:
+            database.get_backup(c.FILESTACK_APP_SECRET, c.FILESTACK_API_KEY, c.FILESTACK_HANDLE_REFRESH)
+            database.refresh_backup(c.FILESTACK_APP_SECRET, c.FILESTACK_API_KEY, c.FILESTACK_HANDLE_REFRESH)
+            overwrite.assert_not_called()
+
+
+class TestClassBackupCodec:
+    db = {"_default": {"1": {"reddit_id": "t3_1"}, "2": {"reddit_id": "t3_2"}}}
+
+    def test_gzip_round_trip(self):
+        codec = BackupCodec(Compression.gzip)
+        payload, _ = codec.snapshot(self.db)
+        data = codec.encode(payload)
+        assert data.startswith(codec.gzip_magic)
+        assert codec.decode(data) == payload
+
+    def test_decode_ignores_configured_compression(self):
+        payload, _ = BackupCodec().snapshot(self.db)
+        assert BackupCodec(Compression.none).decode(BackupCodec(Compression.gzip).encode(payload)) == payload
+
+    def test_restore_legacy_plain_file(self):
+        codec = BackupCodec(Compression.gzip)
+        db, state = codec.restore(codec.decode(b'{"_default": {"1": {"reddit_id": "t3_1"}}}'))
+        assert db == {"_default": {"1": {"reddit_id": "t3_1"}}}
+        assert state is None
+
+    def test_restore_snapshot_with_delta(self):
+        codec = BackupCodec()
+        payload, state = codec.snapshot(self.db)
+        assert state.last_doc_id == 2
+
+        newer = {"_default": self.db["_default"] | {"3": {"reddit_id": "t3_3"}}}
+        delta = codec.delta(newer, state)
+        assert delta["records"] == {"3": {"reddit_id": "t3_3"}}
+
+        db, restored = codec.restore(payload, delta)
+        assert db == newer
+        assert restored.snapshot_id == state.snapshot_id
+
+    def test_restore_ignores_delta_of_other_snapshot(self):
+        codec = BackupCodec()
+        payload, state = codec.snapshot(self.db)
+        _, other = codec.snapshot(self.db)
+        delta = codec.delta({"_default": {"3": {"reddit_id": "t3_3"}}}, other)
+
+        db, _ = codec.restore(payload, delta)
+        assert "3" not in db["_default"]
+
+
+class TestClassDataBaseDelta:
+    def test_refresh_backup_alternates_snapshots_and_deltas(self, tmp_path):
+        c = Config(items.full_config)
+        db_path = tmp_path / "db.json"
+        db_path.write_text('{"_default": {"1": {"reddit_id": "t3_1"}}}')
+        database = DataBase(str(db_path), codec=BackupCodec(Compression.gzip), full_snapshot_every=1)
+
+        targets = []
+
+        def overwrite(self, filepath, security=None):
+            targets.append((self.handle, BackupCodec().decode(open(filepath, "rb").read())))
+            return True
+
+        with mock.patch.object(Filelink, "overwrite", overwrite), mock.patch.object(
+            Filelink, "metadata", return_value={"filename": "db.json"}
+        ):
+            args = (c.FILESTACK_APP_SECRET, c.FILESTACK_API_KEY, "refresh")
+            database.refresh_backup(*args, delta_handle="delta")
+            db_path.write_text('{"_default": {"1": {"reddit_id": "t3_1"}, "2": {"reddit_id": "t3_2"}}}')
+            database.refresh_backup(*args, delta_handle="delta")
+            db_path.write_text('{"_default": {"1": {"reddit_id": "t3_1"}, "3": {"reddit_id": "t3_3"}}}')
+            database.refresh_backup(*args, delta_handle="delta")
+
+        assert [(handle, payload["format"]) for handle, payload in targets] == [
+            ("refresh", "snapshot"),
+            ("delta", "delta"),
+            ("refresh", "snapshot"),
+        ]
+        assert targets[1][1]["records"] == {"2": {"reddit_id": "t3_2"}}
+        assert targets[1][1]["snapshot_id"] == targets[0][1]["snapshot_id"]
+
+    def test_get_backup_applies_delta(self, tmp_path):
+        c = Config(items.full_config)
+        codec = BackupCodec(Compression.gzip)
+        payload, state = codec.snapshot({"_default": {"1": {"reddit_id": "t3_1"}}})
+        delta = codec.delta({"_default": {"2": {"reddit_id": "t3_2"}}}, state)
+        files = {"refresh": codec.encode(payload), "delta": codec.encode(delta)}
+
+        def download(self, path, *args, **kwargs):
+            with open(path, "wb") as f:
+                f.write(files[self.handle])
+            return len(files[self.handle])
+
+        db_path = tmp_path / "db.json"
+        database = DataBase(str(db_path), codec=codec)
+        with mock.patch.object(Filelink, "download", download):
+            database.get_backup(c.FILESTACK_APP_SECRET, c.FILESTACK_API_KEY, "refresh", delta_handle="delta")
+
+        assert {doc["reddit_id"] for doc in TinyDB(db_path).all()} == {"t3_1", "t3_2"}
+        assert database.snapshots["refresh"].snapshot_id == state.snapshot_id
+
+
+class TestClassDataBaseClient:
+    def test_security_reused_until_close_to_expiry(self):
+        database = DataBase(policy_ttl=15 * 60, policy_refresh_margin=60)
+        security = database._get_security("secret")
+        assert database._get_security("secret") is security
+        assert database.policies_signed == 1
+
+        with mock.patch("src.helper.time.time", return_value=security.policy["expiry"] - 30):
+            renewed = database._get_security("secret")
+        assert renewed is not security
+        assert database.policies_signed == 2
+
+        assert database._get_security("other secret").secret == "other secret"
+
+    def test_client_reused_with_current_security(self):
+        database = DataBase()
+        client = database._get_client("secret", "apikey")
+        assert database._get_client("secret", "apikey") is client
+
+        database._security = None
+        assert database._get_client("secret", "apikey").security is database._security
+
+    def test_filestack_requests_use_pooled_session(self, tmp_path):
+        seen = []
+
+        def filelink(handle, security=None):
+            seen.append(filestack.utils.original_requests.get)
+            return mock.MagicMock(**{"download.return_value": None})
+
+        with mock.patch("src.helper.Filelink", filelink):
+            with pytest.raises(FileDownloadError):
+                DataBase(db_path=str(tmp_path / "db.json")).get_backup("secret", "apikey", "handle")
+
+        assert seen == [helper.filestack_session.get]
+        # the requests module is only swapped out while filestack is used
+        assert filestack.utils.original_requests is requests
+
+    def test_filestack_calls_are_serialised(self, tmp_path):
+        active, overlaps = [], []
+
+        def filelink(handle, security=None):
+            active.append(handle)
+            overlaps.append(len(active))
+            time.sleep(0.05)
+            active.remove(handle)
+            return mock.MagicMock(**{"download.return_value": None})
+
+        def get_backup(handle):
+            with pytest.raises(FileDownloadError):
+                DataBase(db_path=str(tmp_path / f"{handle}.json")).get_backup("secret", "apikey", handle)
+
+        with mock.patch("src.helper.Filelink", filelink):
+            threads = [threading.Thread(target=get_backup, args=(f"handle{i}",)) for i in range(3)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        assert overlaps == [1, 1, 1]
+        assert filestack.utils.original_requests is requests
+
+    def test_filestack_without_original_requests(self, tmp_path, monkeypatch):
+        monkeypatch.delattr(filestack.utils, "original_requests")
+        with mock.patch("src.helper.Filelink") as filelink:
+            filelink.return_value.download.return_value = None
+            with pytest.raises(FileDownloadError):
+                DataBase(db_path=str(tmp_path / "db.json")).get_backup("secret", "apikey", "handle")
+        assert not hasattr(filestack.utils, "original_requests")
@@ -0,0 +1,141 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.media import ContentTypeCache, MediaClassifier, MediaRules
+from tests import items
+
+
+class _HeadHandler(BaseHTTPRequestHandler):
+    # /image/<delay> answers with an image content type after <delay> seconds
+    def do_HEAD(self):
+        kind, delay = self.path.strip("/").split("/")
+        time.sleep(float(delay))
+        self.send_response(200)
+        self.send_header("content-type", "image/png" if kind == "image" else "text/html")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def head_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _HeadHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+class TestClassMediaClassifier:
+    def test_check_image(self, head_server):
+        classifier = MediaClassifier()
+        assert classifier.check_image(f"{head_server}/image/0") == f"{head_server}/image/0"
+        assert classifier.check_image(f"{head_server}/page/0") is None
+
+    def test_check_image_bad_input(self):
+        assert MediaClassifier().check_image(123) is None
+
+    def test_check_image_timeout(self, head_server):
+        assert MediaClassifier(timeout=0.1).check_image(f"{head_server}/image/1") is None
+
+    def test_check_images_concurrently(self, head_server):
+        classifier = MediaClassifier(max_workers=10)
+        urls = [f"{head_server}/image/0.{i}" for i in range(1, 10)] + [f"{head_server}/page/0.3", None]
+
+        start = time.monotonic()
+        results = classifier.check_images(urls)
+        # the slowest url takes 0.9 seconds, one after another would take 4.8
+        assert time.monotonic() - start < 2.5
+
+        assert len(results) == 10
+        assert results[f"{head_server}/image/0.5"] == f"{head_server}/image/0.5"
+        assert results[f"{head_server}/page/0.3"] is None
+
+    def test_check_images_deadline(self, head_server):
+        classifier = MediaClassifier(deadline=0.2)
+        results = classifier.check_images([f"{head_server}/image/0", f"{head_server}/image/1"])
+        assert results == {f"{head_server}/image/0": f"{head_server}/image/0", f"{head_server}/image/1": None}
+
+
+class TestClassContentTypeCache:
+    def test_hit_and_miss(self):
+        cache = ContentTypeCache()
+        assert cache.lookup("https://i.redd.it/a.png") == (False, None)
+        cache.store("https://i.redd.it/a.png", "image/png")
+        assert cache.lookup("https://i.redd.it/a.png") == (True, "image/png")
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_ttl(self):
+        cache = ContentTypeCache(ttl=-1, negative_ttl=60)
+        cache.store("https://i.redd.it/a.png", "image/png")
+        cache.store("https://example.com/down", None)
+        assert cache.lookup("https://i.redd.it/a.png") == (False, None)
+        assert cache.lookup("https://example.com/down") == (True, None)
+
+    def test_lru_eviction(self):
+        cache = ContentTypeCache(max_entries=2)
+        cache.store("a", "image/png")
+        cache.store("b", "image/png")
+        cache.lookup("a")
+        cache.store("c", "text/html")
+        assert cache.lookup("b") == (False, None)
+        assert cache.lookup("a") == (True, "image/png")
+        assert len(cache) == 2
+
+    def test_persisted(self, tmp_path):
+        path = str(tmp_path / "content_types.json")
+        cache = ContentTypeCache(path)
+        cache.store("a", "image/png")
+        cache.save()
+        assert ContentTypeCache(path).lookup("a") == (True, "image/png")
+
+    def test_classifier_uses_cache(self, head_server):
+        classifier = MediaClassifier(cache=ContentTypeCache())
+        urls = [f"{head_server}/image/0", f"{head_server}/page/0"]
+        first = classifier.check_images(urls)
+        assert classifier.check_images(urls) == first
+        assert classifier.cache.hits == 2
+
+    def test_failures_are_cached(self):
+        classifier = MediaClassifier(timeout=0.1, cache=ContentTypeCache())
+        assert classifier.check_image("http://127.0.0.1:1/a.png") is None
+        assert classifier.cache.lookup("http://127.0.0.1:1/a.png") == (True, None)
+
+
+class TestClassMediaRules:
+    @pytest.mark.parametrize(
+        "url, expected",
+        [
+            ("https://i.redd.it/abc123.jpg", True),
+            ("https://i.imgur.com/abc123.PNG", True),
+            ("https://i.imgur.com/abc123.gifv", None),
+            ("https://v.redd.it/abc123", False),
+            ("https://www.reddit.com/gallery/abc123", False),
+            ("https://imgur.com/abc123", False),
+            ("https://youtu.be/some_vid?si=ergdfg", False),
+            ("https://example.com/cat.png", None),
+            (None, None),
+        ],
+    )
+    def test_classify(self, url, expected):
+        assert MediaRules().classify(url) is expected
+
+    def test_custom_rules(self, tmp_path):
+        path = tmp_path / "rules.json"
+        path.write_text('{"image_domains": ["pngimg.com"], "non_image_domains": ["example.com"]}')
+        rules = MediaRules.from_file(str(path))
+        assert rules.classify(items.cat_image) is True
+        assert rules.classify(items.not_image) is False
+        assert rules.classify("https://i.redd.it/abc123.jpg") is None
+
+    def test_classifier_skips_requests(self):
+        classifier = MediaClassifier(rules=MediaRules(), cache=ContentTypeCache())
+        results = classifier.check_images(["https://i.redd.it/abc123.jpg", "https://v.redd.it/abc123"])
+        assert results == {
+            "https://i.redd.it/abc123.jpg": "https://i.redd.it/abc123.jpg",
+            "https://v.redd.it/abc123": None,
+        }
+        assert classifier.cache.misses == 0
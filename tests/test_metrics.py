@@ -0,0 +1,91 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+from src import metrics
+from src.metrics import Counter, Histogram, Registry, start_metrics_server
+
+
+class TestClassMetrics:
+    def _registry(self, monkeypatch):
+        registry = Registry()
+        monkeypatch.setattr(metrics, "registry", registry)
+        return registry
+
+    def test_counter(self, monkeypatch):
+        registry = self._registry(monkeypatch)
+        posts = Counter("posts_total", "Posts.", ["result"])
+        posts.labels("created").inc()
+        posts.labels("created").inc(2)
+        posts.labels("failed").inc()
+
+        assert posts.value("created") == 3
+        assert registry.render() == (
+            "# HELP posts_total Posts.\n"
+            "# TYPE posts_total counter\n"
+            'posts_total{result="created"} 3\n'
+            'posts_total{result="failed"} 1\n'
+        )
+
+    def test_counter_wrong_labels(self, monkeypatch):
+        self._registry(monkeypatch)
+        posts = Counter("posts_total", "Posts.", ["result"])
+        with pytest.raises(ValueError):
+            posts.labels("created", "extra")
+
+    def test_duplicate_metric(self, monkeypatch):
+        self._registry(monkeypatch)
+        Counter("posts_total", "Posts.")
+        with pytest.raises(ValueError):
+            Counter("posts_total", "Posts.")
+
+    def test_metric_is_abstract(self, monkeypatch):
+        self._registry(monkeypatch)
+        with pytest.raises(TypeError):
+            metrics._Metric("posts_total", "Posts.")
+
+    def test_histogram(self, monkeypatch):
+        registry = self._registry(monkeypatch)
+        latency = Histogram("latency_seconds", "Latency.", buckets=(0.1, 1))
+        latency.observe(0.05)
+        latency.observe(0.1)
+        latency.observe(0.5)
+        latency.observe(5)
+
+        lines = registry.render().splitlines()
+        assert 'latency_seconds_bucket{le="0.1"} 2' in lines
+        assert 'latency_seconds_bucket{le="1.0"} 3' in lines
+        assert 'latency_seconds_bucket{le="+Inf"} 4' in lines
+        assert "latency_seconds_sum 5.65" in lines
+        assert "latency_seconds_count 4" in lines
+
+    def test_histogram_time_records_on_error(self, monkeypatch):
+        self._registry(monkeypatch)
+        latency = Histogram("latency_seconds", "Latency.", ["call"])
+        with pytest.raises(RuntimeError):
+            with latency.labels("post_create").time():
+                raise RuntimeError("Lemmy is down")
+        assert latency.labels("post_create").counts[0] == 1
+
+    def test_label_values_are_escaped(self, monkeypatch):
+        registry = self._registry(monkeypatch)
+        Counter("listings_total", "Listings.", ["subreddit"]).labels('a"b').inc()
+        assert 'listings_total{subreddit="a\\"b"} 1' in registry.render()
+
+    def test_metrics_server(self):
+        metrics.POSTS.labels("created").inc()
+        server = start_metrics_server(0, address="127.0.0.1")
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            with urllib.request.urlopen(f"{url}/metrics", timeout=5) as resp:
+                assert resp.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+                body = resp.read().decode()
+            assert "# TYPE lemmy_posts_total counter" in body
+            assert 'lemmy_posts_total{result="created"}' in body
+
+            with pytest.raises(urllib.error.HTTPError):
+                urllib.request.urlopen(f"{url}/other", timeout=5)
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -1,9 +1,24 @@
+import random
+import shutil
+from collections import Counter
 from unittest import mock
 
+import praw
+from praw.models import Submission
 from tinydb import Query, TinyDB
 
-from src.helper import RedditThread
-from src.mirror import _extract_threads_to_mirror, mirror_threads_to_lemmy
+from src.helper import RedditThread, ThreadSelection
+from src.media import MediaClassifier, MediaRules
+from src.mirror import (
+    ListingCheckpoint,
+    _extract_threads_to_mirror,
+    fetch_new_since,
+    iter_threads_to_mirror,
+    mirror_threads_to_lemmy,
+    sample_threads,
+    select_threads_from_reddit,
+)
+from src.ratelimit import TokenBucket
 from tests import items
 
 
@@ -94,3 +109,212 @@ class TestClassMirror:
 
         test_db.close()
         assert mirror == 1
+
+    def test_mirror_threads_to_lemmy_only_posts_are_rate_limited(self, tmp_path):
+        test_db = TinyDB(shutil.copy(items.test_db_path, tmp_path / "db.json"))
+        mock_lemmy = mock.Mock()
+        limiter = TokenBucket(rate=None)
+        mirror = mirror_threads_to_lemmy(
+            lemmy=mock_lemmy,
+            threads_to_mirror=test_db.all() + [items.thread],
+            community="fake_community",
+            DB=test_db,
+            limiter=limiter,
+        )
+
+        test_db.close()
+        assert mirror == 1
+        assert limiter.acquired == 1
+
+
+# example.com is never an image, so no HEAD requests are sent
+_classifier = MediaClassifier(rules=MediaRules(image_domains=[], non_image_domains=["example.com"]))
+
+
+def _submission(name: str):
+    submission = mock.MagicMock()
+    submission.name = name
+    submission.over_18 = False
+    submission.poll_data = False
+    submission.is_video = False
+    submission.url = f"https://example.com/{name}"
+    submission.selftext = ""
+    submission.link_flair_text = None
+    return submission
+
+
+class TestClassLazyExtraction:
+    def test_iter_threads_to_mirror_stops_reading_the_listing(self):
+        test_db = TinyDB(items.test_db_path)
+        read = []
+
+        def listing():
+            for i in range(100):
+                read.append(i)
+                yield _submission(f"t3_{i}")
+
+        threads = iter_threads_to_mirror(listing(), test_db, [RedditThread.poll], classifier=_classifier, batch_size=5)
+        assert [t["reddit_id"] for t in sample_threads(threads, 3, ThreadSelection.first)] == ["t3_0", "t3_1", "t3_2"]
+        assert len(read) == 5
+        test_db.close()
+
+    def test_sample_threads_fewer_than_cap(self):
+        threads = [{"reddit_id": "t3_1"}, {"reddit_id": "t3_2"}]
+        assert sample_threads(iter(threads), 10) == threads
+        assert sample_threads(iter(threads), 0) == []
+
+    def test_sample_threads_is_uniform(self):
+        rng = random.Random(1)
+        counts = Counter()
+        for _ in range(4000):
+            for t in sample_threads(({"reddit_id": i} for i in range(10)), 2, rng=rng):
+                counts[t["reddit_id"]] += 1
+
+        # each of the 10 threads is picked 2 / 10 of the time
+        assert all(700 < counts[i] < 900 for i in range(10))
+
+    def test_select_threads_from_reddit(self):
+        test_db = TinyDB(items.test_db_path)
+        reddit = mock.MagicMock()
+        reddit.subreddit.return_value.new.return_value = [_submission(f"t3_{i}") for i in range(3)]
+
+        threads = select_threads_from_reddit(
+            reddit, "test", test_db, cap=5, ignore_thread_types=[RedditThread.poll], classifier=_classifier
+        )
+        assert len(threads) == 3
+        test_db.close()
+
+
+class FakeNewListing:
+    # serves r/{sub}/new from a newest-first list of submissions, like reddit
+    def __init__(self, count: int):
+        self.subreddit = mock.MagicMock()
+        self.submissions = [_submission(f"t3_{i:x}") for i in range(count, 0, -1)]
+        self.requests = []
+
+    def get(self, url, params):
+        self.requests.append(dict(params))
+        names = [s.name for s in self.submissions]
+        limit = params["limit"]
+        if "before" in params:
+            if params["before"] not in names:
+                return []
+            end = names.index(params["before"])
+            return self.submissions[max(end - limit, 0) : end]
+        start = names.index(params["after"]) + 1 if "after" in params else 0
+        return self.submissions[start : start + limit]
+
+    def add(self, count: int):
+        newest = int(self.submissions[0].name[3:], 16)
+        self.submissions = [_submission(f"t3_{i:x}") for i in range(newest + count, newest, -1)] + self.submissions
+
+
+class TestClassListingCheckpoint:
+    def test_checkpoint_is_persisted_and_monotonic(self, tmp_path):
+        path = str(tmp_path / "checkpoint.json")
+        checkpoint = ListingCheckpoint(path)
+        checkpoint.set("test/new", "t3_b")
+        checkpoint.set("test/new", "t3_a")
+        assert ListingCheckpoint(path).get("test/new") == "t3_b"
+
+    def test_fetch_new_since_single_request(self):
+        reddit = FakeNewListing(50)
+        new = fetch_new_since(reddit, "test", "t3_2d")
+        assert [s.name for s in new] == ["t3_2e", "t3_2f", "t3_30", "t3_31", "t3_32"]
+        assert len(reddit.requests) == 1
+
+    def test_fetch_new_since_nothing_new(self):
+        reddit = FakeNewListing(50)
+        assert fetch_new_since(reddit, "test", "t3_32") == []
+        assert len(reddit.requests) == 2
+
+    def test_fetch_new_since_catches_up_past_a_page(self):
+        reddit = FakeNewListing(50)
+        reddit.add(250)
+        new = fetch_new_since(reddit, "test", "t3_32")
+        assert len(new) == 250
+        assert new[0].name == "t3_33"
+        assert [r.get("after") for r in reddit.requests[1:]] == [None, "t3_c9", "t3_65"]
+
+    def test_fetch_new_since_deleted_cursor(self):
+        reddit = FakeNewListing(50)
+        reddit.add(3)
+        reddit.submissions = [s for s in reddit.submissions if s.name != "t3_32"]
+        assert [s.name for s in fetch_new_since(reddit, "test", "t3_32")] == ["t3_33", "t3_34", "t3_35"]
+
+    def test_select_threads_only_reads_new_threads(self, tmp_path):
+        test_db = TinyDB(items.test_db_path)
+        reddit = FakeNewListing(30)
+        reddit.subreddit.return_value.new.side_effect = lambda limit: iter(reddit.submissions[:limit])
+        checkpoint = ListingCheckpoint(str(tmp_path / "checkpoint.json"))
+        kwargs = {
+            "ignore_thread_types": [RedditThread.poll],
+            "classifier": _classifier,
+            "checkpoint": checkpoint,
+            "selection": ThreadSelection.first,
+        }
+
+        def posted(reddit_id):
+            return True
+
+        first = select_threads_from_reddit(reddit, "test", test_db, cap=100, limit=10, **kwargs)
+        assert len(first) == 10
+        # the cursor only moves once the selected threads have been posted
+        assert checkpoint.get("test/new") is None
+        checkpoint.commit("test/new", posted)
+        assert checkpoint.get("test/new") == "t3_1e"
+
+        reddit.add(2)
+        second = select_threads_from_reddit(reddit, "test", test_db, cap=100, limit=10, **kwargs)
+        assert [t["reddit_id"] for t in second] == ["t3_1f", "t3_20"]
+        checkpoint.commit("test/new", posted)
+
+        # the first threads fill the cap, the rest are left for the next run
+        reddit.add(3)
+        assert len(select_threads_from_reddit(reddit, "test", test_db, cap=1, **kwargs)) == 1
+        checkpoint.commit("test/new", posted)
+        assert checkpoint.get("test/new") == "t3_21"
+
+        # a random draw reads the whole listing and leaves the checkpoint alone
+        kwargs["selection"] = ThreadSelection.random
+        assert len(select_threads_from_reddit(reddit, "test", test_db, cap=1, limit=10, **kwargs)) == 1
+        checkpoint.commit("test/new", posted)
+        assert checkpoint.get("test/new") == "t3_21"
+        test_db.close()
+
+    def test_checkpoint_stays_before_threads_that_were_not_posted(self, tmp_path):
+        checkpoint = ListingCheckpoint(str(tmp_path / "checkpoint.json"))
+        checkpoint.set("test/new", "t3_a")
+        checkpoint.stage("test/new", ["t3_b", "t3_c", "t3_d", "t3_e"], ["t3_b", "t3_d", "t3_e"])
+        # t3_c was rejected, t3_d failed to post
+        checkpoint.commit("test/new", lambda reddit_id: reddit_id != "t3_d")
+        assert checkpoint.get("test/new") == "t3_c"
+
+        # nothing staged, nothing moves
+        checkpoint.commit("test/new", lambda reddit_id: True)
+        assert ListingCheckpoint(str(tmp_path / "checkpoint.json")).get("test/new") == "t3_c"
+
+
+class TestClassListingRecord:
+    def _submission(self, reddit, name, **data):
+        return Submission(reddit, _data={"name": name, "id": name[3:], "title": f"Title {name}"} | data)
+
+    def test_extract_never_fetches_submissions(self):
+        test_db = TinyDB(items.test_db_path)
+        reddit = praw.Reddit(client_id="id", client_secret="secret", user_agent="test")
+        listing = [
+            self._submission(reddit, "t3_a1", url="https://example.com/a", stickied=True),
+            self._submission(reddit, "t3_a2", url="https://example.com/b", stickied=False, poll_data={"options": []}),
+            # neither stickied nor poll_data are in the payload
+            self._submission(reddit, "t3_a3", url="https://example.com/c", selftext=""),
+        ]
+
+        with mock.patch.object(Submission, "_fetch", side_effect=AssertionError("fetched")) as fetch:
+            threads = _extract_threads_to_mirror(
+                listing, test_db, [RedditThread.pinned, RedditThread.poll], classifier=_classifier
+            )
+
+        fetch.assert_not_called()
+        assert [t["reddit_id"] for t in threads] == ["t3_a3"]
+        assert threads[0]["is_pinned"] is False
+        test_db.close()
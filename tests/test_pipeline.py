@@ -0,0 +1,117 @@
+import shutil
+import time
+from unittest import mock
+
+from src.helper import RedditThread, ThreadSelection
+from src.media import MediaClassifier, MediaRules
+from src.mirror import ListingCheckpoint
+from src.pipeline import MirrorPipeline, mirror_with_pipeline
+from src.store import TinyDBThreadStore
+from tests import items
+
+
+def _submission(name: str, url: str = "https://example.com/page"):
+    submission = mock.MagicMock()
+    submission.name = name
+    submission.over_18 = False
+    submission.poll_data = False
+    submission.locked = False
+    submission.is_video = False
+    submission.url = url
+    submission.title = f"Title {name}"
+    submission.selftext = ""
+    submission.permalink = f"/r/test/comments/{name}"
+    submission.link_flair_text = None
+    return submission
+
+
+def _reddit(submissions):
+    reddit = mock.MagicMock()
+    reddit.subreddit.return_value.new.return_value = submissions
+    return reddit
+
+
+class SlowClassifier(MediaClassifier):
+    def check_image(self, url):
+        time.sleep(0.2)
+        return None
+
+
+class TestClassMirrorPipeline:
+    def _pipeline(self, store, submissions, **kwargs):
+        return MirrorPipeline(
+            _reddit(submissions),
+            mock.Mock(),
+            "test",
+            "fake_community",
+            store,
+            ignore_thread_types=[RedditThread.mirrored],
+            classifier=MediaClassifier(rules=MediaRules(image_domains=[], non_image_domains=["example.com"])),
+            **kwargs,
+        )
+
+    def test_posts_new_threads(self, tmp_path):
+        db_path = shutil.copy(items.test_db_path, tmp_path / "db.json")
+        with TinyDBThreadStore(db_path) as store:
+            mirrored = store.all()[0]["reddit_id"]
+            submissions = [_submission("t3_a"), _submission(mirrored), _submission("t3_b"), _submission("t3_a")]
+            pipeline = self._pipeline(store, submissions)
+
+            assert mirror_with_pipeline(pipeline) == 2
+            assert pipeline.lemmy.post.create.call_count == 2
+            assert pipeline.stats.duplicates == 1
+            assert "t3_a" in store and "t3_b" in store
+
+    def test_cap_stops_fetching_early(self, tmp_path):
+        fetched = []
+
+        def listing():
+            for i in range(100):
+                fetched.append(i)
+                yield _submission(f"t3_{i}")
+
+        with TinyDBThreadStore(str(tmp_path / "db.json")) as store:
+            pipeline = self._pipeline(
+                store, listing(), cap=2, queue_size=1, selection=ThreadSelection.first, batch_size=1
+            )
+            assert mirror_with_pipeline(pipeline) == 2
+            assert len(fetched) < 10
+
+    def test_failed_posts_are_not_stored(self, tmp_path):
+        with TinyDBThreadStore(str(tmp_path / "db.json")) as store:
+            pipeline = self._pipeline(store, [_submission("t3_a")])
+            pipeline.lemmy.post.create.side_effect = Exception("Lemmy is down")
+
+            assert mirror_with_pipeline(pipeline) == 0
+            assert pipeline.stats.failed == 1
+            assert "t3_a" not in store
+
+    def test_posting_overlaps_classifying(self, tmp_path):
+        with TinyDBThreadStore(str(tmp_path / "db.json")) as store:
+            submissions = [_submission(f"t3_{i}") for i in range(4)]
+            pipeline = self._pipeline(store, submissions, selection=ThreadSelection.first, batch_size=1)
+            pipeline.classifier = SlowClassifier()
+            pipeline.lemmy.post.create.side_effect = lambda **kwargs: time.sleep(0.2)
+
+            start = time.monotonic()
+            assert mirror_with_pipeline(pipeline) == 4
+            assert time.monotonic() - start < 1.4
+
+    def test_reddit_failure_posts_nothing(self, tmp_path):
+        with TinyDBThreadStore(str(tmp_path / "db.json")) as store:
+            pipeline = self._pipeline(store, [_submission("t3_a")])
+            pipeline.reddit.subreddit.side_effect = Exception("Reddit is down")
+
+            assert mirror_with_pipeline(pipeline) == 0
+            pipeline.lemmy.post.create.assert_not_called()
+
+    def test_checkpoint_is_staged_like_the_synchronous_task(self, tmp_path):
+        with TinyDBThreadStore(str(tmp_path / "db.json")) as store:
+            submissions = [_submission(n) for n in ("t3_3", "t3_2", "t3_1")]
+            checkpoint = ListingCheckpoint()
+            pipeline = self._pipeline(store, submissions, cap=2, selection=ThreadSelection.first, checkpoint=checkpoint)
+
+            # without a cursor the newest threads are read oldest first, the newest one is left for the next run
+            assert mirror_with_pipeline(pipeline) == 2
+            checkpoint.commit("test/new", store.contains)
+            assert checkpoint.get("test/new") == "t3_2"
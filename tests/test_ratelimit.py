@@ -0,0 +1,50 @@
+import threading
+import time
+
+from src.ratelimit import TokenBucket
+
+
+class TestClassTokenBucket:
+    def test_unlimited(self):
+        bucket = TokenBucket(None)
+        assert sum(bucket.acquire() for _ in range(100)) == 0
+        assert bucket.acquired == 100
+
+    def test_burst_is_free(self):
+        bucket = TokenBucket(rate=1, burst=3)
+        assert [bucket.acquire() for _ in range(3)] == [0, 0, 0]
+
+    def test_throttled_after_burst(self):
+        bucket = TokenBucket(rate=20, burst=1)
+        start = time.monotonic()
+        bucket.acquire()
+        waited = bucket.acquire()
+        assert 0.03 < waited <= 0.05
+        assert time.monotonic() - start >= 0.03
+        assert bucket.throttled_seconds == waited
+
+    def test_timeout_reserves_nothing(self):
+        bucket = TokenBucket(rate=10, burst=1)
+        bucket.acquire()
+        assert bucket.acquire(timeout=0.01) is None
+        assert bucket.acquired == 1
+        assert 0.05 < bucket.acquire(timeout=1) <= 0.1
+
+    def test_from_delay(self):
+        assert TokenBucket.from_delay(0).rate is None
+        assert TokenBucket.from_delay(60).rate == 1 / 60
+
+    def test_waits_outside_the_lock(self):
+        bucket = TokenBucket(rate=10, burst=1)
+        bucket.acquire()
+        waits = []
+        threads = [threading.Thread(target=lambda: waits.append(bucket.acquire())) for _ in range(3)]
+        for t in threads:
+            t.start()
+        time.sleep(0.02)
+        # the waiting callers reserved their tokens without blocking each other
+        assert bucket._lock.acquire(timeout=0.01)
+        bucket._lock.release()
+        for t in threads:
+            t.join()
+        assert sorted(round(w, 1) for w in waits) == [0.1, 0.2, 0.3]
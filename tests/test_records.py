@@ -0,0 +1,91 @@
+import json
+import shutil
+
+import pytest
+
+from src.records import (
+    RECORD_FIELDS,
+    Candidate,
+    content_hash,
+    migrate_db_file,
+    mirrored_record,
+    slim_record,
+)
+
+
+class TestClassCandidate:
+    candidate = Candidate(reddit_id="t3_abc", title="a title", url="https://example.com/page", flair="News")
+
+    def test_candidate_reads_like_a_dict(self):
+        assert self.candidate["title"] == "a title"
+        assert self.candidate.get("body") is None
+        assert self.candidate.get("missing", 1) == 1
+        with pytest.raises(KeyError):
+            self.candidate["missing"]
+
+    def test_candidate_has_no_dict(self):
+        assert not hasattr(self.candidate, "__dict__")
+        with pytest.raises(AttributeError):
+            self.candidate.extra = 1
+
+    def test_candidate_as_dict(self):
+        data = self.candidate.as_dict()
+        assert set(data) == set(Candidate.__slots__)
+        assert data["flair"] == "News"
+
+
+class TestClassRecords:
+    thread = Candidate(reddit_id="t3_abc", title="a title", body="a body", url="https://example.com/page")
+
+    def test_content_hash_is_stable(self):
+        assert content_hash(self.thread) == content_hash(self.thread.as_dict())
+        assert content_hash(self.thread) != content_hash(Candidate(reddit_id="t3_abc", title="another title"))
+
+    def test_mirrored_record(self):
+        record = mirrored_record(self.thread, {"post_view": {"post": {"id": 42}}})
+        assert set(record) <= set(RECORD_FIELDS)
+        assert record["reddit_id"] == "t3_abc"
+        assert record["lemmy_post_id"] == 42
+        assert record["content_hash"] == content_hash(self.thread)
+
+    def test_mirrored_record_without_post(self):
+        assert mirrored_record(self.thread)["lemmy_post_id"] is None
+        assert mirrored_record(self.thread, {"error": "rate_limit"})["lemmy_post_id"] is None
+
+    def test_slim_record_keeps_pair(self):
+        record = slim_record(dict(self.thread.as_dict(), pair="pics:pics"))
+        assert record["pair"] == "pics:pics"
+        assert slim_record(record) == record
+
+
+class TestClassMigrateDbFile:
+    def test_migrate_db_file(self, tmp_path):
+        db_path = str(tmp_path / "db.json")
+        shutil.copy("tests/test_db.json", db_path)
+        with open(db_path, encoding="utf-8") as f:
+            docs = json.load(f)["_default"]
+
+        before, after = migrate_db_file(db_path)
+        assert after < before
+
+        with open(db_path, encoding="utf-8") as f:
+            migrated = json.load(f)["_default"]
+        assert set(migrated) == set(docs)
+        for doc_id, doc in migrated.items():
+            assert set(doc) <= set(RECORD_FIELDS)
+            assert doc["reddit_id"] == docs[doc_id]["reddit_id"]
+
+    def test_migrate_db_file_twice(self, tmp_path):
+        db_path = str(tmp_path / "db.json")
+        shutil.copy("tests/test_db.json", db_path)
+        migrate_db_file(db_path)
+        with open(db_path, encoding="utf-8") as f:
+            migrated = f.read()
+
+        before, after = migrate_db_file(db_path)
+        assert before == after
+        with open(db_path, encoding="utf-8") as f:
+            assert f.read() == migrated
+
+    def test_migrate_missing_db_file(self, tmp_path):
+        assert migrate_db_file(str(tmp_path / "missing.json")) == (0, 0)
@@ -0,0 +1,76 @@
+import json
+import shutil
+import threading
+
+from src.restore import BackgroundRestore
+from src.store import TinyDBThreadStore
+from tests import items
+
+
+class FakeFilestack:
+    # stands in for DataBase: "downloads" a TinyDB file into db_path
+    def __init__(self, db_path, threads, fail_times=0, release=None):
+        self.db_path = db_path
+        self.threads = threads
+        self.fail_times = fail_times
+        self.release = release
+        self.calls = []
+
+    def get_backup(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.release is not None:
+            self.release.wait(5)
+        if len(self.calls) <= self.fail_times:
+            raise ConnectionError("Filestack is unavailable")
+        with open(self.db_path, "w") as f:
+            json.dump({"_default": {str(i): t for i, t in enumerate(self.threads, 1)}}, f)
+
+
+class TestClassBackgroundRestore:
+    def test_merges_backup_into_local_store(self, tmp_path):
+        db_path = shutil.copy(items.test_db_path, tmp_path / "db.json")
+        with TinyDBThreadStore(db_path) as store:
+            local = store.all()
+            backup = FakeFilestack(str(tmp_path / "db.json.restore"), [local[0], items.thread])
+
+            restore = BackgroundRestore(store, backup, handle="refresh").start()
+            assert restore.wait(5)
+            assert restore.merged == 1
+            assert len(store) == 3
+            assert items.thread["reddit_id"] in store
+            assert backup.calls == [{"handle": "refresh"}]
+            # the downloaded copy is removed after the merge
+            assert not (tmp_path / "db.json.restore").exists()
+
+    def test_store_usable_while_restoring(self, tmp_path):
+        db_path = shutil.copy(items.test_db_path, tmp_path / "db.json")
+        release = threading.Event()
+        with TinyDBThreadStore(db_path) as store:
+            backup = FakeFilestack(str(tmp_path / "db.json.restore"), [items.thread], release=release)
+            restore = BackgroundRestore(store, backup).start()
+
+            assert not restore.wait(0.1)
+            assert store.contains("test_170jhq3")
+            assert items.thread["reddit_id"] not in store
+
+            release.set()
+            assert restore.wait(5)
+            assert items.thread["reddit_id"] in store
+
+    def test_retries_until_restored(self, tmp_path):
+        db_path = tmp_path / "db.json"
+        with TinyDBThreadStore(str(db_path)) as store:
+            backup = FakeFilestack(str(tmp_path / "db.json.restore"), [items.thread], fail_times=2)
+            restore = BackgroundRestore(store, backup, retry_seconds=0.01).start()
+
+            assert restore.wait(5)
+            assert restore.failed_attempts == 2
+            assert len(store) == 1
+
+    def test_stop_while_failing(self, tmp_path):
+        with TinyDBThreadStore(str(tmp_path / "db.json")) as store:
+            backup = FakeFilestack(str(tmp_path / "db.json.restore"), [], fail_times=100)
+            restore = BackgroundRestore(store, backup, retry_seconds=0.01).start()
+            restore.stop()
+            restore._thread.join(5)
+            assert not restore.ready.is_set()
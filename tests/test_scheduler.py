@@ -0,0 +1,135 @@
+import threading
+import time
+
+import schedule
+
+from src.helper import OverlapPolicy
+from src.scheduler import JobPool, SchedulerLoop
+
+
+class TestClassSchedulerLoop:
+    def test_next_timeout_no_jobs(self):
+        loop = SchedulerLoop(schedule.Scheduler(), max_idle_seconds=30)
+        assert loop.next_timeout() == 30
+
+    def test_next_timeout_until_next_job(self):
+        scheduler = schedule.Scheduler()
+        scheduler.every(10).seconds.do(lambda: None)
+        loop = SchedulerLoop(scheduler, max_idle_seconds=30)
+        assert 9 < loop.next_timeout() <= 10
+
+    def test_run_once_runs_due_jobs(self):
+        scheduler = schedule.Scheduler()
+        calls = []
+        job = scheduler.every(10).seconds.do(lambda: calls.append(1))
+        job.next_run = job.next_run.replace(year=2000)
+        loop = SchedulerLoop(scheduler, max_idle_seconds=0.01)
+        loop.run_once()
+        assert calls == [1]
+
+    def test_adding_a_job_wakes_the_loop(self):
+        scheduler = schedule.Scheduler()
+        loop = SchedulerLoop(scheduler, max_idle_seconds=30)
+        calls = []
+
+        def add_job():
+            time.sleep(0.05)
+            scheduler.every(1).seconds.do(lambda: calls.append(1))
+
+        threading.Thread(target=add_job).start()
+        start = time.monotonic()
+        # the first sleep is cut short by the new job, the second lasts until it is due
+        loop.run_once()
+        loop.run_once()
+        loop.run_once()
+        assert time.monotonic() - start < 5
+        assert calls == [1]
+
+    def test_stop(self):
+        loop = SchedulerLoop(schedule.Scheduler(), max_idle_seconds=30)
+        runner = threading.Thread(target=loop.run_forever)
+        runner.start()
+        loop.stop()
+        runner.join(timeout=5)
+        assert not runner.is_alive()
+
+
+class TestClassJobPool:
+    def test_skip_while_running(self):
+        pool = JobPool(max_workers=2, policy=OverlapPolicy.skip)
+        release = threading.Event()
+        calls = []
+
+        def job():
+            calls.append(1)
+            release.wait(5)
+
+        assert pool.submit("mirror", job)
+        assert not pool.submit("mirror", job)
+        assert pool.skipped == 1
+        release.set()
+        pool.shutdown()
+        assert calls == [1]
+
+    def test_coalesce_runs_once_more(self):
+        pool = JobPool(max_workers=2, policy=OverlapPolicy.coalesce)
+        release = threading.Event()
+        calls = []
+
+        def job():
+            calls.append(1)
+            release.wait(5)
+
+        pool.submit("mirror", job)
+        pool.submit("mirror", job)
+        pool.submit("mirror", job)
+        assert pool.coalesced == 2
+        release.set()
+        time.sleep(0.1)
+        pool.shutdown()
+        assert calls == [1, 1]
+
+    def test_running_and_queue_depth(self):
+        pool = JobPool(max_workers=1)
+        release = threading.Event()
+        started = threading.Event()
+
+        def job():
+            started.set()
+            release.wait(5)
+
+        pool.submit("mirror", job)
+        pool.submit("automod", job)
+        started.wait(5)
+        assert pool.running == 1
+        assert pool.queue_depth == 1
+        release.set()
+        pool.shutdown()
+        assert pool.running == 0 and pool.queue_depth == 0
+
+    def test_shutdown_finishes_running_jobs_and_drops_queued_ones(self):
+        pool = JobPool(max_workers=1)
+        started = threading.Event()
+        calls = []
+
+        def job(n):
+            started.set()
+            time.sleep(0.1)
+            calls.append(n)
+
+        pool.submit("mirror", job, {"n": 1})
+        pool.submit("backup", job, {"n": 2})
+        started.wait(5)
+        pool.shutdown(wait=True, cancel_queued=True)
+        assert calls == [1]
+        assert pool.queue_depth == 0
+
+    def test_failing_job_is_released(self):
+        pool = JobPool(max_workers=1)
+
+        def job():
+            raise ValueError("Test")
+
+        pool.submit("mirror", job)
+        pool.shutdown()
+        assert not pool.is_active("mirror")
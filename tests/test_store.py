@@ -0,0 +1,223 @@
+import os
+import shutil
+from unittest import mock
+
+import pytest
+from tinydb import TinyDB
+
+from src.helper import Util
+from src.store import (
+    BloomFilter,
+    JournalThreadStore,
+    ScopedThreadStore,
+    ThreadStore,
+    TinyDBThreadStore,
+    open_thread_store,
+    thread_key,
+)
+from tests import items
+
+
+class TestClassThreadStore:
+    def test_is_abstract(self):
+        with pytest.raises(TypeError):
+            ThreadStore()
+
+
+class TestClassTinyDBThreadStore:
+    def test_index_built_from_file(self, tmp_path):
+        db_path = shutil.copy(items.test_db_path, tmp_path / "db.json")
+        with TinyDBThreadStore(db_path) as store:
+            assert len(store) == 2
+            assert store.contains("test_170jhq3")
+            assert not store.contains("test_1234")
+
+    def test_insert_and_remove(self, tmp_path):
+        db_path = shutil.copy(items.test_db_path, tmp_path / "db.json")
+        with TinyDBThreadStore(db_path) as store:
+            store.insert(items.thread)
+            assert items.thread["reddit_id"] in store
+            assert store.remove(items.thread["reddit_id"])
+            assert not store.remove(items.thread["reddit_id"])
+            assert items.thread["reddit_id"] not in store
+
+    def test_insert_is_persisted(self, tmp_path):
+        db_path = shutil.copy(items.test_db_path, tmp_path / "db.json")
+        with TinyDBThreadStore(db_path) as store:
+            Util._insert_thread_into_db(items.thread, store)
+
+        with TinyDBThreadStore(db_path) as store:
+            assert Util._check_thread_in_db(items.thread["reddit_id"], store)
+            assert len(store.all()) == 3
+
+    def test_merge_by_reddit_id(self, tmp_path):
+        db_path = shutil.copy(items.test_db_path, tmp_path / "db.json")
+        with TinyDBThreadStore(db_path) as store:
+            existing = store.all()[0]
+            assert store.merge([existing, items.thread, dict(items.thread)]) == 1
+            assert len(store) == 3
+
+        with TinyDBThreadStore(db_path) as store:
+            assert items.thread["reddit_id"] in store
+
+
+class TestClassJournalThreadStore:
+    def test_insert_appends_to_journal(self, tmp_path):
+        db_path = shutil.copy(items.test_db_path, tmp_path / "db.json")
+        snapshot = open(db_path).read()
+
+        store = JournalThreadStore(str(db_path), compact_every=0)
+        store.insert(items.thread)
+
+        assert store.contains(items.thread["reddit_id"])
+        assert open(db_path).read() == snapshot
+        assert len(open(store.journal_path).readlines()) == 1
+        store.close()
+
+    def test_close_compacts_into_tinydb_snapshot(self, tmp_path):
+        db_path = shutil.copy(items.test_db_path, tmp_path / "db.json")
+        with JournalThreadStore(str(db_path), compact_every=0) as store:
+            store.insert(items.thread)
+            store.remove("test_170jhtj")
+
+        assert open(store.journal_path).read() == ""
+        db = TinyDB(db_path)
+        assert [doc["reddit_id"] for doc in db.all()] == ["test_170jhq3", items.thread["reddit_id"]]
+        db.close()
+
+    def test_compact_every(self, tmp_path):
+        store = JournalThreadStore(str(tmp_path / "db.json"), compact_every=2)
+        store.insert(items.thread)
+        store.insert(items.thread_no_url | {"reddit_id": "test_2"})
+        assert open(store.journal_path).read() == ""
+        assert len(TinyDB(tmp_path / "db.json").all()) == 2
+        store.close()
+
+    def test_journal_replayed_after_crash(self, tmp_path):
+        db_path = str(tmp_path / "db.json")
+        store = JournalThreadStore(db_path, compact_every=0)
+        store.insert(items.thread)
+        # simulate a crash: no close(), plus a torn record at the end of the journal
+        with open(store.journal_path, "a") as f:
+            f.write('{"op": "ins')
+
+        with JournalThreadStore(db_path) as recovered:
+            assert recovered.contains(items.thread["reddit_id"])
+            assert len(recovered) == 1
+
+    def test_journal_with_only_a_torn_record(self, tmp_path):
+        db_path = str(tmp_path / "db.json")
+        with open(f"{db_path}.journal", "w") as f:
+            f.write('{"op": "ins')
+
+        store = JournalThreadStore(db_path, compact_every=0)
+        assert open(store.journal_path).read() == ""
+        store.insert(items.thread)
+        # crash again before the journal is compacted
+        store._journal.close()
+
+        with JournalThreadStore(db_path) as recovered:
+            assert recovered.contains(items.thread["reddit_id"])
+
+    def test_merge_is_journaled(self, tmp_path):
+        db_path = tmp_path / "db.json"
+        with JournalThreadStore(str(db_path), compact_every=0) as store:
+            assert store.merge([items.thread]) == 1
+            assert os.path.getsize(store.journal_path) > 0
+
+    def test_merge_writes_the_batch_once(self, tmp_path):
+        threads = [dict(items.thread, reddit_id=f"test_{n}") for n in range(5)]
+        with JournalThreadStore(str(tmp_path / "db.json"), compact_every=3) as store:
+            with mock.patch("src.store.os.fsync", wraps=os.fsync) as fsync:
+                assert store.merge(threads) == 5
+            # one fsync for the journal, one for the compacted snapshot
+            assert fsync.call_count == 2
+            assert open(store.journal_path).read() == ""
+            assert len(store) == 5
+
+        assert [doc["reddit_id"] for doc in TinyDB(tmp_path / "db.json").all()] == [t["reddit_id"] for t in threads]
+
+    def test_open_thread_store(self, tmp_path):
+        db_path = str(tmp_path / "db.json")
+        with open_thread_store(db_path, storage="journal") as store:
+            assert isinstance(store, JournalThreadStore)
+        with open_thread_store(db_path) as store:
+            assert isinstance(store, TinyDBThreadStore)
+
+
+class TestClassScopedThreadStore:
+    def test_pairs_are_kept_apart(self, tmp_path):
+        db_path = shutil.copy(items.test_db_path, tmp_path / "db.json")
+        with TinyDBThreadStore(db_path) as store:
+            pics, news = ScopedThreadStore(store, "pics:pics"), ScopedThreadStore(store, "news:world")
+            pics.insert(items.thread)
+
+            assert items.thread["reddit_id"] in pics
+            assert items.thread["reddit_id"] not in news
+            # threads without a pair belong to the single pair setup
+            assert items.thread["reddit_id"] not in store
+            assert thread_key(items.thread["reddit_id"], "pics:pics") in store
+            assert len(pics) == 1 and len(news) == 0
+
+        with JournalThreadStore(db_path) as store:
+            assert ScopedThreadStore(store, "pics:pics").contains(items.thread["reddit_id"])
+            assert len(store) == 3
+
+    def test_unpaired_threads_after_switching_to_pairs(self, tmp_path):
+        # threads mirrored by the single pair setup have no pair
+        db_path = shutil.copy(items.test_db_path, tmp_path / "db.json")
+        with TinyDBThreadStore(db_path) as store:
+            legacy = ScopedThreadStore(store, "all:bot_test", include_unpaired=True)
+            other = ScopedThreadStore(store, "pics:pics")
+            assert "test_170jhq3" in legacy and "test_170jhq3" not in other
+            legacy.insert(items.thread)
+            assert len(legacy) == 3 and len(other) == 0
+
+            assert legacy.remove("test_170jhq3")
+            assert "test_170jhq3" not in legacy
+
+    def test_len_counts_index_entries(self, tmp_path):
+        with JournalThreadStore(str(tmp_path / "db.json")) as store:
+            scoped = ScopedThreadStore(store, "pics:pics")
+            scoped.merge([dict(items.thread, reddit_id=f"test_{n}") for n in range(3)])
+            store.insert(items.thread)
+            with mock.patch.object(store, "all", side_effect=AssertionError):
+                assert len(scoped) == 3
+                assert len(ScopedThreadStore(store, "pics:pics", include_unpaired=True)) == 4
+
+    def test_merge_keeps_pairs(self, tmp_path):
+        with TinyDBThreadStore(str(tmp_path / "db.json")) as store:
+            ScopedThreadStore(store, "pics:pics").insert(items.thread)
+            assert store.merge([items.thread, dict(items.thread, pair="pics:pics")]) == 1
+            assert items.thread["reddit_id"] in store
+
+
+class TestClassBloomFilter:
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000, false_positive_rate=0.01)
+        keys = [f"t3_{i}" for i in range(1000)]
+        for k in keys:
+            bloom.add(k)
+        assert all(k in bloom for k in keys)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(capacity=1000, false_positive_rate=0.01)
+        for i in range(1000):
+            bloom.add(f"t3_{i}")
+        false_positives = sum(f"t3_x{i}" in bloom for i in range(10000))
+        assert false_positives / 10000 < 0.03
+
+    def test_memory_budget(self):
+        bloom = BloomFilter(capacity=1000000, false_positive_rate=0.001, max_bytes=1024)
+        assert bloom.size_bytes == 1024
+
+    def test_store_saves_lookups(self, tmp_path):
+        db_path = shutil.copy(items.test_db_path, tmp_path / "db.json")
+        with TinyDBThreadStore(db_path) as store:
+            store.attach_bloom_filter(false_positive_rate=0.001)
+            assert store.contains("test_170jhq3")
+            assert not store.contains("test_1234")
+            assert store.lookups_saved == 1
+
+            store.insert(items.thread)
+            assert store.contains(items.thread["reddit_id"])